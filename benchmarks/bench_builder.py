@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Micro-benchmark for :class:`~txgraylog.protocol.gelf.GelfBuilder`. Compares
+building the messages for an event with the builder each protocol keeps
+against building a :class:`~txgraylog.protocol.gelf.GelfProtocol` for every
+event, as the protocols used to, for both UDP's compressed and chunked
+messages and TCP's plain ones.
+
+Python 2 has no tracemalloc, so rather than counting allocations this
+reports the size of the objects made for each event besides the messages
+themselves, and the number of garbage collections run while encoding the
+events, counted from the garbage collector's own debugging output.
+"""
+
+import gc
+import os
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from txgraylog.protocol import gelf  # noqa
+
+ROUNDS = 20000
+OVERRIDES = {'application': 'billing-api', 'environment': 'production'}
+TEMPLATE = gelf.GelfTemplate('localhost', OVERRIDES)
+SENDERS = [
+    # name, whether to chunk and whether to compress
+    ('udp', True, True),
+    ('tcp', False, False),
+]
+
+
+def make_event(size):
+    return {
+        'system': 'HTTPChannel,0,127.0.0.1',
+        'message': ['"GET /api/v1/customers/1234 HTTP/1.1" 200 512'],
+        'isError': False,
+        'time': time.time(),
+        'customer_id': 1234,
+        'request_id': 'c0ffee00-dead-beef-cafe-000000000000',
+        'body': os.urandom(size // 2).encode('hex'),
+    }
+
+
+def per_event(chunk, compress):
+    def build(event):
+        return gelf.GelfProtocol(
+            'localhost', chunk=chunk, compress=compress, template=TEMPLATE,
+            **event).generate()
+    return build
+
+
+def builder(chunk, compress):
+    return gelf.GelfBuilder(TEMPLATE, chunk=chunk, compress=compress).build
+
+
+def overhead(chunk, compress, event):
+    """ The size in bytes of the objects made for an event besides the
+        messages, in each way
+    """
+    g = gelf.GelfProtocol(
+        'localhost', chunk=chunk, compress=compress, template=TEMPLATE,
+        **event)
+    messages = g.generate()
+    before = sum(sys.getsizeof(o) for o in (
+        g, g.__dict__, g._event, messages))
+    after = sys.getsizeof(builder(chunk, compress)(event))
+    return before, after
+
+
+def collections(func, event, rounds):
+    """ Count the garbage collections run while building the messages for
+        an event `rounds` times
+    """
+    gc.collect()
+    log = tempfile.TemporaryFile()
+    stderr, sys.stderr = sys.stderr, log
+    gc.set_debug(gc.DEBUG_STATS)
+    try:
+        for _ in xrange(rounds):
+            func(event)
+    finally:
+        gc.set_debug(0)
+        sys.stderr = stderr
+    log.seek(0)
+    return log.read().count('collecting generation')
+
+
+def run(func, event):
+    seconds = min(timeit.repeat(lambda: func(event), number=ROUNDS, repeat=3))
+    return seconds / ROUNDS * 1e6
+
+
+def main():
+    print '%-5s %6s %10s %10s %8s %9s %9s %6s %6s' % (
+        'proto', 'size', 'old us', 'new us', 'speedup', 'old B', 'new B',
+        'old gc', 'new gc')
+    for name, chunk, compress in SENDERS:
+        for size in (256, 4096, 32768):
+            event = make_event(size)
+            old = per_event(chunk, compress)
+            new = builder(chunk, compress)
+            before, after = run(old, event), run(new, event)
+            old_bytes, new_bytes = overhead(chunk, compress, event)
+            print '%-5s %6d %10.2f %10.2f %7.2fx %9d %9d %6d %6d' % (
+                name, size, before, after, before / after, old_bytes,
+                new_bytes, collections(old, event, ROUNDS),
+                collections(new, event, ROUNDS))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Micro-benchmark for :class:`~txgraylog.protocol.gelf.ChunkIds`. Compares
+generating the id of a chunked message from a per-process prefix and counter
+against reading random bytes, and uuid1 for the legacy format, for every
+message, on its own and in the throughput of building chunked messages.
+"""
+
+import os
+import sys
+import time
+import timeit
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from twisted.python import randbytes  # noqa
+
+from txgraylog.protocol import gelf  # noqa
+
+ROUNDS = 20000
+
+
+class RandomIds(object):
+    """ The ids chunked messages used to have
+    """
+
+    def __init__(self, legacy):
+        self.legacy = legacy
+
+    def next(self):
+        if self.legacy:
+            return uuid.uuid1().bytes + randbytes.secureRandom(16)
+        return randbytes.secureRandom(8)
+
+
+def make_event(size):
+    return {
+        'system': 'HTTPChannel,0,127.0.0.1',
+        'message': [os.urandom(size // 2).encode('hex')],
+        'isError': False,
+        'time': time.time(),
+    }
+
+
+def run(func):
+    seconds = min(timeit.repeat(func, number=ROUNDS, repeat=3))
+    return seconds / ROUNDS * 1e6
+
+
+def compare(name, func, legacy):
+    """ Time a function with the random ids and then with the counters
+    """
+    attribute = 'LEGACY_IDS' if legacy else 'NEW_IDS'
+    counters = getattr(gelf, attribute)
+    setattr(gelf, attribute, RandomIds(legacy))
+    try:
+        before = run(func)
+    finally:
+        setattr(gelf, attribute, counters)
+    after = run(func)
+    print '%-24s %10.2f %10.2f %8.2fx' % (
+        name, before, after, before / after)
+
+
+def main():
+    template = gelf.GelfTemplate('localhost')
+    print '%-24s %10s %10s %9s' % ('', 'random us', 'counter us', 'speedup')
+    for legacy, fmt in ((True, gelf.GELF_LEGACY), (False, gelf.GELF_NEW)):
+        label = 'legacy' if legacy else 'new'
+        compare('%s id' % (label, ),
+                lambda: gelf.chunk_header(fmt, 2), legacy)
+        for size in (4096, 32768):
+            builder = gelf.GelfBuilder(
+                template, gelf_fmt=fmt, compress=False)
+            event = make_event(size)
+            compare('%s %d byte message' % (label, size),
+                    lambda: builder.build(event), legacy)
+
+
+if __name__ == '__main__':
+    main()
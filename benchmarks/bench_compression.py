@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Benchmark matrix for GELF compression strategies. For each distribution of
+message sizes it reports the CPU time per message, the bytes sent relative
+to the uncompressed JSON and the number of UDP datagrams needed.
+"""
+
+import os
+import sys
+import time
+import zlib
+import random
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from txgraylog.protocol import compression, gelf  # noqa
+
+MESSAGES = 2000
+WORDS = (
+    'GET POST /api/v1/customers /orders 200 404 500 request response '
+    'timeout user session token cache hit miss database query took ms '
+    'connection refused retrying upstream worker').split()
+
+
+class TemplateGzipCompression(compression.GzipCompression):
+    """ Gzip copying a prepared compressor, measured to show why the
+        shipped strategy does not do this
+    """
+
+    def __init__(self, *args, **kwargs):
+        compression.GzipCompression.__init__(self, *args, **kwargs)
+        self.template = zlib.compressobj(
+            self.level, zlib.DEFLATED, compression.GZIP_WBITS)
+
+    def compress(self, data):
+        compressor = self.template.copy()
+        return compressor.compress(data) + compressor.flush()
+
+
+STRATEGIES = [
+    ('none', compression.NONE),
+    ('zlib-1', compression.ZlibCompression(1)),
+    ('zlib-6', compression.ZlibCompression(6)),
+    ('zlib-9', compression.ZlibCompression(9)),
+    ('zlib-1 >=512B', compression.ZlibCompression(1, min_size=512)),
+    ('zlib-6 >=512B', compression.ZlibCompression(6, min_size=512)),
+    ('gzip-6', compression.GzipCompression(6)),
+    ('gzip-6 copied', TemplateGzipCompression(6)),
+]
+
+
+def sentence(size, rand):
+    words = []
+    while sum(len(w) + 1 for w in words) < size:
+        words.append(rand.choice(WORDS))
+    return ' '.join(words)
+
+
+def distributions():
+    rand = random.Random(4)
+    return [
+        ('small 50-300B', [rand.randint(50, 300) for _ in xrange(MESSAGES)]),
+        ('medium 1-3KB', [rand.randint(1024, 3072) for _ in xrange(MESSAGES)]),
+        ('large 8-32KB', [rand.randint(8192, 32768) for _ in xrange(MESSAGES)]),
+        ('lognormal', [
+            min(int(rand.lognormvariate(6, 1.2)), 65536)
+            for _ in xrange(MESSAGES)]),
+    ]
+
+
+def make_payloads(sizes):
+    rand = random.Random(8)
+    return [
+        gelf.serializer.dumps(gelf.GelfProtocol('localhost', compress=False, **{
+            'system': 'bench',
+            'message': [sentence(size, rand)],
+            'isError': False,
+            'time': time.time(),
+            'request_id': rand.randint(0, 1 << 30),
+        }).log_params)
+        for size in sizes
+    ]
+
+
+def measure(strategy, payloads):
+    def run():
+        for payload in payloads:
+            strategy.compress(payload)
+
+    seconds = min(timeit.repeat(run, number=1, repeat=3))
+    sent = [len(strategy.compress(p)) for p in payloads]
+    datagrams = sum(
+        1 if size <= gelf.WAN_CHUNK else
+        (size + gelf.WAN_CHUNK - 1) // gelf.WAN_CHUNK for size in sent)
+    return (
+        seconds / len(payloads) * 1e6,
+        float(sum(sent)) / sum(len(p) for p in payloads),
+        datagrams)
+
+
+def main():
+    for name, sizes in distributions():
+        payloads = make_payloads(sizes)
+        print '%s (%d messages)' % (name, len(payloads))
+        print '  %-14s %10s %8s %10s' % (
+            'strategy', 'us/msg', 'ratio', 'datagrams')
+        for label, strategy in STRATEGIES:
+            print '  %-14s %10.2f %8.3f %10d' % (
+                (label, ) + measure(strategy, payloads))
+        print
+
+
+if __name__ == '__main__':
+    main()
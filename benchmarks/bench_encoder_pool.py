@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Latency benchmark for the encoder pool. Measures the time the reactor
+thread spends per event when GELF messages are encoded inline, and when
+they are encoded by :class:`~txgraylog.encoder.EncoderPool`.
+"""
+
+import os
+import sys
+import time
+import binascii
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from twisted.internet import defer, reactor, task  # noqa
+from twisted.python import randbytes  # noqa
+from twisted.test import proto_helpers  # noqa
+
+from txgraylog.encoder import EncoderPool  # noqa
+from txgraylog.protocol.tcp import TCPGelfProtocol  # noqa
+
+EVENTS = 20000
+PER_TICK = 200
+PAYLOAD = binascii.hexlify(randbytes.insecureRandom(1024))
+
+
+class Timer(object):
+    """ Accumulates the time spent in the wrapped callables
+    """
+
+    def __init__(self):
+        self.elapsed = 0.0
+
+    def wrap(self, func):
+        def timed(*args, **kwargs):
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.elapsed += time.time() - start
+        return timed
+
+
+def make_protocol():
+    protocol = TCPGelfProtocol('127.0.0.1', 12201)
+    protocol.makeConnection(proto_helpers.StringTransport())
+    return protocol
+
+
+def make_event(i):
+    return {
+        'system': 'bench',
+        'message': ['message number %d %s' % (i, PAYLOAD)],
+        'isError': False,
+        'time': time.time(),
+    }
+
+
+@defer.inlineCallbacks
+def measure(workers):
+    timer = Timer()
+    protocol = make_protocol()
+
+    pool = None
+    if workers:
+        pool = EncoderPool(protocol, workers, max_pending=EVENTS)
+        pool._deliver = timer.wrap(pool._deliver)
+        emit = timer.wrap(pool.submit)
+        pool.start()
+    else:
+        emit = timer.wrap(protocol.log_message)
+
+    for i in xrange(0, EVENTS, PER_TICK):
+        for j in xrange(i, i + PER_TICK):
+            emit(make_event(j))
+        yield task.deferLater(reactor, 0, lambda: None)
+
+    if pool is not None:
+        while pool.pending:
+            yield task.deferLater(reactor, 0.001, lambda: None)
+        pool.stop()
+
+    defer.returnValue(timer.elapsed / EVENTS * 1e6)
+
+
+@defer.inlineCallbacks
+def main():
+    try:
+        inline = yield measure(0)
+        print 'inline encoding:     %8.2f us/event on the reactor' % (inline, )
+        for workers in (1, 2, 4):
+            pooled = yield measure(workers)
+            print '%d encoder thread(s): %8.2f us/event on the reactor' % (
+                workers, pooled)
+    finally:
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    reactor.callWhenRunning(main)
+    reactor.run()
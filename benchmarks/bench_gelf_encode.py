@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Micro-benchmark for GELF encoding. Compares the cost of building and
+generating a :class:`~txgraylog.protocol.gelf.GelfProtocol` message against
+the previous behaviour, which serialized and compressed each event twice.
+"""
+
+import os
+import sys
+import time
+import zlib
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from txgraylog.protocol import gelf  # noqa
+
+EVENTS_PER_SECOND = 20000
+ROUNDS = 20000
+
+
+def make_event():
+    return {
+        'system': 'HTTPChannel,0,127.0.0.1',
+        'message': ['"GET /api/v1/customers/1234 HTTP/1.1" 200 512'],
+        'isError': False,
+        'time': time.time(),
+        'customer_id': 1234,
+        'request_id': 'c0ffee00-dead-beef-cafe-000000000000',
+    }
+
+
+def encode_twice(event):
+    """ The encoding cost before memoization: `generate` read the encoded
+        property twice, serializing and compressing on each access
+    """
+    g = gelf.GelfProtocol('localhost', **event)
+    for _ in xrange(2):
+        zlib.compress(gelf.serializer.dumps(g.log_params))
+    return g
+
+
+def encode_once(event):
+    return gelf.GelfProtocol('localhost', **event).generate()
+
+
+def run(func):
+    event = make_event()
+    seconds = min(timeit.repeat(lambda: func(event), number=ROUNDS, repeat=3))
+    return seconds / ROUNDS * 1e6
+
+
+def main():
+    before, after = run(encode_twice), run(encode_once)
+    print 'double encoding:  %8.2f us/event' % (before, )
+    print 'single encoding:  %8.2f us/event' % (after, )
+    print 'saved:            %8.2f us/event' % (before - after, )
+    print 'CPU saved at %d events/s: %.1f%% of one core' % (
+        EVENTS_PER_SECOND, (before - after) * EVENTS_PER_SECOND / 1e4)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Micro-benchmark for :class:`~txgraylog.protocol.gelf.GelfTemplate`. Compares
+building and serializing an uncompressed GELF message from a template
+against updating the event with the overrides and building the message
+from scratch.
+"""
+
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from txgraylog.protocol import gelf  # noqa
+
+ROUNDS = 20000
+OVERRIDES = {
+    'application': 'billing-api',
+    'environment': 'production',
+    'datacenter': 'eu-west-1',
+    'release': '2015.06.1',
+}
+
+
+def make_event():
+    return {
+        'system': 'HTTPChannel,0,127.0.0.1',
+        'message': ['"GET /api/v1/customers/1234 HTTP/1.1" 200 512'],
+        'isError': False,
+        'time': time.time(),
+        'customer_id': 1234,
+        'request_id': 'c0ffee00-dead-beef-cafe-000000000000',
+    }
+
+
+def from_scratch(event):
+    event.update(OVERRIDES)
+    return gelf.GelfProtocol(
+        'localhost', compress=False, **event).encoded_log_params
+
+
+def from_template(event, template=gelf.GelfTemplate('localhost', OVERRIDES)):
+    return gelf.GelfProtocol(
+        'localhost', compress=False, template=template,
+        **event).encoded_log_params
+
+
+def run(func):
+    event = make_event()
+    seconds = min(timeit.repeat(lambda: func(event), number=ROUNDS, repeat=3))
+    return seconds / ROUNDS * 1e6
+
+
+def main():
+    before, after = run(from_scratch), run(from_template)
+    print 'from scratch:   %8.2f us/event' % (before, )
+    print 'from template:  %8.2f us/event' % (after, )
+    print 'speedup:        %8.2fx' % (before / after, )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Throughput benchmark for :class:`~txgraylog.protocol.http.HTTPGelfProtocol`
+against :class:`~txgraylog.protocol.tcp.TCPGelfProtocol`. Sends the same
+events to local stand in servers over TCP, over HTTP with a request per
+message and over HTTP with batched requests, and measures how long it takes
+for all of them to arrive
+"""
+
+import os
+import sys
+import time
+import zlib
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from twisted.internet import defer, reactor, task  # noqa
+from twisted.internet.protocol import Factory, Protocol  # noqa
+from twisted.web import resource, server  # noqa
+
+from txgraylog.buffering import MessageBuffer  # noqa
+from txgraylog.protocol.compression import GZIP_WBITS  # noqa
+from txgraylog.protocol.http import HTTPGelfProtocol  # noqa
+from txgraylog.protocol.tcp import TCPGelfProtocol, TCPGraylogFactory  # noqa
+
+EVENTS = 5000
+
+
+def make_event(i):
+    return {
+        'system': 'HTTPChannel,0,127.0.0.1',
+        'message': ['"GET /api/v1/customers/%d HTTP/1.1" 200 512' % (i, )],
+        'isError': False,
+        'time': time.time(),
+        'customer_id': i,
+    }
+
+
+class Counter(object):
+    received = 0
+
+
+class TCPInput(Protocol):
+    def dataReceived(self, data):
+        Counter.received += data.count('\x00')
+
+
+class HTTPInput(resource.Resource):
+    isLeaf = True
+
+    def render_POST(self, request):
+        body = request.content.read()
+        if request.getHeader('content-encoding') == 'gzip':
+            body = zlib.decompress(body, GZIP_WBITS)
+        Counter.received += body.count('\n') + 1
+        request.setResponseCode(202)
+        return ''
+
+
+@defer.inlineCallbacks
+def until(condition):
+    while not condition():
+        yield task.deferLater(reactor, 0.001, lambda: None)
+
+
+@defer.inlineCallbacks
+def run(name, protocol):
+    Counter.received = 0
+    start = time.time()
+    for i in xrange(EVENTS):
+        protocol.log_message(make_event(i))
+    yield until(lambda: Counter.received >= EVENTS)
+    elapsed = time.time() - start
+    print '%-16s %8.0f events/s' % (name, EVENTS / elapsed)
+
+
+@defer.inlineCallbacks
+def main():
+    factory = Factory()
+    factory.protocol = TCPInput
+    tcp_port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+    http_port = reactor.listenTCP(
+        0, server.Site(HTTPInput()), interface='127.0.0.1')
+
+    # every event is logged at once, faster than the transport takes them,
+    # so the buffer has to hold those logged while it is paused
+    tcp = TCPGelfProtocol(
+        '127.0.0.1', tcp_port.getHost().port,
+        buffer=MessageBuffer(max_count=None))
+    reactor.connectTCP(tcp.host, tcp.port, TCPGraylogFactory(tcp))
+    yield until(lambda: tcp.connected)
+    yield run('tcp', tcp)
+
+    for name, options in [('http', {'concurrency': 4}),
+                          ('http batched', {'batch': True})]:
+        # every event is queued at once, so the buffer has to hold them all
+        http = HTTPGelfProtocol(
+            '127.0.0.1', http_port.getHost().port,
+            buffer=MessageBuffer(max_count=None), **options)
+        http.connect()
+        yield run(name, http)
+        yield http.disconnect()
+
+    reactor.stop()
+
+
+if __name__ == '__main__':
+    reactor.callWhenRunning(main)
+    reactor.run()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Micro-benchmark for :class:`~txgraylog.protocol.limits.SizeLimits`. Compares
+encoding a typical event and a huge failure event into compressed GELF
+datagrams with and without the size limits, reporting the time taken and
+the number of chunks produced.
+"""
+
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from twisted.python.failure import Failure  # noqa
+
+from txgraylog.protocol import gelf  # noqa
+from txgraylog.protocol.limits import DEFAULT_LIMITS  # noqa
+
+
+def recurse(depth):
+    if depth:
+        recurse(depth - 1)
+    raise ValueError('bottom')
+
+
+def typical_event():
+    return {
+        'system': 'HTTPChannel,0,127.0.0.1',
+        'message': ['"GET /api/v1/customers/1234 HTTP/1.1" 200 512'],
+        'isError': False,
+        'time': time.time(),
+        'customer_id': 1234,
+        'request_id': 'c0ffee00-dead-beef-cafe-000000000000',
+    }
+
+
+def huge_event():
+    try:
+        recurse(800)
+    except ValueError:
+        failure = Failure()
+
+    return {
+        'system': 'worker',
+        'message': [],
+        'isError': True,
+        'failure': failure,
+        'time': time.time(),
+        'rows': range(100000),
+        'body': os.urandom(200000).encode('hex'),
+    }
+
+
+def run(event, limits, rounds):
+    def encode():
+        return gelf.GelfProtocol(
+            'localhost', limits=limits, **event).generate()
+
+    seconds = min(timeit.repeat(encode, number=rounds, repeat=3))
+    return seconds / rounds * 1e6, len(encode())
+
+
+def main():
+    for name, event, rounds in [('typical', typical_event(), 5000),
+                                ('huge', huge_event(), 10)]:
+        for label, limits in [('no limits', None), ('limits', DEFAULT_LIMITS)]:
+            took, chunks = run(event, limits, rounds)
+            print '%-8s %-10s %12.2f us/event %4d chunks' % (
+                name, label, took, chunks)
+
+
+if __name__ == '__main__':
+    main()
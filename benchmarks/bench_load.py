@@ -0,0 +1,423 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Load generator and benchmark harness for every txGraylog sender. Drives a
+:class:`~txgraylog.observer.GraylogObserver` with a synthetic stream of
+Twisted log events of a given size, level mix and share of failures, sending
+them to local stand ins for Graylog's UDP, TCP and HTTP inputs. Each protocol
+is run in a process of its own, so that its memory high-water mark is its
+own, and reports:
+
+    - events per second, from the first event until the last one arrives
+    - reactor thread time per event, spent in the observer's `emit`
+    - bytes on the wire and the number of GELF chunks
+    - the memory high-water mark of the process
+
+The results are written to `benchmarks/results/<name>.json`, by default
+named after the release in setup.py, and can be compared against those of
+an earlier release to catch regressions. A run compared against the file it
+would be written to leaves that file alone unless `--name` is given:
+
+    python benchmarks/bench_load.py --events 50000 --size 1024
+    python benchmarks/bench_load.py --compare benchmarks/results/0.3.json
+"""
+
+import argparse
+import json
+import os
+import random
+import re
+import resource
+import socket
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+import zlib
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'src'))
+
+from twisted.internet import defer, protocol, reactor, task  # noqa
+from twisted.python import log  # noqa
+from twisted.python.failure import Failure  # noqa
+from twisted.web import resource as web_resource, server  # noqa
+
+from txgraylog.buffering import MessageBuffer  # noqa
+from txgraylog.observer import GraylogObserver  # noqa
+from txgraylog.protocol import amqp, http, relay, tcp, udp  # noqa
+from txgraylog.protocol.compression import GZIP_WBITS  # noqa
+from txgraylog.service import GraylogRelayService  # noqa
+
+# the protocols, the input each sends to and the options it is given
+PROTOCOLS = [
+    ('udp-plain', udp.UDPPlainTextProtocol, 'udp', {}),
+    ('udp-gelf', udp.UDPGelfProtocol, 'udp', {}),
+    ('tcp-plain', tcp.TCPPlainTextProtocol, 'tcp', {'coalesce': True}),
+    ('tcp-gelf', tcp.TCPGelfProtocol, 'tcp', {'coalesce': True}),
+    ('http-gelf', http.HTTPGelfProtocol, 'http', {'batch': True}),
+    ('relay-gelf', relay.RelayGelfProtocol, 'relay', {}),
+    ('amqp-gelf', amqp.AMQPGelfProtocol, 'amqp', {}),
+]
+LEVELS = {'debug': 7, 'info': 6, 'warning': 4, 'error': 3, 'critical': 2}
+
+# events are emitted in slices, giving the inputs a chance to read
+SLICE = 200
+# how long the inputs may see nothing before we stop waiting for the rest
+IDLE = 2.0
+# the metrics compared between runs, and whether more is better
+COMPARED = [
+    ('events_per_second', True),
+    ('reactor_us_per_event', False),
+    ('wire_bytes', False),
+    ('max_rss_kb', False),
+]
+
+
+def release():
+    with open(os.path.join(HERE, '..', 'setup.py')) as f:
+        return re.search(r"version='([^']+)'", f.read()).group(1)
+
+
+def parse_levels(text):
+    """ Parse a level mix such as `info=80,warning=15,error=5`
+    """
+    mix = []
+    for part in text.split(','):
+        name, weight = part.split('=')
+        mix.append((LEVELS[name.strip()], float(weight)))
+    return mix
+
+
+class EventStream(object):
+    """ Builds a reproducible stream of legacy Twisted log events
+    """
+
+    def __init__(self, size, levels, failures, seed=0):
+        self.random = random.Random(seed)
+        self.size = size
+        self.failures = failures
+        self.levels = []
+        total = sum(weight for _, weight in levels)
+        cumulative = 0
+        for level, weight in levels:
+            cumulative += weight / total
+            self.levels.append((cumulative, level))
+        self.failure = self._failure()
+
+    def _failure(self):
+        try:
+            {}['missing']
+        except KeyError:
+            return Failure()
+
+    def _level(self):
+        roll = self.random.random()
+        for cumulative, level in self.levels:
+            if roll <= cumulative:
+                return level
+        return self.levels[-1][1]
+
+    def event(self, i):
+        # random text, as padding of a single character would compress to
+        # next to nothing
+        length = max(self.size - 64, 0)
+        padding = '%0*x' % (length, self.random.getrandbits(4 * length + 4))
+        padding = padding[:length]
+        event = {
+            'system': 'HTTPChannel,%d,127.0.0.1' % (i % 16, ),
+            'message': ('GET /api/v1/customers/%d 200 %s' % (i, padding), ),
+            'isError': False,
+            'time': time.time(),
+            'level': self._level(),
+            'customer_id': i,
+        }
+        if self.random.random() < self.failures:
+            event.update(
+                isError=True, failure=self.failure, why='request failed',
+                level=3)
+        return event
+
+
+class Input(object):
+    """ Counts what arrives at the stand in Graylog inputs
+    """
+
+    def __init__(self):
+        self.messages = 0
+        self.bytes = 0
+        self.chunks = 0
+        self.last = time.time()
+
+    def received(self, messages, size, chunks=0):
+        self.messages += messages
+        self.bytes += size
+        self.chunks += chunks
+        self.last = time.time()
+
+
+class UDPInput(protocol.DatagramProtocol):
+
+    def __init__(self, counts):
+        self.counts = counts
+
+    def datagramReceived(self, data, address):
+        if data.startswith('\x1e\x0f'):
+            # count a message by its first chunk
+            first = struct.unpack('>H', data[34:36])[0] == 0
+            self.counts.received(int(first), len(data), 1)
+        else:
+            self.counts.received(1, len(data))
+
+
+class TCPInput(protocol.Protocol):
+
+    def dataReceived(self, data):
+        self.factory.counts.received(data.count('\x00'), len(data))
+
+
+class HTTPInput(web_resource.Resource):
+    isLeaf = True
+
+    def __init__(self, counts):
+        web_resource.Resource.__init__(self)
+        self.counts = counts
+
+    def render_POST(self, request):
+        body = request.content.read()
+        size = len(body)
+        if request.getHeader('content-encoding') == 'gzip':
+            body = zlib.decompress(body, GZIP_WBITS)
+        self.counts.received(body.count('\n') + 1, size)
+        request.setResponseCode(202)
+        return ''
+
+
+def listen(kind, counts, options):
+    """ Start the stand in input for a protocol, returning its host and port
+    """
+    if kind == 'udp':
+        port = reactor.listenUDP(0, UDPInput(counts), interface='127.0.0.1')
+        # a large receive buffer so that datagrams are not lost while the
+        # reactor is busy emitting
+        port.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 24)
+        return '127.0.0.1', port.getHost().port
+    elif kind in ('tcp', 'relay'):
+        factory = protocol.Factory()
+        factory.protocol = TCPInput
+        factory.counts = counts
+        port = reactor.listenTCP(0, factory, interface='127.0.0.1')
+        host, number = '127.0.0.1', port.getHost().port
+        if kind == 'relay':
+            path = os.path.join(tempfile.mkdtemp(), 'relay.sock')
+            # only the relay's listener is started, so that it does not send
+            # its own log messages
+            service = GraylogRelayService(
+                tcp.TCPGelfProtocol, host, number, path, coalesce=True)
+            reactor.listenUNIX(path, service.relay)
+            return path, None
+        return host, number
+    elif kind == 'http':
+        site = server.Site(HTTPInput(counts))
+        port = reactor.listenTCP(0, site, interface='127.0.0.1')
+        return '127.0.0.1', port.getHost().port
+    elif kind == 'amqp':
+        # there is no stand in for a broker, so a real one has to be given
+        host, port = options.broker.split(':')
+        return host, int(port)
+    raise ValueError(kind)
+
+
+def connected(sender):
+    senders = getattr(sender, 'protocols', [sender])
+    return all(getattr(s, 'connected', True) for s in senders)
+
+
+@defer.inlineCallbacks
+def until(condition, interval=0.01):
+    while not condition():
+        yield task.deferLater(reactor, interval, lambda: None)
+
+
+@defer.inlineCallbacks
+def measure(name, options):
+    """ Send the events through one protocol and print the results
+    """
+    _, protocol_class, kind, kwargs = [p for p in PROTOCOLS if p[0] == name][0]
+    counts = Input()
+    host, port = listen(kind, counts, options)
+
+    kwargs = dict(kwargs)
+    if kind != 'udp':
+        # every event may be queued at once, so the buffer has to hold them
+        kwargs['buffer'] = MessageBuffer(max_count=None)
+    observer = GraylogObserver(protocol_class, host, port, **kwargs)
+    yield until(lambda: connected(observer.protocol))
+
+    if kind == 'amqp':
+        # a message has arrived once the broker confirms it
+        sender = observer.protocol
+        poll = task.LoopingCall(lambda: counts.received(
+            sender.messages_sent - counts.messages,
+            sender.bytes_sent - counts.bytes))
+        poll.start(0.01)
+
+    stream = EventStream(
+        options.size, parse_levels(options.levels), options.failures)
+    start = time.time()
+    in_reactor = building = 0.0
+    for offset in xrange(0, options.events, SLICE):
+        # the events are built a slice at a time so that they do not count
+        # towards the memory high-water mark, and the time taken is left out
+        began = time.time()
+        events = [
+            stream.event(i)
+            for i in xrange(offset, min(offset + SLICE, options.events))]
+        building += time.time() - began
+        began = time.time()
+        for event in events:
+            observer.emit(event)
+        in_reactor += time.time() - began
+        yield task.deferLater(reactor, 0, lambda: None)
+
+    yield until(lambda: (
+        counts.messages >= options.events or
+        time.time() - counts.last > IDLE))
+    elapsed = counts.last - start - building
+
+    print json.dumps({
+        'protocol': name,
+        'events': options.events,
+        'received': counts.messages,
+        'seconds': elapsed,
+        'events_per_second': counts.messages / max(elapsed, 1e-9),
+        'reactor_us_per_event': in_reactor / options.events * 1e6,
+        'wire_bytes': counts.bytes,
+        'bytes_per_event': counts.bytes / float(max(counts.messages, 1)),
+        'chunks': counts.chunks,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    })
+    reactor.stop()
+
+
+def run(name, options):
+    """ Run one protocol in a process of its own
+    """
+    args = [
+        sys.executable, os.path.abspath(__file__), '--run', name,
+        '--events', str(options.events), '--size', str(options.size),
+        '--levels', options.levels, '--failures', str(options.failures),
+        '--broker', options.broker or '']
+    output = subprocess.check_output(args)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def compare(results, baseline, tolerance):
+    """ Print how the results changed since the baseline, returning the
+        number of figures which got worse by more than the tolerance
+    """
+    regressions = 0
+    for name, result in sorted(results.iteritems()):
+        before = baseline.get(name)
+        if before is None:
+            continue
+        for metric, higher_is_better in COMPARED:
+            old, new = before[metric], result[metric]
+            if not old:
+                continue
+            change = (new - old) / float(old)
+            worse = -change if higher_is_better else change
+            flag = ''
+            if worse > tolerance:
+                flag = '  REGRESSION'
+                regressions += 1
+            print '%-12s %-22s %12.1f %12.1f %+7.1f%%%s' % (
+                name, metric, old, new, change * 100, flag)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--events', type=int, default=20000)
+    parser.add_argument('--size', type=int, default=256,
+                        help='the approximate size of each message')
+    parser.add_argument('--levels', default='info=80,warning=15,error=5',
+                        help='the mix of levels as name=weight pairs')
+    parser.add_argument('--failures', type=float, default=0.01,
+                        help='the share of events carrying a failure')
+    parser.add_argument('--protocols', default=None,
+                        help='comma separated protocols to run, from %s' % (
+                            ', '.join(p[0] for p in PROTOCOLS), ))
+    parser.add_argument('--name', default=None,
+                        help='the name to store the results under')
+    parser.add_argument('--compare', default=None,
+                        help='a results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    parser.add_argument('--broker', default=None,
+                        help='the host:port of an AMQP broker to publish to')
+    parser.add_argument('--run', default=None, help=argparse.SUPPRESS)
+    options = parser.parse_args()
+
+    if options.run:
+        log.startLogging(open(os.devnull, 'w'), setStdout=False)
+        reactor.callWhenRunning(measure, options.run, options)
+        reactor.run()
+        return
+
+    names = [p[0] for p in PROTOCOLS]
+    if options.protocols:
+        names = options.protocols.split(',')
+    elif amqp.pika is None or not options.broker:
+        names.remove('amqp-gelf')
+
+    directory = os.path.join(HERE, 'results')
+    path = os.path.join(directory, '%s.json' % (options.name or release(), ))
+    baseline = None
+    if options.compare:
+        # read the baseline before anything is written, as it may well be
+        # the file named after this release
+        with open(options.compare) as f:
+            baseline = json.load(f)
+        if options.name is None and (
+                os.path.realpath(path) == os.path.realpath(options.compare)):
+            path = None
+
+    results = {}
+    print '%-12s %10s %12s %12s %10s %8s %10s' % (
+        'protocol', 'received', 'events/s', 'us/event', 'bytes/ev',
+        'chunks', 'rss kB')
+    for name in names:
+        result = results[name] = run(name, options)
+        print '%-12s %10d %12.0f %12.1f %10.0f %8d %10d' % (
+            name, result['received'], result['events_per_second'],
+            result['reactor_us_per_event'], result['bytes_per_event'],
+            result['chunks'], result['max_rss_kb'])
+
+    settings = {
+        'events': options.events, 'size': options.size,
+        'levels': options.levels, 'failures': options.failures}
+    if path is None:
+        print 'results not written over the baseline, give --name to do so'
+    else:
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path, 'w') as f:
+            json.dump({
+                'settings': settings,
+                'python': sys.version.split()[0],
+                'results': results,
+            }, f, indent=2, sort_keys=True, separators=(',', ': '))
+        print 'results written to', path
+
+    if baseline is not None:
+        if baseline['settings'] != settings:
+            print 'warning: the baseline was run with', baseline['settings']
+        if compare(results, baseline['results'], options.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
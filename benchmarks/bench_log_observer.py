@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Micro-benchmark for :class:`~txgraylog.observer.GraylogLogObserver`.
+Compares the cost of a twisted.logger event going through the legacy
+observer, which converts and encodes every event, with the new style
+observer, which drops debug events before formatting them and maps the
+rest straight to GELF. Nothing is sent over the network
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from twisted.logger import LogLevel, LogPublisher, Logger  # noqa
+from twisted.logger import LegacyLogObserverWrapper  # noqa
+
+from txgraylog.observer import GraylogObserver, GraylogLogObserver  # noqa
+from txgraylog.protocol.udp import UDPGelfProtocol  # noqa
+
+ROUNDS = 20000
+
+
+class EncodeOnly(object):
+    """ Encodes messages without sending them
+    """
+
+    def __init__(self):
+        self.gelf = UDPGelfProtocol('127.0.0.1', 12201)
+
+    def log_message(self, event):
+        self.gelf.encode(event)
+
+
+def logger(observer):
+    publisher = LogPublisher()
+    publisher.addObserver(observer)
+    return Logger(namespace='app.web', observer=publisher)
+
+
+def run(log, level):
+    emit = getattr(log, level.name)
+    seconds = min(timeit.repeat(
+        lambda: emit('GET {path} {code} {size}', path='/api/v1/customers',
+                     code=200, size=512),
+        number=ROUNDS, repeat=3))
+    return seconds / ROUNDS * 1e6
+
+
+def main():
+    legacy = GraylogObserver(UDPGelfProtocol, '127.0.0.1', 12201)
+    legacy.protocol = EncodeOnly()
+    native = GraylogLogObserver(UDPGelfProtocol, '127.0.0.1', 12201)
+    native.protocol = EncodeOnly()
+
+    legacy_log = logger(LegacyLogObserverWrapper(legacy.emit))
+    native_log = logger(native)
+    for level in (LogLevel.debug, LogLevel.info):
+        before, after = run(legacy_log, level), run(native_log, level)
+        print '%-5s legacy observer:  %8.2f us/event' % (level.name, before)
+        print '%-5s log observer:     %8.2f us/event (%.1fx)' % (
+            level.name, after, before / after)
+
+
+if __name__ == '__main__':
+    main()
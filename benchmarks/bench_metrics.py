@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Micro-benchmark for :class:`~txgraylog.metrics.Metrics`. Measures what
+recording metrics adds to encoding an event with the UDP GELF protocol, and
+the cost of taking a snapshot
+"""
+
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from txgraylog.metrics import Metrics  # noqa
+from txgraylog.protocol.udp import UDPGelfProtocol  # noqa
+
+ROUNDS = 20000
+
+
+def make_event():
+    return {
+        'system': 'HTTPChannel,0,127.0.0.1',
+        'message': ['"GET /api/v1/customers/1234 HTTP/1.1" 200 512'],
+        'isError': False,
+        'time': time.time(),
+        'customer_id': 1234,
+    }
+
+
+def run(protocol):
+    event = make_event()
+    seconds = min(timeit.repeat(
+        lambda: protocol._encode(event), number=ROUNDS, repeat=3))
+    return seconds / ROUNDS * 1e6
+
+
+def main():
+    protocol = UDPGelfProtocol('127.0.0.1', 12201)
+    before = run(protocol)
+    protocol.metrics = metrics = Metrics()
+    metrics.protocols = [protocol]
+    after = run(protocol)
+    snapshot = min(timeit.repeat(
+        metrics.snapshot, number=ROUNDS, repeat=3)) / ROUNDS * 1e6
+
+    print 'without metrics:  %8.2f us/event' % (before, )
+    print 'with metrics:     %8.2f us/event (+%.2f us)' % (
+        after, after - before)
+    print 'snapshot:         %8.2f us' % (snapshot, )
+
+
+if __name__ == '__main__':
+    main()
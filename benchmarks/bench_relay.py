@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Benchmark for relay mode with :class:`~txgraylog.protocol.relay`. Starts a
+number of worker processes logging to a local stand in for a Graylog GELF
+TCP input, first each with its own connection and then through a relay
+process over a Unix socket. Reports the CPU each worker spends sending its
+events and the number of connections made to Graylog
+"""
+
+import os
+import resource
+import signal
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from twisted.internet import defer, protocol, reactor, task  # noqa
+
+from txgraylog.buffering import MessageBuffer  # noqa
+from txgraylog.observer import GraylogObserver  # noqa
+from txgraylog.protocol.relay import RelayGelfProtocol  # noqa
+from txgraylog.protocol.tcp import TCPGelfProtocol  # noqa
+from txgraylog.service import GraylogRelayService  # noqa
+
+WORKERS = 8
+EVENTS = 20000
+CONNECTIONS = 2
+
+
+def make_event(i):
+    return {
+        'system': 'bench',
+        'message': ['"GET /api/v1/customers/%d HTTP/1.1" 200 512' % (i, )],
+        'isError': False,
+        'time': time.time(),
+        'customer_id': i,
+    }
+
+
+def cpu():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+@defer.inlineCallbacks
+def until(condition, interval=0.001):
+    while not condition():
+        yield task.deferLater(reactor, interval, lambda: None)
+
+
+@defer.inlineCallbacks
+def worker(mode, target):
+    """ Log the events, directly to Graylog or through the relay, and print
+        the CPU time taken once they are all written
+    """
+    # every event is logged at once, so the buffer has to hold those logged
+    # while the transport is paused
+    if mode == 'direct':
+        observer = GraylogObserver(
+            TCPGelfProtocol, '127.0.0.1', int(target), coalesce=True,
+            buffer=MessageBuffer(max_count=None))
+    else:
+        observer = GraylogObserver(
+            RelayGelfProtocol, target, None,
+            buffer=MessageBuffer(max_count=None))
+    sender = observer.protocol
+    yield until(lambda: sender.connected)
+
+    start = cpu()
+    for i in xrange(EVENTS):
+        sender.log_message(make_event(i))
+    # poll slowly so that waiting costs next to nothing
+    yield until(
+        lambda: not len(sender.buffer) and not sender.pending_bytes(), 0.05)
+    print cpu() - start
+
+    reactor.stop()
+
+
+def relay(path, port):
+    """ Forward the workers' messages until we are told to stop, then print
+        the CPU time taken
+    """
+    service = GraylogRelayService(
+        TCPGelfProtocol, '127.0.0.1', int(port), path,
+        connections=CONNECTIONS, coalesce=True)
+    # the workers send faster than the stand in for Graylog reads, so each
+    # connection has to hold everything it is sent while it is paused
+    for sender in service.observer.protocol.protocols:
+        sender.buffer = MessageBuffer(max_count=None)
+    service.startService()
+
+    def stop(*args):
+        print cpu()
+        sys.stdout.flush()
+        reactor.stop()
+    signal.signal(signal.SIGTERM, stop)
+
+
+class GelfInput(protocol.Protocol):
+    """ Counts the benchmark's messages and the connections they arrive on
+    """
+
+    def connectionMade(self):
+        self.factory.connections += 1
+        # read more than twisted's default of 64KB at a time, so that the
+        # relay is not paused
+        self.transport.bufferSize = 1 << 20
+        self.data = ''
+
+    def dataReceived(self, data):
+        records = (self.data + data).split('\x00')
+        self.data = records.pop()
+        for record in records:
+            if '"facility":"bench"' in record:
+                self.factory.received += 1
+
+
+class Output(protocol.ProcessProtocol):
+    """ Collects the output of a process
+    """
+
+    def __init__(self):
+        self.output = ''
+        self.ended = defer.Deferred()
+
+    def outReceived(self, data):
+        self.output += data
+
+    def processEnded(self, reason):
+        self.ended.callback(self.output)
+
+
+def spawn(*args):
+    output = Output()
+    process = reactor.spawnProcess(
+        output, sys.executable,
+        [sys.executable, os.path.abspath(__file__)] + list(args),
+        env=os.environ)
+    return process, output
+
+
+@defer.inlineCallbacks
+def run(name, graylog, mode, target):
+    graylog.received = 0
+    start = time.time()
+    outputs = [spawn('worker', mode, target)[1] for _ in xrange(WORKERS)]
+    times = yield defer.gatherResults([o.ended for o in outputs])
+    yield until(lambda: graylog.received >= WORKERS * EVENTS)
+    elapsed = time.time() - start
+
+    times = [float(t) for t in times]
+    print '%-8s %8.0f ms cpu per worker %4d connections %8.0f events/s' % (
+        name, 1000 * sum(times) / len(times), graylog.connections,
+        WORKERS * EVENTS / elapsed)
+
+
+@defer.inlineCallbacks
+def main():
+    graylog = protocol.Factory()
+    graylog.protocol = GelfInput
+    port = reactor.listenTCP(0, graylog, interface='127.0.0.1').getHost().port
+
+    graylog.connections = 0
+    yield run('direct', graylog, 'direct', str(port))
+
+    graylog.connections = 0
+    path = os.path.join(tempfile.mkdtemp(), 'relay.sock')
+    process, output = spawn('relay', path, str(port))
+    yield until(lambda: os.path.exists(path))
+    yield run('relay', graylog, 'relay', path)
+    process.signalProcess('TERM')
+    relay_time = yield output.ended
+    print '%-8s %8.0f ms cpu in the relay' % ('', 1000 * float(relay_time))
+
+    reactor.stop()
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['worker']:
+        reactor.callWhenRunning(worker, *sys.argv[2:])
+    elif sys.argv[1:2] == ['relay']:
+        reactor.callWhenRunning(relay, *sys.argv[2:])
+    else:
+        reactor.callWhenRunning(main)
+    reactor.run()
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Benchmark for coalescing the datagrams of
+:class:`~txgraylog.protocol.udp.UDPGelfProtocol` and sending them with
+sendmmsg, against writing each datagram to the transport. Events are logged
+in slices of a reactor iteration each to a local UDP sink, and for each way
+this reports:
+
+    - events and datagrams per second, until the sink has them all
+    - the number of send system calls made for every datagram
+    - the process time spent sending each datagram
+
+The sink runs in the same reactor, so receiving costs the same both ways.
+"""
+
+import argparse
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from twisted.internet import defer, protocol, reactor, task  # noqa
+
+from txgraylog.protocol import mmsg  # noqa
+from txgraylog.protocol.udp import UDPGelfProtocol  # noqa
+
+
+class Sink(protocol.DatagramProtocol):
+
+    def __init__(self):
+        self.datagrams = 0
+
+    def datagramReceived(self, data, address):
+        self.datagrams += 1
+
+
+class Counting(object):
+    """ Wraps a function, counting its calls and the time spent in them
+    """
+
+    def __init__(self, func):
+        self.func = func
+        self.calls = 0
+        self.seconds = 0.0
+
+    def __call__(self, *args, **kwargs):
+        self.calls += 1
+        start = time.clock()
+        try:
+            return self.func(*args, **kwargs)
+        finally:
+            self.seconds += time.clock() - start
+
+
+def make_event(size, i):
+    return {
+        'system': 'HTTPChannel,0,127.0.0.1',
+        'message': ['request %d %s' % (i, 'x' * size)],
+        'isError': False,
+        'time': time.time(),
+    }
+
+
+@defer.inlineCallbacks
+def measure(coalesce, events, size, per_slice):
+    sink = Sink()
+    port = reactor.listenUDP(0, sink, interface='127.0.0.1')
+    port.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 24)
+    # read everything waiting in each iteration rather than twisted's
+    # default of 256KB, so that the sink keeps up with whole slices
+    port.maxThroughput = 1 << 30
+
+    sender = UDPGelfProtocol(
+        '127.0.0.1', port.getHost().port, compression=False,
+        coalesce=coalesce)
+    sending = reactor.listenUDP(0, sender, interface='127.0.0.1')
+    while not sender.connected:
+        yield task.deferLater(reactor, 0.01, lambda: None)
+
+    # every send system call goes through one of these
+    write = sending.write = Counting(sending.write)
+    batch = None
+    if sender.sender is not None:
+        batch = sender.sender.send = Counting(sender.sender.send)
+
+    event = make_event(size, 0)
+    expected = len(sender.encode(dict(event))) * events
+    start = time.time()
+    for i in xrange(0, events, per_slice):
+        for j in xrange(i, min(i + per_slice, events)):
+            sender.log_message(make_event(size, j))
+        yield task.deferLater(reactor, 0, lambda: None)
+
+    idle = time.time()
+    received = 0
+    while sink.datagrams < expected and time.time() - idle < 1.0:
+        if sink.datagrams != received:
+            received, idle = sink.datagrams, time.time()
+        yield task.deferLater(reactor, 0.001, lambda: None)
+    elapsed = time.time() - start
+
+    calls = write.calls + (batch.calls if batch else 0)
+    seconds = write.seconds + (batch.seconds if batch else 0)
+    yield sending.stopListening()
+    yield port.stopListening()
+    defer.returnValue({
+        'events_per_second': events / elapsed,
+        'datagrams_per_second': sink.datagrams / elapsed,
+        'received': sink.datagrams,
+        'expected': expected,
+        'calls_per_datagram': calls / float(expected),
+        'send_us_per_datagram': seconds / expected * 1e6,
+    })
+
+
+@defer.inlineCallbacks
+def main(options):
+    if not mmsg.available:
+        print 'sendmmsg is not available here'
+        return
+
+    print '%6s %-9s %10s %10s %10s %10s %12s' % (
+        'size', 'sender', 'events/s', 'dgrams/s', 'received', 'calls/dgram',
+        'send us/dgram')
+    for size in options.sizes:
+        for name, coalesce in (('write', False), ('sendmmsg', True)):
+            result = yield measure(
+                coalesce, options.events, size, options.slice)
+            print '%6d %-9s %10.0f %10.0f %4d/%-5d %10.3f %12.2f' % (
+                size, name, result['events_per_second'],
+                result['datagrams_per_second'], result['received'],
+                result['expected'], result['calls_per_datagram'],
+                result['send_us_per_datagram'])
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--events', type=int, default=5000)
+    parser.add_argument('--slice', type=int, default=64,
+                        help='events logged in each reactor iteration')
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[256, 1024, 8192])
+    options = parser.parse_args()
+
+    d = main(options)
+    d.addErrback(lambda f: f.printTraceback())
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+if __name__ == '__main__':
+    run()
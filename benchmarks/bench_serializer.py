@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Micro-benchmark for the JSON backends in
+:mod:`~txgraylog.protocol.serializer`. Serializes typical GELF messages with
+every installed backend, and with jsonlib if it is installed as that is what
+txGraylog used to depend on. The backend chosen at import time is marked
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from txgraylog.protocol import serializer  # noqa
+
+ROUNDS = 20000
+MESSAGES = {
+    'access log': {
+        'version': '', 'host': 'web-01', 'level': 6,
+        'short_message': '"GET /api/v1/customers/1234 HTTP/1.1" 200 512',
+        'full_message': '"GET /api/v1/customers/1234 HTTP/1.1" 200 512',
+        'timestamp': 1434567890.123, 'facility': 'HTTPChannel,0,127.0.0.1',
+        '_customer_id': 1234, '_application': 'billing-api',
+        '_request_id': 'c0ffee00-dead-beef-cafe-000000000000',
+    },
+    'traceback': {
+        'version': '', 'host': 'web-01', 'level': 3,
+        'short_message': 'integer division or modulo by zero',
+        'full_message': 'Traceback (most recent call last):\n' + ''.join(
+            '  File "/srv/app/module%d.py", line %d, in handler\n'
+            '    result = compute(request)\n' % (i, i * 7)
+            for i in xrange(30)),
+        'timestamp': 1434567890.123, 'facility': 'HTTPChannel,0,127.0.0.1',
+        '_application': 'billing-api',
+    },
+}
+
+
+def backends():
+    found = [(name, serializer.get_backend(name))
+             for name in serializer.available()]
+    try:
+        import jsonlib
+    except ImportError:
+        pass
+    else:
+        found.append(('jsonlib', jsonlib.write))
+    return found
+
+
+def main():
+    for label, message in sorted(MESSAGES.iteritems()):
+        print '%s (%d bytes):' % (label, len(serializer.dumps(message)))
+        for name, dumps in backends():
+            seconds = min(timeit.repeat(
+                lambda: dumps(message), number=ROUNDS, repeat=3))
+            print '    %-12s %8.2f us/message%s' % (
+                name, seconds / ROUNDS * 1e6,
+                ' (chosen)' if name == serializer.backend else '')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Throughput benchmark for TCP write coalescing. Sends GELF messages through
+:class:`~txgraylog.protocol.tcp.TCPGelfProtocol` to a local TCP sink, with
+and without coalescing, and reports the messages per second delivered.
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from twisted.internet import defer, reactor, task  # noqa
+from twisted.internet.protocol import Factory, Protocol  # noqa
+
+from txgraylog.protocol.tcp import TCPGelfProtocol, TCPGraylogFactory  # noqa
+
+MESSAGES = 100000
+PER_TICK = 500
+
+
+class Sink(Protocol):
+    """ Count the null terminated frames we receive
+    """
+
+    def connectionMade(self):
+        # read more than twisted's default of 64KB at a time, so that the
+        # sink keeps up and the sender is not paused
+        self.transport.bufferSize = 1 << 20
+
+    def dataReceived(self, data):
+        self.factory.received += data.count('\x00')
+        if self.factory.received >= MESSAGES and not self.factory.done.called:
+            self.factory.done.callback(None)
+
+
+class SinkFactory(Factory):
+
+    protocol = Sink
+
+    def __init__(self):
+        self.received = 0
+        self.done = defer.Deferred()
+
+
+def make_event(i):
+    return {
+        'system': 'bench',
+        'message': ['message number %d' % (i, )],
+        'isError': False,
+        'time': time.time(),
+    }
+
+
+@defer.inlineCallbacks
+def measure(**kwargs):
+    sink = SinkFactory()
+    listener = reactor.listenTCP(0, sink, interface='127.0.0.1')
+
+    protocol = TCPGelfProtocol(
+        '127.0.0.1', listener.getHost().port, **kwargs)
+    factory = TCPGraylogFactory(protocol)
+    connector = reactor.connectTCP('127.0.0.1', protocol.port, factory)
+    while not protocol.connected:
+        yield task.deferLater(reactor, 0.01, lambda: None)
+
+    start = time.time()
+    for i in xrange(0, MESSAGES, PER_TICK):
+        for j in xrange(i, i + PER_TICK):
+            protocol.log_message(make_event(j))
+        yield task.deferLater(reactor, 0, lambda: None)
+    yield sink.done
+    elapsed = time.time() - start
+
+    factory.stopTrying()
+    connector.disconnect()
+    yield listener.stopListening()
+    defer.returnValue(MESSAGES / elapsed)
+
+
+@defer.inlineCallbacks
+def main():
+    try:
+        plain = yield measure()
+        coalesced = yield measure(coalesce=True)
+        print 'per-message writes: %10.0f msg/s' % (plain, )
+        print 'coalesced writes:   %10.0f msg/s' % (coalesced, )
+    finally:
+        reactor.stop()
+
+
+if __name__ == '__main__':
+    reactor.callWhenRunning(main)
+    reactor.run()
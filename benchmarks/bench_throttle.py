@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Micro-benchmark for :class:`~txgraylog.throttle.Throttle`. Measures the
+cost the throttle adds to each event for each stage, both for a storm of
+identical events and for events which are all different
+"""
+
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from txgraylog.throttle import Throttle  # noqa
+
+ROUNDS = 50000
+STAGES = [
+    ('none', {}),
+    ('sample', {'sample': {6: 0.1}}),
+    ('dedupe', {'dedupe_window': 60}),
+    ('rate limit', {'rate': 100}),
+    ('all', {'sample': {7: 0.1}, 'dedupe_window': 60, 'rate': 100}),
+]
+
+
+def make_events(distinct):
+    return [{
+        'message': ('connection to db-%d refused' % (
+            i if distinct else 0, ), ),
+        'system': 'app.db',
+        'isError': False,
+        'time': time.time(),
+    } for i in xrange(ROUNDS)]
+
+
+def run(options, events):
+    def send(event):
+        pass
+
+    def filter_all():
+        throttle = Throttle(**options)
+        for event in events:
+            throttle.filter(event, send)
+        throttle.stop(send_merged=False)
+
+    seconds = min(timeit.repeat(filter_all, number=1, repeat=3))
+    return seconds / len(events) * 1e6
+
+
+def main():
+    storm, distinct = make_events(False), make_events(True)
+    print '%-12s %12s %12s' % ('stage', 'storm', 'distinct')
+    for name, options in STAGES:
+        print '%-12s %9.2f us %9.2f us' % (
+            name, run(options, storm), run(options, distinct))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Benchmark for :class:`~txgraylog.protocol.tracebacks.TracebackCache`.
+Builds the GELF message for storms of error events, each carrying a failure
+raised at one of a number of sites and at some depth, with the tracebacks
+formatted every time and with them reused from the cache. A storm of more
+sites than the cache holds shows the cost of missing it.
+"""
+
+import os
+import sys
+import time
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+
+from twisted.python.failure import Failure  # noqa
+
+from txgraylog.protocol import gelf, limits, tracebacks  # noqa
+
+ROUNDS = 2000
+# the number of sites failures are raised at, and the depth of the stack
+STORMS = [(1, 5), (1, 30), (10, 5), (100, 5), (1000, 5)]
+
+
+def make_sites(count):
+    """ Make functions which each raise from a line of their own, so that
+        the failures of each have a different fingerprint
+    """
+    namespace = {}
+    source = ''.join(
+        'def site_%d(depth):\n'
+        '    if depth:\n'
+        '        return site_%d(depth - 1)\n'
+        '    raise ValueError("customer %%d not found" %% depth)\n' % (i, i)
+        for i in xrange(count))
+    exec compile(source, 'sites.py', 'exec') in namespace
+    return [namespace['site_%d' % (i, )] for i in xrange(count)]
+
+
+def make_events(sites, depth):
+    events = []
+    for i in xrange(ROUNDS):
+        try:
+            sites[i % len(sites)](depth)
+        except ValueError:
+            failure = Failure()
+        events.append({
+            'system': 'HTTPChannel,0,127.0.0.1',
+            'message': [],
+            'isError': True,
+            'failure': failure,
+            'time': time.time(),
+        })
+    return events
+
+
+def run(builder, events):
+    def build():
+        for event in events:
+            builder.build(event)
+    seconds = min(timeit.repeat(build, number=1, repeat=3))
+    return seconds / len(events) * 1e6
+
+
+def main():
+    print '%6s %6s %12s %12s %8s %8s' % (
+        'sites', 'depth', 'uncached us', 'cached us', 'speedup', 'hits')
+    for count, depth in STORMS:
+        events = make_events(make_sites(count), depth)
+
+        uncached = gelf.GelfBuilder(gelf.GelfTemplate(
+            'localhost', limits=limits.SizeLimits(tracebacks=None)))
+        cache = tracebacks.TracebackCache()
+        cached = gelf.GelfBuilder(gelf.GelfTemplate(
+            'localhost', limits=limits.SizeLimits(tracebacks=cache)))
+
+        before, after = run(uncached, events), run(cached, events)
+        print '%6d %6d %12.2f %12.2f %7.2fx %7.1f%%' % (
+            count, depth, before, after, before / after,
+            100.0 * cache.hits / (cache.hits + cache.misses))
+
+
+if __name__ == '__main__':
+    main()
@@ -22,13 +22,16 @@ setup(
     url='https://github.com/dr4ke616/txGraylog/',
     package_dir={"": "src"},
     packages=find_packages(where="src"),
-    tests_require=['twisted>=10.2.0', 'coverage', 'jsonlib'],
-    install_requires=['twisted>=10.2.0', 'jsonlib'],
-    requires=['twisted(>=10.2.0)'],
+    tests_require=['twisted>=15.2.0', 'coverage'],
+    install_requires=['twisted>=15.2.0'],
+    requires=['twisted(>=15.2.0)'],
     extras_require={
         "dev": [
             "coverage",
         ],
+        "amqp": [
+            "pika>=1.0",
+        ],
     },
     zip_safe=False,
     classifiers=[
@@ -0,0 +1,244 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+.. module:: buffering
+    :platform: Unix, Windows
+    :synopsis: Bounded buffer for messages which could not be sent while the
+        connection to Graylog was down
+.. moduleauthor:: Adam Drakeford <adamdrakeford@gmail.com>
+"""
+
+import heapq
+from collections import deque
+
+from twisted.internet import reactor
+
+DROP_OLDEST, DROP_NEWEST, DROP_LEVEL = 0, 1, 2
+INFO = 6
+
+
+def message_size(message):
+    """ The size in bytes of a message, which may be a tuple of the
+        datagrams of a chunked message
+    """
+    if isinstance(message, tuple):
+        return sum([len(datagram) for datagram in message])
+    return len(message)
+
+
+class MessageBuffer(object):
+    """ Holds encoded messages until they can be sent. The buffer is capped
+        both by the number of messages and by their total size in bytes.
+        Once either cap is reached messages are dropped according to the
+        overflow policy:
+            DROP_OLDEST drops the oldest message
+            DROP_NEWEST drops the incoming message
+            DROP_LEVEL drops the oldest of the least severe messages, so
+                debug messages go before errors
+        Messages are replayed in the order they were buffered. A message
+        may be a tuple of the datagrams of a chunked message, which is kept,
+        dropped and replayed whole. When given a
+        :class:`~txgraylog.spill.SpillQueue` the buffer writes messages to
+        disk instead of dropping them once it is full
+    """
+
+    def __init__(
+            self, max_count=1000, max_bytes=None, policy=DROP_OLDEST,
+            replay_batch=100, replay_interval=0, spill=None):
+        """ Initialise the buffer
+            :param max_count: the maximum number of messages to hold, or
+                None for no limit
+            :param max_bytes: the maximum total size of the messages to
+                hold, or None for no limit
+            :param policy: the overflow policy
+            :param replay_batch: the number of messages sent in each reactor
+                iteration while replaying
+            :param replay_interval: the number of seconds to wait between
+                replaying each batch
+            :param spill: an optional spill queue for messages which do not
+                fit in memory
+        """
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.replay_batch = replay_batch
+        self.replay_interval = replay_interval
+        self.spill = spill
+        self.clock = reactor
+
+        self.count = 0
+        self.size = 0
+
+        self.buffered = 0
+        self.dropped = 0
+        self.replayed = 0
+
+        # a queue of (sequence, message) for each level, so that we can drop
+        # by level while still replaying in the order messages came in
+        self._queues = {}
+        self._head = self._tail = 0
+        self._replay_call = None
+        self._replay_send = None
+
+    def __len__(self):
+        if self.spill is not None:
+            return self.count + len(self.spill)
+        return self.count
+
+    def __iter__(self):
+        """ Iterate over the buffered messages, oldest first
+        """
+        for _, message in heapq.merge(*self._queues.values()):
+            yield message
+
+        if self.spill is not None:
+            for message in self.spill:
+                yield message
+
+    @property
+    def replaying(self):
+        """ Whether a replay is still in progress
+        """
+        return self._replay_send is not None
+
+    def append(self, message, level=INFO):
+        """ Buffer a message, dropping messages if the buffer is full
+        """
+        if self.spill is not None and (
+                len(self.spill) or not self._fits(message_size(message))):
+            # once anything is on disk everything else has to follow it
+            # there to keep the messages in order
+            if self.spill.append(message, level):
+                self.buffered += 1
+            else:
+                self.dropped += 1
+            return
+
+        if (self.policy == DROP_NEWEST and
+                not self._fits(message_size(message))):
+            self.dropped += 1
+            return
+
+        self._queue(level).append((self._tail, message))
+        self._tail += 1
+        self._added(message)
+
+    def restore(self, entries):
+        """ Put `(message, level)` entries which were taken from the buffer
+            but never sent back in front of the buffered messages
+        """
+        for message, level in reversed(entries):
+            self._head -= 1
+            self._queue(level).appendleft((self._head, message))
+            self._added(message)
+
+    def popleft(self):
+        """ Remove and return the oldest message and its level
+        """
+        if not self._queues:
+            if self.spill is not None and len(self.spill):
+                return self.spill.popleft()
+            raise IndexError('pop from an empty buffer')
+        level = min(self._queues, key=lambda l: self._queues[l][0][0])
+        return self._pop(level, deque.popleft), level
+
+    def replay(self, send):
+        """ Send the buffered messages in order by calling `send` with each
+            message and its level. Messages are sent `replay_batch` at a time
+            to avoid flooding the connection
+        """
+        if self._replay_send is None:
+            self._replay_send = send
+            self._replay()
+
+    def stop_replay(self):
+        """ Stop any replay in progress, keeping the messages not yet sent.
+            This may be called from `send` itself, in which case no more
+            messages of the batch are sent
+        """
+        if self._replay_call is not None and self._replay_call.active():
+            self._replay_call.cancel()
+        self._replay_call = None
+        self._replay_send = None
+
+    def _replay(self):
+        """ Send the next batch of messages
+        """
+        self._replay_call = None
+
+        for _ in xrange(self.replay_batch):
+            send = self._replay_send
+            if send is None:
+                return
+            if not len(self):
+                self._replay_send = None
+                return
+            message, level = self.popleft()
+            self.replayed += 1
+            send(message, level)
+
+        if self._replay_send is None:
+            return
+        if len(self):
+            self._replay_call = self.clock.callLater(
+                self.replay_interval, self._replay)
+        else:
+            self._replay_send = None
+
+    def _queue(self, level):
+        """ Get the queue of messages for a level
+        """
+        try:
+            return self._queues[level]
+        except KeyError:
+            queue = self._queues[level] = deque()
+            return queue
+
+    def _fits(self, size):
+        """ Whether a message of the given size fits without dropping
+        """
+        if self.max_count is not None and self.count >= self.max_count:
+            return False
+        if self.max_bytes is not None and self.size + size > self.max_bytes:
+            return False
+        return True
+
+    def _added(self, message):
+        """ Account for a new message and drop others if we are now over
+            either of our limits
+        """
+        self.count += 1
+        self.size += message_size(message)
+        self.buffered += 1
+
+        while self.count and (
+                (self.max_count is not None and
+                    self.count > self.max_count) or
+                (self.max_bytes is not None and self.size > self.max_bytes)):
+            self._drop()
+
+    def _drop(self):
+        """ Drop a single message according to the overflow policy
+        """
+        if self.policy == DROP_LEVEL:
+            self._pop(max(self._queues), deque.popleft)
+        elif self.policy == DROP_NEWEST:
+            level = max(self._queues, key=lambda l: self._queues[l][-1][0])
+            self._pop(level, deque.pop)
+        else:
+            level = min(self._queues, key=lambda l: self._queues[l][0][0])
+            self._pop(level, deque.popleft)
+        self.dropped += 1
+
+    def _pop(self, level, pop):
+        """ Take a message off the queue for a level
+        """
+        queue = self._queues[level]
+        _, message = pop(queue)
+        if not queue:
+            del self._queues[level]
+
+        self.count -= 1
+        self.size -= message_size(message)
+        return message
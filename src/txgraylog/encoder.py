@@ -0,0 +1,112 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+.. module:: encoder
+    :platform: Unix, Windows
+    :synopsis: A pool of threads which encode log events away from the
+        reactor thread
+.. moduleauthor:: Adam Drakeford <adamdrakeford@gmail.com>
+"""
+
+import time
+
+from twisted.internet import reactor
+from twisted.python.threadpool import ThreadPool
+
+from txgraylog.protocol.gelf import event_level
+
+OVERFLOW_DROP, OVERFLOW_INLINE = 0, 1
+
+
+class EncoderPool(object):
+    """ Hands log events to a bounded pool of threads which build the
+        messages for a protocol. The finished messages are passed back to
+        the reactor thread to be sent. Messages from different threads may
+        be sent in a slightly different order to the one they were logged in
+    """
+
+    def __init__(
+            self, protocol, size=2, max_pending=10000,
+            overflow=OVERFLOW_DROP):
+        """ Initialise the encoder pool
+            :param protocol: the protocol whose `encode` method is called in
+                the pool and whose `send_messages` method, or else
+                `send_to_graylog` for each message, is called with the
+                results
+            :param size: the number of encoding threads
+            :param max_pending: the number of events which may be waiting in
+                the pool before it is considered full
+            :param overflow: what to do with an event when the pool is full.
+                OVERFLOW_DROP discards it, while OVERFLOW_INLINE encodes it
+                on the reactor thread
+        """
+        self.protocol = protocol
+        self.max_pending = max_pending
+        self.overflow = overflow
+        self.threadpool = ThreadPool(size, size, name='txgraylog-encoder')
+
+        self.pending = 0
+        self.dropped = 0
+        self.inlined = 0
+        self.errors = 0
+        self.metrics = None
+
+    def start(self):
+        """ Start the encoding threads
+        """
+        self.threadpool.start()
+
+    def stop(self):
+        """ Stop the encoding threads once any queued events are encoded
+        """
+        self.threadpool.stop()
+
+    def submit(self, event):
+        """ Queue an event to be encoded. This must be called from the
+            reactor thread
+        """
+        if self.pending >= self.max_pending:
+            if self.overflow == OVERFLOW_INLINE:
+                self.inlined += 1
+                self.protocol.log_message(event)
+            else:
+                self.dropped += 1
+            return
+
+        self.pending += 1
+        self.threadpool.callInThread(self._encode, event)
+
+    def _encode(self, event):
+        """ Encode an event in a pool thread
+        """
+        start = time.time()
+        try:
+            messages = self.protocol.encode(event)
+        except Exception:
+            # logging this would only feed it back into the observer
+            messages = None
+        reactor.callFromThread(
+            self._deliver, messages, event_level(event), time.time() - start)
+
+    def _deliver(self, messages, level, seconds=0):
+        """ Send the encoded messages from the reactor thread, where the
+            metrics are recorded so that they need no locks
+        """
+        self.pending -= 1
+
+        if messages is None:
+            self.errors += 1
+            return
+
+        if self.metrics is not None:
+            self.metrics.encoded(seconds, [len(m) for m in messages])
+
+        send_messages = getattr(self.protocol, 'send_messages', None)
+        if send_messages is not None:
+            # the chunks of a message must be paced as one
+            send_messages(messages, level)
+            return
+
+        for message in messages:
+            self.protocol.send_to_graylog(message, level)
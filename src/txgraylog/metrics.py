@@ -0,0 +1,173 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+.. module:: metrics
+    :platform: Unix, Windows
+    :synopsis: Counters and histograms describing what txGraylog is doing
+.. moduleauthor:: Adam Drakeford <adamdrakeford@gmail.com>
+"""
+
+import time
+from bisect import bisect_left
+
+from txgraylog.protocol.tracebacks import DEFAULT_TRACEBACKS
+
+# upper bounds of the histogram buckets, in seconds and in bytes
+ENCODE_TIME_BOUNDS = (
+    0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.005, 0.01,
+    0.1)
+PAYLOAD_SIZE_BOUNDS = (
+    128, 256, 512, 1024, 1420, 4096, 8154, 65536, 1024 * 1024)
+
+
+class Histogram(object):
+    """ Counts observations in buckets with fixed upper bounds, plus one for
+        anything larger
+    """
+
+    def __init__(self, bounds):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, percent):
+        """ The upper bound of the bucket holding the given percentile, or
+            the largest value seen when that is in the last bucket
+        """
+        if not self.count:
+            return 0
+        rank = self.count * percent / 100.0
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'mean': self.sum / float(self.count) if self.count else 0,
+            'p50': self.percentile(50),
+            'p99': self.percentile(99),
+            'buckets': zip(self.bounds + (None, ), self.counts),
+        }
+
+
+class Metrics(object):
+    """ What the shipping pipeline has done since it started. The observer
+        counts the events it is given and the protocols record each event
+        they encode. Everything else, such as the messages buffered and
+        dropped or the number of reconnects, is read from the components
+        which already count it when a snapshot is taken.
+
+        The counters are plain attributes without locks, as they are only
+        updated on the reactor thread. Events logged from other threads
+        with the legacy logging system are counted in those threads, and
+        may very rarely be missed
+    """
+
+    def __init__(self):
+        self.timer = time.time
+
+        self.events = 0
+        self.messages = 0
+        self.bytes_encoded = 0
+        self.chunks = 0
+        self.encode_time = Histogram(ENCODE_TIME_BOUNDS)
+        self.payload_size = Histogram(PAYLOAD_SIZE_BOUNDS)
+
+        # the components we read counters from
+        self.protocols = []
+        self.factories = []
+        self.encoder = None
+        self.throttle = None
+        self.tracebacks = DEFAULT_TRACEBACKS
+
+    def encoded(self, seconds, sizes):
+        """ Record an event encoded into messages of the given sizes. More
+            than one message means the event was split into chunks
+        """
+        size = sum(sizes)
+        self.messages += len(sizes)
+        self.bytes_encoded += size
+        if len(sizes) > 1:
+            self.chunks += len(sizes)
+        self.encode_time.observe(seconds)
+        self.payload_size.observe(size)
+
+    def snapshot(self):
+        """ Get all of the counters and histograms as a `dict`
+        """
+        protocols = self.protocols
+        buffers = [p.buffer for p in protocols]
+        encoder = self.encoder
+        throttle = self.throttle
+        tracebacks = self.tracebacks
+
+        return {
+            'events': self.events,
+            'messages': self.messages,
+            'bytes_encoded': self.bytes_encoded,
+            'chunks': self.chunks,
+            'messages_sent': sum(
+                getattr(p, 'messages_sent', 0) for p in protocols),
+            'bytes_sent': sum(getattr(p, 'bytes_sent', 0) for p in protocols),
+            'buffered': sum(len(b) for b in buffers),
+            'buffered_total': sum(b.buffered for b in buffers),
+            'buffer_dropped': sum(b.dropped for b in buffers),
+            'replayed': sum(b.replayed for b in buffers),
+            'connects': sum(getattr(p, 'connects', 0) for p in protocols),
+            'disconnects': sum(
+                getattr(p, 'disconnects', 0) for p in protocols),
+            'reconnects': sum(f.reconnects for f in self.factories),
+            'readdressed': sum(
+                getattr(p, 'readdressed', 0) for p in protocols),
+            'refused': sum(getattr(p, 'refused', 0) for p in protocols),
+            'send_dropped': sum(
+                getattr(p, 'send_dropped', 0) for p in protocols),
+            'pauses': sum(getattr(p, 'pauses', 0) for p in protocols),
+            'paused_seconds': sum(
+                p.paused_seconds() for p in protocols
+                if hasattr(p, 'paused_seconds')),
+            'encoder_pending': encoder.pending if encoder else 0,
+            'encoder_dropped': encoder.dropped if encoder else 0,
+            'encoder_errors': encoder.errors if encoder else 0,
+            'throttle_dropped': throttle.dropped if throttle else 0,
+            'throttle_merged': throttle.merged if throttle else 0,
+            'traceback_hits': tracebacks.hits if tracebacks else 0,
+            'traceback_misses': tracebacks.misses if tracebacks else 0,
+            'traceback_evicted': tracebacks.evicted if tracebacks else 0,
+            'encode_time': self.encode_time.snapshot(),
+            'payload_size': self.payload_size.snapshot(),
+        }
+
+    def report(self):
+        """ Build an event dictionary reporting the metrics, with the
+            histograms summarised, to be sent to Graylog like any other
+        """
+        event = {
+            'message': ('txGraylog metrics', ),
+            'system': 'txgraylog.metrics',
+            'isError': False,
+            'time': time.time(),
+        }
+        for name, value in self.snapshot().iteritems():
+            if isinstance(value, dict):
+                for stat in ('count', 'mean', 'max', 'p50', 'p99'):
+                    event['%s_%s' % (name, stat)] = value[stat]
+            else:
+                event[name] = value
+        return event
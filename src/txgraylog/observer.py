@@ -7,39 +7,280 @@
     :synopsis: The observer for which our protocols to use
 .. moduleauthor:: Adam Drakeford <adamdrakeford@gmail.com>
 """
+from zope.interface import implementer
+
 from twisted.python import log
-from twisted.internet import reactor
+from twisted.internet import reactor, task
 from twisted.internet.protocol import DatagramProtocol, Protocol
+from twisted.logger import (
+    ILogObserver, LogLevel, PredicateResult, formatEvent, globalLogPublisher
+)
 
-from txgraylog.protocol.tcp import TCPGraylogFactory
+from txgraylog.encoder import EncoderPool, OVERFLOW_DROP
+from txgraylog.metrics import Metrics
+from txgraylog.protocol.amqp import AMQPGelfProtocol, AMQPGraylogFactory
+from txgraylog.protocol.http import HTTPGelfProtocol
+from txgraylog.protocol.relay import RelayGelfProtocol, RelayClientFactory
+from txgraylog.protocol.tcp import (
+    TCPConnectionPool, TCPGraylogFactory, ROUND_ROBIN
+)
 
 
 class GraylogObserver:
     """ Graylog observer
     """
 
-    def __init__(self, protocol, host, port):
-        self.protocol = protocol(host, port)
+    def __init__(
+            self, protocol, host, port, workers=0, max_pending=10000,
+            overflow=OVERFLOW_DROP, connections=1, endpoints=(),
+            balance=ROUND_ROBIN, throttle=None, report_interval=None,
+            **kwargs):
+        """ Create the protocol and connect it to Graylog
+            :param workers: the number of threads used to encode events off
+                the reactor thread. By default events are encoded as they
+                are emitted
+            :param max_pending: the number of events which may be waiting
+                to be encoded by the workers
+            :param overflow: the policy for events emitted while the workers
+                are full, see :class:`~txgraylog.encoder.EncoderPool`
+            :param connections: the number of TCP connections to keep open
+            :param endpoints: a list of further `(host, port)` tuples to
+                share the TCP connections with
+            :param balance: how messages are shared between TCP connections,
+                see :class:`~txgraylog.protocol.tcp.TCPConnectionPool`
+            :param throttle: an optional :class:`~txgraylog.throttle.Throttle`
+                to sample, merge and rate limit events before they are sent
+            :param report_interval: the number of seconds between reports of
+                our own metrics sent to Graylog, or None to not send them
+            :param kwargs: extra options passed through to the protocol
+        """
+        if issubclass(protocol, Protocol) and (connections > 1 or endpoints):
+            self.protocol = TCPConnectionPool(
+                protocol, [(host, port)] + list(endpoints), connections,
+                balance, **kwargs)
+        else:
+            self.protocol = protocol(host, port, **kwargs)
+
+        self.throttle = throttle
+        self.encoder = None
+        if workers:
+            self.encoder = EncoderPool(
+                self.protocol, workers, max_pending, overflow)
 
-        if issubclass(self.protocol.__class__, DatagramProtocol):
+        self.metrics = Metrics()
+        self.metrics.encoder = self.encoder
+        self.metrics.throttle = throttle
+        self.report_interval = report_interval
+        self.clock = reactor
+        self._reporter = None
+
+        if isinstance(self.protocol, TCPConnectionPool):
+            self._watch(self.protocol.protocols, self.protocol.factories)
+            self.protocol.connect()
+        elif isinstance(self.protocol, RelayGelfProtocol):
+            factory = RelayClientFactory(self.protocol)
+            self._watch([self.protocol], [factory])
+            factory.connect()
+        elif issubclass(self.protocol.__class__, DatagramProtocol):
+            self._watch([self.protocol], [])
             reactor.listenUDP(0, self.protocol)
         elif issubclass(self.protocol.__class__, Protocol):
-            reactor.connectTCP(
-                self.protocol.host,
-                self.protocol.port,
-                TCPGraylogFactory(self.protocol)
-            )
+            factory = TCPGraylogFactory(self.protocol)
+            self._watch([self.protocol], [factory])
+            factory.connect()
+        elif isinstance(self.protocol, AMQPGelfProtocol):
+            factory = AMQPGraylogFactory(self.protocol)
+            self._watch([self.protocol], [factory])
+            reactor.connectTCP(self.protocol.host, self.protocol.port, factory)
+        elif isinstance(self.protocol, HTTPGelfProtocol):
+            self._watch([self.protocol], [])
+            self.protocol.connect()
         else:
             raise ValueError('Incompatible protocol')
 
     def emit(self, event_dict):
-        self.protocol.log_message(event_dict)
+        if self.encoder is not None:
+            # the event is shared with other observers, so the encoding
+            # threads get a copy of their own
+            event_dict = dict(event_dict)
+        self._send(event_dict)
 
     def start(self, with_reactor=False):
+        if self.encoder is not None:
+            self.encoder.start()
+
+        if self.report_interval:
+            self._reporter = task.LoopingCall(self._report)
+            self._reporter.clock = self.clock
+            self._reporter.start(self.report_interval, now=False)
+
         if with_reactor:
-            reactor.callWhenRunning(log.addObserver, self.emit)
+            reactor.callWhenRunning(self._register)
         else:
-            log.addObserver(self.emit)
+            self._register()
 
     def stop(self):
+        self._unregister()
+
+        if self._reporter is not None and self._reporter.running:
+            self._reporter.stop()
+        if self.throttle is not None:
+            self.throttle.stop()
+        if self.encoder is not None:
+            self.encoder.stop()
+
+    def _send(self, event_dict):
+        """ Throttle, encode and send an event dictionary of our own
+        """
+        self.metrics.events += 1
+        if self.throttle is not None:
+            self.throttle.filter(event_dict, self._deliver)
+        else:
+            self._deliver(event_dict)
+
+    def _deliver(self, event_dict):
+        if self.encoder is not None:
+            self.encoder.submit(event_dict)
+        else:
+            self.protocol.log_message(event_dict)
+
+    def _report(self):
+        """ Send a report of our metrics
+        """
+        self._deliver(self.metrics.report())
+
+    def _watch(self, protocols, factories):
+        """ Have the protocols record their encoding in our metrics, and
+            read the rest of the metrics from them and their factories
+        """
+        for protocol in protocols:
+            protocol.metrics = self.metrics
+        if self.encoder is not None:
+            self.encoder.metrics = self.metrics
+        self.metrics.protocols = protocols
+        self.metrics.factories = factories
+
+    def _register(self):
+        log.addObserver(self.emit)
+
+    def _unregister(self):
         log.removeObserver(self.emit)
+
+
+# syslog levels, which are what GELF uses
+SYSLOG_LEVELS = {
+    LogLevel.debug: 7,
+    LogLevel.info: 6,
+    LogLevel.warn: 4,
+    LogLevel.error: 3,
+    LogLevel.critical: 2,
+}
+
+
+@implementer(ILogObserver)
+class GraylogLogObserver(GraylogObserver):
+    """ Graylog observer for the :mod:`twisted.logger` logging system. Events
+        are filtered by level, namespace and any predicates before anything
+        else is done with them, so events which are not sent cost next to
+        nothing. The `log_format` of an event is only rendered once it is
+        known to be sent, and the event is then mapped straight to the
+        fields of a GELF message:
+            log_level becomes the syslog level
+            log_namespace becomes the facility
+            log_format is kept as the `_format` field
+            log_failure becomes the failure, with the rendered message
+                as the `_why` field
+        along with the other keys of the event which do not begin with
+        `log_`
+    """
+
+    max_namespaces = 10000
+
+    def __init__(
+            self, protocol, host, port, level=LogLevel.info, namespaces=None,
+            predicates=(), **kwargs):
+        """ Create the protocol and connect it to Graylog
+            :param level: the lowest :class:`~twisted.logger.LogLevel` of
+                the events to send
+            :param namespaces: a list of namespaces to send events from,
+                including the namespaces below them, or None for all
+            :param predicates: a list of callables taking an event, which
+                return False or :attr:`~twisted.logger.PredicateResult.no`
+                for events which should not be sent
+            :param kwargs: see :class:`GraylogObserver`
+        """
+        GraylogObserver.__init__(self, protocol, host, port, **kwargs)
+        self.levels = frozenset(
+            l for l in LogLevel.iterconstants() if l >= level)
+        self.namespaces = None if namespaces is None else tuple(namespaces)
+        self.predicates = list(predicates)
+        self.filtered = 0
+
+        self._namespaces = {}
+
+    def __call__(self, event):
+        if not self.accept(event):
+            self.filtered += 1
+            return
+        self._send(self.convert(event))
+
+    def accept(self, event):
+        """ Whether an event passes the filters
+        """
+        if event.get('log_level') not in self.levels:
+            return False
+        if self.namespaces is not None and not self._included(
+                event.get('log_namespace')):
+            return False
+        for predicate in self.predicates:
+            result = predicate(event)
+            if not result or result is PredicateResult.no:
+                return False
+        return True
+
+    def convert(self, event):
+        """ Turn an event into an event dictionary for the protocols
+        """
+        event_dict = dict(
+            (key, value) for key, value in event.iteritems()
+            if not key.startswith('log_'))
+
+        text = formatEvent(event)
+        event_dict['message'] = (text, )
+        event_dict['level'] = SYSLOG_LEVELS.get(event.get('log_level'), 6)
+        event_dict['system'] = event.get('log_namespace', '')
+        if 'log_time' in event:
+            event_dict['time'] = event['log_time']
+        if event.get('log_format') is not None:
+            event_dict['format'] = event['log_format']
+
+        if 'log_failure' in event:
+            event_dict['isError'] = True
+            event_dict['failure'] = event['log_failure']
+            event_dict['why'] = text
+        else:
+            event_dict['isError'] = False
+        return event_dict
+
+    def _included(self, namespace):
+        """ Whether events from a namespace are sent. The answer for each
+            namespace is remembered
+        """
+        try:
+            return self._namespaces[namespace]
+        except KeyError:
+            pass
+
+        included = namespace is not None and any(
+            namespace == prefix or namespace.startswith(prefix + '.')
+            for prefix in self.namespaces)
+        if len(self._namespaces) >= self.max_namespaces:
+            self._namespaces.clear()
+        self._namespaces[namespace] = included
+        return included
+
+    def _register(self):
+        globalLogPublisher.addObserver(self)
+
+    def _unregister(self):
+        globalLogPublisher.removeObserver(self)
@@ -0,0 +1,353 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+.. module:: amqp
+    :platform: Unix, Windows
+    :synopsis: Graylog AMQP protocol, publishing to a broker in front of a
+        Graylog AMQP input. Connecting to a broker needs pika
+.. moduleauthor:: Adam Drakeford <adamdrakeford@gmail.com>
+"""
+
+from socket import gethostname
+
+from twisted.internet import reactor
+
+from gelf import GelfBuilder, GelfTemplate, event_level
+from limits import DEFAULT_LIMITS
+from tcp import TCPGraylogFactory
+from txgraylog.buffering import MessageBuffer, INFO
+
+try:
+    import pika
+    from pika.adapters.twisted_connection import TwistedProtocolConnection
+except ImportError:
+    pika = None
+
+
+class AMQPGelfProtocol(object):
+    """ Graylog Gelf protocol which publishes GELF messages to an AMQP
+        exchange, with publisher confirms. Messages are published in batches
+        and up to `max_unconfirmed` publishes may be waiting for the broker
+        to confirm them, so we never wait on a round trip for each one.
+
+        Like the TCP protocols, messages are buffered while there is no
+        channel, or while `max_unconfirmed` messages are already pending or
+        waiting to be confirmed, and replayed in order once there is room
+        for them. A message is only
+        counted as sent once the broker confirms it. Messages which were
+        published but not confirmed when the channel closed are put back in
+        the buffer and published again, and messages the broker refuses are
+        buffered again too, so each message is delivered at least once
+    """
+
+    parameter_override = {}
+    limits = DEFAULT_LIMITS
+
+    def __init__(
+            self, host, port, exchange='log-messages', routing_key='',
+            compression=True, buffer=None, batch_size=100, flush_delay=0,
+            max_unconfirmed=1000, vhost='/', username='guest',
+            password='guest', persistent=True):
+        """ Initialize our protocol
+            :param exchange: the exchange to publish to
+            :param routing_key: the routing key of each message
+            :param compression: whether to compress with zlib, or one of the
+                strategies from :mod:`~txgraylog.protocol.compression`
+            :param buffer: the :class:`~txgraylog.buffering.MessageBuffer`
+                holding messages while there is no channel
+            :param batch_size: the number of messages at which a batch is
+                published straight away
+            :param flush_delay: the number of seconds a message may wait for
+                its batch to fill. The default of 0 publishes at the end of
+                the current reactor iteration
+            :param max_unconfirmed: the number of publishes which may be
+                waiting to be confirmed
+            :param persistent: whether the broker should write the messages
+                to disk
+        """
+        self.host = host
+        self.port = port
+        self.exchange = exchange
+        self.routing_key = routing_key
+        self.compression = compression
+        self.batch_size = batch_size
+        self.flush_delay = flush_delay
+        self.max_unconfirmed = max_unconfirmed
+        self.vhost = vhost
+        self.username = username
+        self.password = password
+
+        self.properties = None
+        if pika is not None:
+            self.properties = pika.BasicProperties(
+                delivery_mode=2 if persistent else 1)
+
+        self.connected = False
+        self.channel = None
+
+        self.hostname = gethostname()
+        self.buffer = buffer if buffer is not None else MessageBuffer()
+        self.builder = None
+        self.metrics = None
+        self.clock = reactor
+
+        self._pending = []
+        self._flush_call = None
+        self._unconfirmed = {}
+        self._sequence = 0
+
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.connects = 0
+        self.disconnects = 0
+        self.nacked = 0
+
+    def channelOpened(self, channel):
+        """ A channel with publisher confirms turned on is open
+        """
+        self.channel = channel
+        self.connected = True
+        self.connects += 1
+        self._refill()
+
+    def channelClosed(self, reason):
+        """ The channel is gone. Anything published but not yet confirmed
+            and anything still waiting to be published is kept for the next
+            channel
+        """
+        self.channel = None
+        self.connected = False
+        self.disconnects += 1
+
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+
+        unconfirmed = [
+            self._unconfirmed[seq] for seq in sorted(self._unconfirmed)]
+        self._unconfirmed = {}
+        pending, self._pending = self._pending, []
+        self.buffer.restore(unconfirmed + pending)
+
+    def log_message(self, event):
+        """ The method to be called when we want to emit a log activity
+            The paramater overide can be set to include extra paramaters
+        """
+        messages = self._encode(event)
+        level = event_level(event)
+        for message in messages:
+            self.send_to_graylog(message, level)
+
+    def encode(self, event):
+        """ Build the GELF message to be published for an event with our
+            builder, which is rebuilt whenever the paramater overide
+            changes. Each message is a whole AMQP message so it is never
+            chunked
+        """
+        return self._builder().build(event)
+
+    def send_to_graylog(self, message, level=INFO):
+        """ Publish a message, or buffer it while there is no channel, no
+            room for another unconfirmed publish or the buffer still holds
+            messages to be published first
+        """
+        if not self.connected or len(self.buffer) or not self._room():
+            self.buffer.append(str(message), level)
+            return
+
+        self._write(str(message), level)
+
+    def send_encoded(self, message, level=INFO):
+        """ Compress and publish a GELF message which has already been
+            serialized
+        """
+        for body in self._builder().build_encoded(message):
+            self.send_to_graylog(body, level)
+
+    def _builder(self):
+        """ Get the builder for our messages, rebuilding it whenever the
+            paramater overide or the compression changes
+        """
+        builder = self.builder
+        if (builder is None or
+                builder.compress is not self.compression or
+                builder.template.overrides != self.parameter_override):
+            builder = self.builder = GelfBuilder(
+                GelfTemplate(
+                    self.hostname, self.parameter_override, self.limits),
+                chunk=False, compress=self.compression)
+        return builder
+
+    def flush(self):
+        """ Publish the pending messages, as many as may be unconfirmed
+        """
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+
+        if not self.connected:
+            return
+
+        room = self.max_unconfirmed - len(self._unconfirmed)
+        batch, self._pending = self._pending[:room], self._pending[room:]
+        for entry in batch:
+            self._publish(entry)
+
+    def _room(self):
+        """ The number of messages which may be added to the pending batch
+            without more than `max_unconfirmed` being pending or unconfirmed
+        """
+        return (
+            self.max_unconfirmed - len(self._unconfirmed) -
+            len(self._pending))
+
+    def _refill(self):
+        """ Move buffered messages to the pending batch, in order, for as
+            long as there is room for them
+        """
+        buffer = self.buffer
+        while self.connected and len(buffer) and self._room() > 0:
+            message, level = buffer.popleft()
+            buffer.replayed += 1
+            self._write(message, level)
+
+    def _write(self, message, level):
+        """ Add a message to the pending batch, publishing it straight away
+            once it is full or there is no room for it to grow
+        """
+        self._pending.append((message, level))
+
+        if len(self._pending) >= self.batch_size or not self._room():
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = self.clock.callLater(
+                self.flush_delay, self.flush)
+
+    def _publish(self, entry):
+        """ Publish a message without waiting for it to be confirmed
+        """
+        self._sequence += 1
+        seq = self._sequence
+        self._unconfirmed[seq] = entry
+
+        d = self.channel.basic_publish(
+            self.exchange, self.routing_key, entry[0], self.properties)
+        d.addCallbacks(
+            self._confirmed, self._refused, callbackArgs=(seq, ),
+            errbackArgs=(seq, ))
+
+    def _confirmed(self, _, seq):
+        """ The broker has taken responsibility for a message
+        """
+        entry = self._unconfirmed.pop(seq, None)
+        if entry is None:
+            return
+
+        self.messages_sent += 1
+        self.bytes_sent += len(entry[0])
+        self._refill()
+
+    def _refused(self, reason, seq):
+        """ The broker refused a message, or the channel closed before it
+            was confirmed. Publishing to a closed channel fails straight
+            away, so once the channel is closed nothing is published again
+            until there is a new one
+        """
+        channel = self.channel
+        if channel is not None and getattr(channel, 'is_closed', False):
+            self.channelClosed(reason)
+            return
+
+        entry = self._unconfirmed.pop(seq, None)
+        if entry is None:
+            # already put back in the buffer when the channel closed
+            return
+
+        self.nacked += 1
+        self.buffer.append(*entry)
+        self._refill()
+
+    def _encode(self, event):
+        """ Encode an event, recording how long it took and the size of the
+            messages when we have a :class:`~txgraylog.metrics.Metrics`
+        """
+        metrics = self.metrics
+        if metrics is None:
+            return self.encode(event)
+
+        start = metrics.timer()
+        messages = self.encode(event)
+        metrics.encoded(metrics.timer() - start, [len(m) for m in messages])
+        return messages
+
+
+class AMQPGraylogFactory(TCPGraylogFactory):
+    """ Connects to the broker with pika, opening a channel with publisher
+        confirms for the protocol each time the connection is made and
+        reconnecting whenever it is lost. When the broker closes the channel
+        while the connection stays up, for instance because the exchange
+        does not exist, the connection is closed too so that we reconnect.
+        The delay before reconnecting keeps growing for as long as channels
+        close without the broker confirming anything
+    """
+
+    def __init__(self, protocol):
+        if pika is None:
+            raise ImportError('pika is needed to connect to an AMQP broker')
+        TCPGraylogFactory.__init__(self, protocol)
+        self.channel_closes = 0
+        self._failing = False
+        self._sent = 0
+
+    def buildProtocol(self, addr):
+        protocol = self.protocol
+        parameters = pika.ConnectionParameters(
+            virtual_host=protocol.vhost,
+            credentials=pika.PlainCredentials(
+                protocol.username, protocol.password))
+
+        connection = TwistedProtocolConnection(parameters)
+        d = connection.ready
+        d.addCallback(lambda _: connection.channel())
+        d.addCallback(self._confirm, connection)
+        # a failure to open is followed by the connection being lost, which
+        # is where we retry
+        d.addErrback(lambda _: None)
+        return connection
+
+    def clientConnectionLost(self, connector, reason):
+        if self.protocol.connected:
+            self.protocol.channelClosed(reason)
+        TCPGraylogFactory.clientConnectionLost(self, connector, reason)
+
+    def _confirm(self, channel, connection):
+        channel.on_closed.addCallback(
+            self._channel_closed, channel, connection)
+        d = channel.confirm_delivery()
+        d.addCallback(self._channel_opened, channel)
+        return d
+
+    def _channel_opened(self, _, channel):
+        if not self._failing:
+            self.resetDelay()
+        self._sent = self.protocol.messages_sent
+        self.protocol.channelOpened(channel)
+
+    def _channel_closed(self, reason, channel, connection):
+        """ The channel is closed, by the broker or along with the
+            connection. Keep its messages for the next channel and close
+            the connection, which we then reconnect
+        """
+        self.channel_closes += 1
+        self._failing = (
+            isinstance(reason, pika.exceptions.ChannelClosedByBroker) and
+            self.protocol.messages_sent == self._sent)
+        if self.protocol.channel is channel:
+            self.protocol.channelClosed(reason)
+
+        try:
+            connection.close()
+        except pika.exceptions.ConnectionWrongStateError:
+            # the connection is already closing
+            pass
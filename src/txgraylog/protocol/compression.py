@@ -0,0 +1,67 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+.. module:: compression
+    :platform: Unix, Windows
+    :synopsis: Compression strategies for GELF messages. Graylog accepts
+        zlib, gzip or uncompressed GELF and works out which from the
+        message itself, or over HTTP from the Content-Encoding header
+.. moduleauthor:: Adam Drakeford <adamdrakeford@gmail.com>
+"""
+
+import zlib
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+
+class NoCompression(object):
+    """ Sends messages as they are
+    """
+
+    content_encoding = None
+
+    def compress(self, data):
+        return data
+
+
+class ZlibCompression(object):
+    """ Compresses messages with zlib, leaving messages smaller than
+        `min_size` uncompressed as compressing them saves little or nothing
+    """
+
+    content_encoding = 'deflate'
+
+    def __init__(self, level=zlib.Z_DEFAULT_COMPRESSION, min_size=0):
+        """ Initialise the compression strategy
+            :param level: the zlib compression level, from 1 (fastest) to 9
+                (smallest)
+            :param min_size: the size in bytes below which messages are
+                not compressed
+        """
+        self.level = level
+        self.min_size = min_size
+
+    def compress(self, data):
+        if len(data) < self.min_size:
+            return data
+        return zlib.compress(data, self.level)
+
+
+class GzipCompression(ZlibCompression):
+    """ Compresses messages with gzip framing. Each message is a separate
+        gzip stream so a new compressor is needed for every one; copying a
+        prepared compressor costs more than making a new one
+    """
+
+    content_encoding = 'gzip'
+
+    def compress(self, data):
+        if len(data) < self.min_size:
+            return data
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, GZIP_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+
+NONE = NoCompression()
+ZLIB = ZlibCompression()
@@ -11,17 +11,73 @@
 .. moduleauthor:: Adam Drakeford <adamdrakeford@gmail.com>
 """
 
-import zlib
+import itertools
+import json
+import os
 import time
-import uuid
 import struct
-import jsonlib as json
 
-from twisted.python import randbytes
+import serializer
+from compression import NONE, ZLIB
+from limits import DEFAULT_LIMITS
+from tracebacks import DEFAULT_TRACEBACKS
 
 IGNORE_FIELDS = set(["message", "time", "isError", "system", "id", "failure"])
+BASE_FIELDS = IGNORE_FIELDS | set(["version", "level", "file", "line"])
 WAN_CHUNK, LAN_CHUNK = 1420, 8154
 GELF_LEGACY, GELF_NEW = 0, 1
+CHUNK_DROP, CHUNK_TRUNCATE = 0, 1
+MAX_CHUNKS = 128
+MAX_COUNTER = 2 ** 64 - 1
+
+
+def event_level(event):
+    """ The syslog level for a Twisted event dictionary, either as set on the
+        event or 3 (error) for failures and 6 (info) for everything else
+    """
+    if event.get('isError') and 'failure' in event:
+        return event.get('level', 3)
+    return event.get('level', 6)
+
+
+class LogParams(dict):
+    """ The GELF paramaters of a :class:`GelfProtocol`, which notes when
+        it is changed in place so that the message is encoded again
+    """
+
+    __slots__ = ('changed', )
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self.changed = False
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.changed = True
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        self.changed = True
+
+    def clear(self):
+        dict.clear(self)
+        self.changed = True
+
+    def pop(self, *args):
+        self.changed = True
+        return dict.pop(self, *args)
+
+    def popitem(self):
+        self.changed = True
+        return dict.popitem(self)
+
+    def setdefault(self, key, default=None):
+        self.changed = True
+        return dict.setdefault(self, key, default)
+
+    def update(self, *args, **kwargs):
+        dict.update(self, *args, **kwargs)
+        self.changed = True
 
 
 class GelfProtocol(object):
@@ -37,121 +93,456 @@ class GelfProtocol(object):
                 "facility": "foo",
                 "_custom_value": "bar"
             }
+        The protocols build their messages with a :class:`GelfBuilder`
+        rather than an instance of this class per event
     """
 
     def __init__(
             self, host, size=WAN_CHUNK, gelf_fmt=GELF_LEGACY,
-            chunk=True, compress=True, **kwargs):
+            chunk=True, compress=True, chunk_overflow=CHUNK_TRUNCATE,
+            template=None, encoded=None, limits=DEFAULT_LIMITS, event=None,
+            **kwargs):
         """ initalise the a Gelf protocol instance.
             :param size: the size of each chunk
             :param gelf_fmt: The format of GELF chunks is changing and versions
                 0.9.5p2 and before require a legacy format. This should be
                 either GELF_LEGACY or GELF_NEW
+            :param compress: whether to compress with zlib, or one of the
+                strategies from :mod:`~txgraylog.protocol.compression`
+            :param chunk_overflow: what to do with a message needing more than
+                the MAX_CHUNKS chunks Graylog accepts. CHUNK_DROP sends
+                nothing, while CHUNK_TRUNCATE shortens the full message until
+                it fits and marks it as `_truncated`
+            :param template: a :class:`GelfTemplate` to build and serialize
+                the message with, in which case the template's host is used
+            :param encoded: a message which has already been serialized, to
+                be compressed and chunked as it is
+            :param limits: the :class:`~txgraylog.protocol.limits.SizeLimits`
+                the fields are kept within, or None for no limits. A
+                template applies its own
+            :param event: the event to build the message from with the
+                template, in place of `kwargs`, so that its keys may share
+                the names of our other paramaters
             :param kwargs: `dict` containing the log paramaters to be
                 used by Graylog
         """
         self.hostname = host
         self.chunk_size = size
         self.gelf_format = gelf_fmt
+        self.chunk_overflow = chunk_overflow
+        self.limits = limits
 
         self._chunk = chunk
-        self._compress = compress
+        if compress is True:
+            self._compress = ZLIB
+        else:
+            self._compress = compress or NONE
+        self._encoded = None
 
-        self._build_log_params(kwargs)
+        self._template = template
+        self._serialized = encoded
+        if encoded is not None:
+            self._log_params = None
+        elif template is None:
+            self._build_log_params(kwargs)
+        else:
+            self._event = event if event is not None else kwargs
+            self._log_params = None
 
     def generate(self):
         """ Compress the log paramaters and return either it. If
             the length of the compressed data is larger than the
             chunk size, we split into chunks
         """
-        if self._chunk and len(self.encoded_log_params) > self.chunk_size:
-            return list(self._get_chunks(self.encoded_log_params))
-        else:
-            return [self.encoded_log_params]
+        return list(self)
 
     def __iter__(self):
-        """ Iterate over each of the log paramaters
+        """ Iterate over each of the messages to be sent
+        """
+        encoded = self._fit_chunks()
+        if encoded is None:
+            return iter([])
+        elif self._chunk and len(encoded) > self.chunk_size:
+            return self._get_chunks(encoded)
+        else:
+            return iter([encoded])
+
+    def datagrams(self):
+        """ Iterate over each of the messages to be sent as a tuple of
+            buffers, for use with scatter/gather writes. The payload of each
+            chunk is a `memoryview` so it is never copied
         """
-        if self._chunk and len(self.encoded_log_params) > self.chunk_size:
-            return self._get_chunks(self.encoded_log_params)
+        encoded = self._fit_chunks()
+        if encoded is None:
+            return iter([])
+        elif self._chunk and len(encoded) > self.chunk_size:
+            return self._get_chunk_parts(encoded)
         else:
-            return iter(self.encoded_log_params)
+            return iter([(encoded, )])
+
+    @property
+    def log_params(self):
+        """ The GELF paramaters of this message
+        """
+        if self._log_params is None:
+            if self._serialized is not None:
+                params = json.loads(self._serialized)
+            else:
+                params = self._template.log_params(self._event)
+            self._log_params = LogParams(params)
+        return self._log_params
+
+    @log_params.setter
+    def log_params(self, params):
+        """ Replace the GELF paramaters with a copy of `params`, dropping
+            any cached encoding. The copy is a :class:`LogParams`, so that
+            changes made to it in place drop the cached encoding too
+        """
+        self._log_params = LogParams(params)
+        self._encoded = None
 
     @property
     def encoded_log_params(self):
-        """ Property to return back the compressed log paramaters
+        """ Property to return back the compressed log paramaters. These are
+            serialized and compressed once and cached until `log_params` is
+            reassigned or changed
         """
-        params = (
-            zlib.compress(json.dumps(self.log_params))
-            if self._compress else json.dumps(self.log_params)
-        )
-        return params
+        params = self._log_params
+        if params is not None and params.changed:
+            params.changed = False
+            self._encoded = None
+
+        if self._encoded is None:
+            if self._log_params is not None:
+                encoded = serializer.dumps(self._log_params)
+            elif self._serialized is not None:
+                encoded = self._serialized
+            else:
+                encoded = self._template.encode(self._event)
+            self._encoded = self._compress.compress(encoded)
+        return self._encoded
 
     def _build_log_params(self, event):
         """ Build up the log paramaters
         """
+        limits = self.limits
         if event['isError'] and 'failure' in event:
-            level = 3
-            short_message = str(event['failure'].value)
-            full_message = event['failure'].getTraceback()
+            failure = event['failure']
+            short_message = str(failure.value)
+            if limits is not None:
+                full_message = limits.traceback(failure)
+            else:
+                full_message = DEFAULT_TRACEBACKS.format(failure)
         else:
-            level = 6
             short_message = event['message'][0] if event['message'] else ''
             full_message = ' '.join([str(m) for m in event['message']])
 
-        self.log_params = {
+        log_params = {
             'version': event.get('version', ''),
             'host': self.hostname,
             'short_message': short_message,
             'full_message': full_message,
             'timestamp': event.get('time', time.time()),
-            'level': event.get('level', level),
+            'level': event_level(event),
             'facility': event.get('system', ''),
         }
 
         if 'file' in event:
-            self.log_params['file'] = event['file']
+            log_params['file'] = event['file']
         if 'line' in event:
-            self.log_params['line'] = event['line']
+            log_params['line'] = event['line']
 
         for key, value in event.iteritems():
             if key not in IGNORE_FIELDS:
-                self.log_params["_%s" % (key, )] = value
+                log_params["_%s" % (key, )] = value
+
+        if limits is not None:
+            log_params = limits.apply(log_params)
+        self.log_params = log_params
+
+    def _fit_chunks(self):
+        """ Get the encoded log paramaters, applying the chunk overflow policy
+            if they will not fit in MAX_CHUNKS chunks. Returns None if the
+            message should be dropped
+        """
+        encoded = self.encoded_log_params
+        limit = MAX_CHUNKS * self.chunk_size
+        if not self._chunk or len(encoded) <= limit:
+            return encoded
+        elif self.chunk_overflow != CHUNK_TRUNCATE:
+            return None
+
+        full_message = self.log_params.get('full_message') or ''
+        while len(encoded) > limit and full_message:
+            full_message = full_message[:len(full_message) // 2]
+            self.log_params = dict(
+                self.log_params, full_message=full_message, _truncated=True)
+            encoded = self.encoded_log_params
+
+        return encoded if len(encoded) <= limit else None
 
     def _get_chunks(self, compressed):
         """Split the compressed log paramaters into chunks
         """
-        num_chunks = (len(compressed) / self.chunk_size) + 1
-
-        if self.gelf_format == GELF_LEGACY:
-            pieces = struct.pack('>H', num_chunks)
-            chunk_id = uuid.uuid1().bytes + randbytes.secureRandom(16)
-
-            for i in xrange(num_chunks):
-                chunk = ''.join([
-                    '\x1e\x0f',
-                    chunk_id,
-                    struct.pack('>H', i),
-                    pieces,
-                    compressed[
-                        i * self.chunk_size:
-                        i * self.chunk_size + self.chunk_size]
-                    ]
-                )
-                yield chunk
+        for header, piece in self._get_chunk_parts(compressed):
+            yield header + piece.tobytes()
+
+    def _get_chunk_parts(self, compressed):
+        """ Split the compressed log paramaters into a header and a slice of
+            the payload for each chunk. The header is built once and only
+            the sequence number is patched in for each chunk
+        """
+        size = self.chunk_size
+        num_chunks = (len(compressed) + size - 1) // size
+        prefix, suffix = chunk_header(self.gelf_format, num_chunks)
+
+        payload = memoryview(compressed)
+        for i in xrange(num_chunks):
+            yield prefix + chr(i) + suffix, payload[i * size:(i + 1) * size]
+
+
+def chunk_header(gelf_fmt, num_chunks):
+    """ Build the header shared by the chunks of a message as the bytes
+        before and after the sequence number, which with at most MAX_CHUNKS
+        chunks is always a single byte
+    """
+    if gelf_fmt == GELF_LEGACY:
+        return (
+            '\x1e\x0f' + LEGACY_IDS.next() + '\x00',
+            struct.pack('>H', num_chunks))
+    return '\x1e\x0f' + NEW_IDS.next(), chr(num_chunks)
+
+
+class ChunkIds(object):
+    """ Generates the ids of chunked messages without reading random bytes
+        for every message. Each process picks a random prefix and a random
+        starting point for a 64 bit counter, and each id is the prefix
+        followed by the next value of the counter. Ids never repeat within
+        a process, and two processes only share one if their counters
+        happen to overlap, which with random 64 bit starting points is far
+        less likely than two ids from 8 random bytes alike in Graylog's few
+        seconds of reassembly. A forked process picks its own prefix and
+        starting point the first time it needs an id
+    """
+
+    def __init__(self, size):
+        """ Initialise the generator
+            :param size: the number of bytes in each id, at least 8
+        """
+        self.size = size
+        self.getpid = os.getpid
+        self._pid = None
+
+    def next(self):
+        """ Get the next id
+        """
+        if self.getpid() != self._pid:
+            self.reset()
+        return self._prefix + struct.pack(
+            '>Q', (self._start + next(self._counter)) & MAX_COUNTER)
+
+    def reset(self):
+        """ Pick a new prefix and starting point
+        """
+        self._prefix = os.urandom(self.size - 8)
+        self._start = struct.unpack('>Q', os.urandom(8))[0]
+        self._counter = itertools.count()
+        self._pid = self.getpid()
+
+
+LEGACY_IDS, NEW_IDS = ChunkIds(32), ChunkIds(8)
+
+
+class GelfBuilder(object):
+    """ Builds the messages for events with a :class:`GelfTemplate`, taking
+        the same options as :class:`GelfProtocol`. A protocol keeps one and
+        uses it for every event, so that no message object, copy of the
+        event or dictionary of paramaters is made per event; only the
+        serialized message, its compressed form and the chunks are. It
+        keeps no state between events, so it may be used by encoding
+        threads at the same time. The rare message needing more than
+        MAX_CHUNKS chunks is left to :class:`GelfProtocol` and its chunk
+        overflow policy
+    """
+
+    def __init__(
+            self, template, size=WAN_CHUNK, gelf_fmt=GELF_LEGACY,
+            chunk=True, compress=True, chunk_overflow=CHUNK_TRUNCATE):
+        """ Initialise the builder
+            :param template: the :class:`GelfTemplate` to build and
+                serialize the messages with
+        """
+        self.template = template
+        self.chunk_size = size
+        self.gelf_format = gelf_fmt
+        self.chunk = chunk
+        self.chunk_overflow = chunk_overflow
+        self.compress = compress
+        if compress is True:
+            self.compression = ZLIB
+        else:
+            self.compression = compress or NONE
+
+    def build(self, event):
+        """ Build the messages to be sent for an event
+        """
+        encoded = self.compression.compress(self.template.encode(event))
+        if not self.chunk or len(encoded) <= self.chunk_size:
+            return [encoded]
+        elif len(encoded) > MAX_CHUNKS * self.chunk_size:
+            return self._overflow(event).generate()
+        return self._chunks(encoded)
+
+    def build_encoded(self, message):
+        """ Build the messages to be sent for a GELF message which has
+            already been serialized
+        """
+        encoded = self.compression.compress(message)
+        if not self.chunk or len(encoded) <= self.chunk_size:
+            return [encoded]
+        elif len(encoded) > MAX_CHUNKS * self.chunk_size:
+            return self._overflow(encoded=message).generate()
+        return self._chunks(encoded)
+
+    def datagrams(self, event):
+        """ Build the messages to be sent for an event as tuples of buffers,
+            for use with scatter/gather writes. The payload of each chunk is
+            a `memoryview` so it is never copied
+        """
+        encoded = self.compression.compress(self.template.encode(event))
+        if not self.chunk or len(encoded) <= self.chunk_size:
+            return [(encoded, )]
+        elif len(encoded) > MAX_CHUNKS * self.chunk_size:
+            return list(self._overflow(event).datagrams())
+
+        size = self.chunk_size
+        num_chunks = (len(encoded) + size - 1) // size
+        prefix, suffix = chunk_header(self.gelf_format, num_chunks)
+        payload = memoryview(encoded)
+        return [
+            (prefix + chr(i) + suffix, payload[i * size:(i + 1) * size])
+            for i in xrange(num_chunks)]
+
+    def _chunks(self, encoded):
+        """ Split a message into chunks, each joined from its header and its
+            slice of the message in one go
+        """
+        size = self.chunk_size
+        num_chunks = (len(encoded) + size - 1) // size
+        prefix, suffix = chunk_header(self.gelf_format, num_chunks)
+        join = ''.join
+        return [
+            join((prefix, chr(i), suffix, encoded[i * size:(i + 1) * size]))
+            for i in xrange(num_chunks)]
+
+    def _overflow(self, event=None, encoded=None):
+        """ Build a :class:`GelfProtocol` for a message too large for
+            MAX_CHUNKS chunks, which applies the chunk overflow policy
+        """
+        return GelfProtocol(
+            self.template.host, size=self.chunk_size,
+            gelf_fmt=self.gelf_format, compress=self.compression,
+            chunk_overflow=self.chunk_overflow, template=self.template,
+            encoded=encoded, event=event or {})
+
+
+class GelfTemplate(object):
+    """ A GELF message layout for a host and set of paramater overrides. The
+        host and the overrides are the same for every message, so they are
+        serialized once and only the fields taken from each event are
+        serialized per message. The name of the GELF field for each event
+        key is also remembered rather than worked out every time. The
+        message holds the same fields with the same values as one built
+        by :class:`GelfProtocol` from the event updated with the overrides
+    """
+
+    max_names = 10000
+
+    def __init__(self, host, overrides=None, limits=DEFAULT_LIMITS):
+        """ Initialise the template
+            :param host: the host the messages come from
+            :param overrides: `dict` of paramaters which override those of
+                every event
+            :param limits: the :class:`~txgraylog.protocol.limits.SizeLimits`
+                the fields taken from each event are kept within, or None
+                for no limits
+        """
+        self.host = host
+        self.overrides = dict(overrides or {})
+        self.limits = limits
+
+        self.static = {'host': host}
+        for key, value in self.overrides.iteritems():
+            if key not in IGNORE_FIELDS:
+                self.static['_%s' % (key, )] = value
+
+        # overrides which change the standard GELF fields have to be merged
+        # into each event before those fields are built
+        self._base = dict(
+            (key, value) for key, value in self.overrides.iteritems()
+            if key in BASE_FIELDS)
+        self._prefix = serializer.dumps(self.static)[:-1] + ','
+        self._names = {}
+
+    def fields(self, event):
+        """ Build the GELF fields which come from an event
+        """
+        if self._base:
+            event = dict(event, **self._base)
+
+        limits = self.limits
+        if event.get('isError') and 'failure' in event:
+            failure = event['failure']
+            short_message = str(failure.value)
+            if limits is not None:
+                full_message = limits.traceback(failure)
+            else:
+                full_message = DEFAULT_TRACEBACKS.format(failure)
         else:
-            pieces = struct.pack('B', num_chunks)
-            chunk_id = randbytes.secureRandom(8)
-
-            for i in xrange(num_chunks):
-                chunk = ''.join([
-                    '\x1e\x0f',
-                    chunk_id,
-                    struct.pack('B', i),
-                    pieces,
-                    compressed[
-                        i * self.chunk_size:
-                        i * self.chunk_size + self.chunk_size]
-                    ]
-                )
-                yield chunk
+            message = event.get('message')
+            short_message = message[0] if message else ''
+            full_message = ' '.join([str(m) for m in message or ()])
+
+        fields = {
+            'version': event.get('version', ''),
+            'short_message': short_message,
+            'full_message': full_message,
+            'timestamp': event['time'] if 'time' in event else time.time(),
+            'level': event_level(event),
+            'facility': event.get('system', ''),
+        }
+
+        if 'file' in event:
+            fields['file'] = event['file']
+        if 'line' in event:
+            fields['line'] = event['line']
+
+        names = self._names
+        for key, value in event.iteritems():
+            try:
+                name = names[key]
+            except KeyError:
+                if len(names) >= self.max_names:
+                    names.clear()
+                if key in IGNORE_FIELDS or key in self.overrides:
+                    name = names[key] = None
+                else:
+                    name = names[key] = '_%s' % (key, )
+            if name is not None:
+                fields[name] = value
+
+        if limits is not None:
+            fields = limits.apply(fields)
+        return fields
+
+    def log_params(self, event):
+        """ Build all of the GELF paramaters for an event
+        """
+        log_params = dict(self.static)
+        log_params.update(self.fields(event))
+        return log_params
+
+    def encode(self, event):
+        """ Serialize the GELF message for an event
+        """
+        return self._prefix + serializer.dumps(self.fields(event))[1:]
@@ -0,0 +1,255 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+.. module:: http
+    :platform: Unix, Windows
+    :synopsis: Graylog HTTP protocol
+.. moduleauthor:: Adam Drakeford <adamdrakeford@gmail.com>
+"""
+
+from StringIO import StringIO
+from socket import gethostname
+
+from twisted.internet import reactor
+from twisted.web.client import (
+    Agent, FileBodyProducer, HTTPConnectionPool, readBody
+)
+from twisted.web.http_headers import Headers
+
+from gelf import GelfBuilder, GelfTemplate, event_level
+from limits import DEFAULT_LIMITS
+from compression import GzipCompression, NONE
+from txgraylog.buffering import MessageBuffer, INFO
+
+
+class HTTPGelfProtocol(object):
+    """ Graylog Gelf protocol which sends data to a Graylog2 GELF HTTP input.
+        Requests go over persistent connections from an HTTP connection
+        pool, with up to `concurrency` requests in flight at once. Each
+        request carries a single message, or with `batch` as many as
+        `batch_size` messages separated by newlines, for inputs with bulk
+        receiving turned on.
+
+        Messages wait in the buffer until they are sent. If a request fails
+        or the server has an error its messages go back to the front of the
+        buffer and nothing more is sent until a retry delay has passed. The
+        delay grows by `factor` with each failure up to `max_delay`, and
+        goes back to `initial_delay` once a request succeeds. Messages the
+        server rejects as bad requests are dropped rather than retried
+    """
+
+    parameter_override = {}
+    limits = DEFAULT_LIMITS
+
+    def __init__(
+            self, host, port, path='/gelf', scheme='http', batch=False,
+            batch_size=100, flush_delay=0, concurrency=2, compress=True,
+            buffer=None, timeout=30, initial_delay=1.0, max_delay=60.0,
+            factor=2.0):
+        """ Initialize our protocol
+            :param path: the path of the GELF input
+            :param scheme: either http or https
+            :param batch: send up to `batch_size` messages in each request
+            :param flush_delay: the number of seconds a message may wait for
+                a batch to fill
+            :param concurrency: the number of requests in flight at once,
+                which is also the number of connections kept open
+            :param compress: whether to gzip the requests, or one of the
+                strategies from :mod:`~txgraylog.protocol.compression`
+            :param buffer: the :class:`~txgraylog.buffering.MessageBuffer`
+                holding messages until they are sent
+            :param timeout: the number of seconds to wait for a response
+            :param initial_delay: the number of seconds to wait before
+                retrying after the first failure
+            :param max_delay: the longest to wait before retrying
+            :param factor: how much longer to wait after each failure
+        """
+        self.host = host
+        self.port = port
+        self.url = '%s://%s:%d%s' % (scheme, host, port, path)
+
+        self.batch_size = batch_size if batch else 1
+        self.flush_delay = flush_delay
+        self.concurrency = concurrency
+        if compress is True:
+            self._compress = GzipCompression()
+        else:
+            self._compress = compress or NONE
+        self.timeout = timeout
+        self.initial_delay = self.delay = initial_delay
+        self.max_delay = max_delay
+        self.factor = factor
+
+        self.hostname = gethostname()
+        self.buffer = buffer if buffer is not None else MessageBuffer()
+        self.builder = None
+        self.metrics = None
+        self.clock = reactor
+
+        self.pool = HTTPConnectionPool(reactor)
+        self.pool.maxPersistentPerHost = concurrency
+        self.agent = Agent(reactor, pool=self.pool)
+
+        self.connected = False
+        self.in_flight = 0
+        self._flush_call = None
+        self._retry_call = None
+
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.requests = 0
+        self.failures = 0
+        self.rejected = 0
+
+    def connect(self):
+        """ Start sending messages
+        """
+        self.connected = True
+        self.flush()
+
+    def disconnect(self):
+        """ Stop sending messages and close the idle connections. Messages
+            not yet sent stay in the buffer
+        """
+        self.connected = False
+        for call in (self._flush_call, self._retry_call):
+            if call is not None and call.active():
+                call.cancel()
+        self._flush_call = self._retry_call = None
+        return self.pool.closeCachedConnections()
+
+    def log_message(self, event):
+        """ The method to be called when we want to emit a log activity
+            The paramater overide can be set to include extra paramaters
+        """
+        messages = self._encode(event)
+        level = event_level(event)
+        for message in messages:
+            self.send_to_graylog(message, level)
+
+    def encode(self, event):
+        """ Build the uncompressed GELF message to be sent for an event with
+            our builder, which is rebuilt whenever the paramater overide
+            changes
+        """
+        builder = self.builder
+        if (builder is None or
+                builder.template.overrides != self.parameter_override):
+            builder = self.builder = GelfBuilder(
+                GelfTemplate(
+                    self.hostname, self.parameter_override, self.limits),
+                chunk=False, compress=False)
+        return builder.build(event)
+
+    def send_to_graylog(self, message, level=INFO):
+        """ Queue a message, sending a request once there is a full batch
+            or the flush delay has passed
+        """
+        self.buffer.append(str(message), level)
+
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+        elif self._flush_call is None and self.connected:
+            self._flush_call = self.clock.callLater(
+                self.flush_delay, self.flush)
+
+    def send_encoded(self, message, level=INFO):
+        """ Send a GELF message which has already been serialized
+        """
+        self.send_to_graylog(message, level)
+
+    def flush(self):
+        """ Send as many requests as we are allowed to have in flight
+        """
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+
+        while (self.connected and self.in_flight < self.concurrency and
+                len(self.buffer)):
+            entries = []
+            while len(entries) < self.batch_size and len(self.buffer):
+                entries.append(self.buffer.popleft())
+            self._post(entries)
+
+    def _encode(self, event):
+        """ Encode an event, recording how long it took and the size of the
+            messages when we have a :class:`~txgraylog.metrics.Metrics`
+        """
+        metrics = self.metrics
+        if metrics is None:
+            return self.encode(event)
+
+        start = metrics.timer()
+        messages = self.encode(event)
+        metrics.encoded(metrics.timer() - start, [len(m) for m in messages])
+        return messages
+
+    def _post(self, entries):
+        """ Send the `(message, level)` entries in a single request
+        """
+        data = '\n'.join([message for message, _ in entries])
+        body = self._compress.compress(data)
+
+        headers = Headers({'Content-Type': ['application/json']})
+        if body is not data and self._compress.content_encoding:
+            headers.addRawHeader(
+                'Content-Encoding', self._compress.content_encoding)
+
+        self.in_flight += 1
+        self.requests += 1
+        d = self.agent.request(
+            'POST', self.url, headers, FileBodyProducer(StringIO(body)))
+        timeout = self.clock.callLater(self.timeout, d.cancel)
+
+        def response(response):
+            # the body has to be read for the connection to be reused
+            d = readBody(response)
+            d.addCallback(lambda _: response.code)
+            return d
+
+        def done(result):
+            if timeout.active():
+                timeout.cancel()
+            self.in_flight -= 1
+            return result
+
+        d.addCallback(response)
+        d.addBoth(done)
+        d.addCallbacks(
+            self._sent, self._failed, callbackArgs=(entries, len(body)),
+            errbackArgs=(entries, ))
+        return d
+
+    def _sent(self, code, entries, size):
+        """ A request was answered
+        """
+        if code >= 500:
+            self._failed(None, entries)
+            return
+
+        if code >= 400:
+            self.rejected += len(entries)
+        else:
+            self.messages_sent += len(entries)
+            self.bytes_sent += size
+
+        self.delay = self.initial_delay
+        self.flush()
+
+    def _failed(self, reason, entries):
+        """ A request failed, so put its messages back and wait before
+            trying again
+        """
+        self.failures += 1
+        self.buffer.restore(entries)
+
+        if self._retry_call is None and self.connected:
+            self.connected = False
+            self._retry_call = self.clock.callLater(self.delay, self._retry)
+            self.delay = min(self.delay * self.factor, self.max_delay)
+
+    def _retry(self):
+        self._retry_call = None
+        self.connect()
@@ -0,0 +1,171 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+.. module:: limits
+    :platform: Unix, Windows
+    :synopsis: Limits on the size of GELF messages, applied to their fields
+        before they are serialized
+.. moduleauthor:: Adam Drakeford <adamdrakeford@gmail.com>
+"""
+
+import datetime
+from repr import Repr
+
+from twisted.python.failure import Failure
+
+from tracebacks import DEFAULT_TRACEBACKS
+
+NUMBERS = frozenset([int, long, float, bool, type(None)])
+PRIMITIVES = (str, unicode, int, long, float, bool, type(None))
+
+
+class SizeLimits(object):
+    """ Keeps the fields of a GELF message within a size, so that a single
+        huge event can neither take long to serialize and compress nor need
+        more chunks than Graylog accepts. Text longer than `max_field` is
+        cut down, keeping the first and last lines of text with several so
+        that both ends of a traceback survive. Values which are not strings
+        or numbers are summarized as a short description. If the message
+        is still larger than `max_size` its longest fields are shortened
+        further. A message which had anything cut is marked `_truncated`.
+        Tracebacks are formatted through a
+        :class:`~txgraylog.protocol.tracebacks.TracebackCache`
+    """
+
+    def __init__(
+            self, max_field=32768, max_size=131072, max_frames=40,
+            head=0.25, min_field=256, tracebacks=DEFAULT_TRACEBACKS):
+        """ Initialise the limits
+            :param max_field: the most characters kept of any one field
+            :param max_size: the most characters kept over all the fields
+            :param max_frames: the most frames formatted in a traceback,
+                with the rest left out from the middle
+            :param head: the share of a cut down field kept from its start,
+                the rest being kept from its end
+            :param min_field: the length fields are not shortened below to
+                fit the message within `max_size`
+            :param tracebacks: the
+                :class:`~txgraylog.protocol.tracebacks.TracebackCache`
+                reusing formatted tracebacks, or None to format every one
+        """
+        self.max_field = max_field
+        self.max_size = max_size
+        self.max_frames = max_frames
+        self.head = head
+        self.min_field = min_field
+        self.tracebacks = tracebacks
+
+        self._repr = Repr()
+        self._repr.maxstring = self._repr.maxother = min_field
+        self._repr.maxlevel = 3
+
+    def traceback(self, failure):
+        """ Format the traceback of a failure, leaving out the frames in
+            the middle of a deep one rather than formatting them all
+        """
+        frames = failure.frames
+        if len(frames) > self.max_frames:
+            failure = self._trim(failure)
+
+        if self.tracebacks is None:
+            return failure.getTraceback()
+        return self.tracebacks.format(failure)
+
+    def _trim(self, failure):
+        """ Copy a failure with the frames in the middle of its traceback
+            replaced by one saying how many were left out
+        """
+        frames = failure.frames
+        keep_head = max(int(self.max_frames * self.head), 1)
+        keep_tail = self.max_frames - keep_head
+        omitted = len(frames) - keep_head - keep_tail
+
+        trimmed = Failure.__new__(Failure)
+        trimmed.__dict__.update(failure.__dict__)
+        trimmed.frames = frames[:keep_head] + [(
+            '...', '<%d frames omitted>' % (omitted, ), 0, [], []
+        )] + frames[-keep_tail:]
+        return trimmed
+
+    def apply(self, fields):
+        """ Apply the limits to the fields of a GELF message, returning
+            them unchanged when they are within the limits
+        """
+        max_field = self.max_field
+        total = 0
+        changed = None
+
+        for name, value in fields.iteritems():
+            kind = type(value)
+            if kind is not str and kind is not unicode:
+                if kind in NUMBERS or isinstance(value, PRIMITIVES):
+                    continue
+                if changed is None:
+                    changed = {}
+                value = changed[name] = self.summarize(value)
+            if len(value) > max_field:
+                if changed is None:
+                    changed = {}
+                value = changed[name] = self.shorten(value, max_field)
+            total += len(value) + len(name)
+
+        if changed is None and total <= self.max_size:
+            return fields
+
+        fields = dict(fields)
+        fields.update(changed or {})
+        if total > self.max_size:
+            self._fit(fields, total)
+        fields['_truncated'] = True
+        return fields
+
+    def _fit(self, fields, total):
+        """ Shorten the longest text fields until the message fits
+        """
+        sizes = dict(
+            (name, len(value)) for name, value in fields.iteritems()
+            if isinstance(value, basestring))
+        for name in sorted(sizes, key=sizes.get, reverse=True):
+            excess = total - self.max_size
+            if excess <= 0:
+                break
+            size = sizes[name]
+            limit = max(size - excess, self.min_field)
+            if limit < size:
+                fields[name] = self.shorten(fields[name], limit)
+                total -= size - len(fields[name])
+
+    def summarize(self, value):
+        """ Describe a value which is not a string or a number in a bounded
+            amount of time and space
+        """
+        if isinstance(value, Failure):
+            return value.getErrorMessage()
+        if isinstance(value, (datetime.date, datetime.time)):
+            return value.isoformat()
+        return self._repr.repr(value)
+
+    def shorten(self, text, limit):
+        """ Cut text down to `limit` characters, keeping its start and end.
+            Text of several lines is cut at line breaks
+        """
+        if len(text) <= limit:
+            return text
+
+        marker = '\n...\n' if '\n' in text else '...'
+        keep = max(limit - len(marker), 0)
+        keep_head = int(keep * self.head)
+        keep_tail = keep - keep_head
+
+        head = text[:keep_head]
+        tail = text[len(text) - keep_tail:] if keep_tail else text[:0]
+        if marker != '...':
+            if '\n' in head:
+                head = head[:head.rindex('\n')]
+            if '\n' in tail:
+                tail = tail[tail.index('\n') + 1:]
+        return head + marker + tail
+
+
+DEFAULT_LIMITS = SizeLimits()
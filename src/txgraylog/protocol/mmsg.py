@@ -0,0 +1,139 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+.. module:: mmsg
+    :platform: Linux
+    :synopsis: Sending a batch of datagrams on a connected socket with a
+        single sendmmsg system call. Elsewhere, or where the C library has
+        no sendmmsg, `available` is False and datagrams must be written one
+        at a time
+.. moduleauthor:: Adam Drakeford <adamdrakeford@gmail.com>
+"""
+
+import ctypes
+import ctypes.util
+import os
+import socket
+import struct
+import sys
+
+# the most messages the kernel accepts in a single call
+MAX_MESSAGES = 1024
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [
+        ('iov_base', ctypes.c_void_p),
+        ('iov_len', ctypes.c_size_t),
+    ]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_name', ctypes.c_void_p),
+        ('msg_namelen', ctypes.c_uint32),
+        ('msg_iov', ctypes.POINTER(iovec)),
+        ('msg_iovlen', ctypes.c_size_t),
+        ('msg_control', ctypes.c_void_p),
+        ('msg_controllen', ctypes.c_size_t),
+        ('msg_flags', ctypes.c_int),
+    ]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [
+        ('msg_hdr', msghdr),
+        ('msg_len', ctypes.c_uint),
+    ]
+
+
+def _load():
+    """ Find sendmmsg in the C library, or return None
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+
+    try:
+        libc = ctypes.CDLL(
+            ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        func = libc.sendmmsg
+    except (OSError, AttributeError):
+        return None
+
+    func.argtypes = [
+        ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    func.restype = ctypes.c_int
+    return func
+
+
+_sendmmsg = _load()
+available = _sendmmsg is not None
+
+IOVEC_SIZE = ctypes.sizeof(iovec)
+
+
+class BatchSender(object):
+    """ Sends batches of datagrams with sendmmsg. Setting the fields of
+        ctypes structures one at a time costs more than the system calls it
+        saves, so each message header points at its own slot in an array of
+        iovecs which is made once, and a batch only has to pack the address
+        and length of each datagram into those slots. The datagrams are
+        joined into a single string for the kernel to read them from
+    """
+
+    def __init__(self, capacity=MAX_MESSAGES):
+        """ Initialise the sender
+            :param capacity: the most datagrams sent in a single call
+        """
+        self.capacity = min(capacity, MAX_MESSAGES)
+        self.calls = 0
+        self._iovecs = ctypes.create_string_buffer(
+            IOVEC_SIZE * self.capacity)
+        self._messages = (mmsghdr * self.capacity)()
+        iovecs = ctypes.cast(self._iovecs, ctypes.POINTER(iovec))
+        for i in xrange(self.capacity):
+            header = self._messages[i].msg_hdr
+            header.msg_iov = ctypes.pointer(iovecs[i])
+            header.msg_iovlen = 1
+        self._formats = {}
+
+    def send(self, sock, datagrams, start=0):
+        """ Send the datagrams from `start` onwards on a connected socket,
+            as many as the kernel will take in one call, and return how many
+            were sent. Raises :class:`socket.error` when not even the first
+            could be sent
+            :param sock: the connected socket
+            :param datagrams: a list of strings
+        """
+        count = min(len(datagrams) - start, self.capacity)
+        if count <= 0:
+            return 0
+
+        batch = datagrams[start:start + count]
+        data = ''.join(batch)
+        address = ctypes.cast(ctypes.c_char_p(data), ctypes.c_void_p).value
+        slots = []
+        append = slots.append
+        for datagram in batch:
+            size = len(datagram)
+            append(address)
+            append(size)
+            address += size
+        self._format(count).pack_into(self._iovecs, 0, *slots)
+
+        self.calls += 1
+        sent = _sendmmsg(sock.fileno(), self._messages, count, 0)
+        if sent < 0:
+            code = ctypes.get_errno()
+            raise socket.error(code, os.strerror(code))
+        return sent
+
+    def _format(self, count):
+        """ The struct packing the address and length of `count` datagrams
+        """
+        fmt = self._formats.get(count)
+        if fmt is None:
+            # size_t is an unsigned long on Linux
+            fmt = self._formats[count] = struct.Struct('PL' * count)
+        return fmt
@@ -0,0 +1,140 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+.. module:: relay
+    :platform: Unix
+    :synopsis: Graylog relay protocol, for worker processes sending their
+        messages through a single relay on the same host
+.. moduleauthor:: Adam Drakeford <adamdrakeford@gmail.com>
+"""
+
+from twisted.internet import defer, reactor
+from twisted.internet.protocol import (
+    Factory, Protocol, ReconnectingClientFactory
+)
+
+from tcp import TCPGelfProtocol, TCPGraylogFactory
+from txgraylog.buffering import INFO
+
+
+def frame_level(level):
+    """ The level a message is framed with, as the relay reads a single
+        digit. Syslog levels run from 0 to 7, so a number outside 0 to 9 is
+        clamped, and a level which is not a number, such as 'warning', is
+        sent as INFO
+    """
+    try:
+        level = int(level)
+    except (TypeError, ValueError):
+        return INFO
+    return min(max(level, 0), 9)
+
+
+class RelayGelfProtocol(TCPGelfProtocol):
+    """ Graylog Gelf protocol which sends the messages of a worker process
+        to a local relay over a Unix socket, rather than each worker keeping
+        its own connections to Graylog. Messages are serialized in the
+        worker, so the relay only has to batch, compress and forward them.
+        Each one is framed as its level as a single digit followed by the
+        GELF message and a null byte, see :func:`frame_level`
+    """
+
+    def __init__(self, path, port=None, coalesce=True, **kwargs):
+        """ Initialize our protocol
+            :param path: the path of the relay's Unix socket
+            :param port: unused, so that the protocol can be created by the
+                observer like any other
+            :param coalesce: write the messages to the socket in batches
+        """
+        TCPGelfProtocol.__init__(
+            self, path, port, coalesce=coalesce, **kwargs)
+        self.path = path
+        self.resolver = None
+
+    def send_to_graylog(self, message, level=INFO):
+        """ Send a message to the relay, or buffer it while we are
+            disconnected
+        """
+        level = frame_level(level)
+        TCPGelfProtocol.send_to_graylog(
+            self, '%d%s\x00' % (level, message), level)
+
+
+class RelayClientFactory(TCPGraylogFactory):
+    """ Connects to the relay's Unix socket, reconnecting whenever the
+        connection is lost
+    """
+
+    def connect(self):
+        reactor.connectUNIX(self.protocol.path, self)
+        return defer.succeed(None)
+
+    def retry(self, connector=None):
+        ReconnectingClientFactory.retry(self, connector)
+
+
+class RelayReceiver(Protocol):
+    """ Receives the messages of a single worker
+    """
+
+    def connectionMade(self):
+        self._partial = ''
+        self.factory.workers += 1
+        self.factory.connects += 1
+
+    def connectionLost(self, reason):
+        self.factory.workers -= 1
+
+    def dataReceived(self, data):
+        records = (self._partial + data).split('\x00')
+        self._partial = records.pop()
+        if len(self._partial) > self.factory.max_length:
+            self.factory.oversized += 1
+            self._partial = ''
+            self.transport.loseConnection()
+
+        for record in records:
+            if record:
+                self.factory.forward(record)
+
+
+class RelayFactory(Factory):
+    """ Accepts connections from the workers and forwards their messages
+        upstream with a Gelf protocol, or a pool of them, which batches and
+        compresses them as it would its own
+    """
+
+    protocol = RelayReceiver
+
+    def __init__(self, upstream, metrics=None, max_length=1048576):
+        """ Initialise the relay
+            :param upstream: the protocol whose `send_encoded` method sends
+                the messages on to Graylog
+            :param metrics: the :class:`~txgraylog.metrics.Metrics` counting
+                the messages as events
+            :param max_length: the longest message a worker may send, beyond
+                which its connection is dropped
+        """
+        self.upstream = upstream
+        self.metrics = metrics
+        self.max_length = max_length
+
+        self.workers = 0
+        self.connects = 0
+        self.received = 0
+        self.oversized = 0
+        self.errors = 0
+
+    def forward(self, record):
+        """ Send on a framed message from a worker
+        """
+        level = ord(record[0]) - 48
+        if not 0 <= level <= 9:
+            self.errors += 1
+            return
+
+        self.received += 1
+        if self.metrics is not None:
+            self.metrics.events += 1
+        self.upstream.send_encoded(record[1:], level)
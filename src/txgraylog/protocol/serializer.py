@@ -0,0 +1,165 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+.. module:: serializer
+    :platform: Unix, Windows
+    :synopsis: JSON serializers for GELF messages. The fastest backend
+        installed is chosen when the module is imported
+.. moduleauthor:: Adam Drakeford <adamdrakeford@gmail.com>
+"""
+
+import datetime
+import json as stdlib_json
+
+from twisted.python import failure, reflect
+
+BACKENDS = ('orjson', 'ujson', 'simplejson', 'json')
+# fastest first, as measured by benchmarks/bench_serializer.py
+PREFERENCE = ('orjson', 'ujson', 'json')
+# backends with their own C encoders rather than a stdlib style JSONEncoder
+NATIVE = ('orjson', 'ujson')
+
+
+def default(obj):
+    """ Turn a value JSON has no representation for into one it has. Log
+        events often carry failures and arbitrary objects, and a message with
+        a summary of them is better than no message at all
+    """
+    if isinstance(obj, failure.Failure):
+        return obj.getErrorMessage()
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if isinstance(obj, (datetime.datetime, datetime.date, datetime.time)):
+        return obj.isoformat()
+    return reflect.safe_str(obj)
+
+
+class _Unknown(object):
+    def __str__(self):
+        return 'unknown'
+
+
+# every backend must turn this into the same document as the standard
+# library, so one which mangles control characters or cannot cope with
+# UTF-8 byte strings is never used
+PROBE = {
+    'text': u'caf\xe9',
+    'bytes': 'caf\xc3\xa9',
+    'control': '\x00\x1f"\\/',
+    'int': 2 ** 40,
+    'float': 1434567890.25,
+    'bool': True,
+    'none': None,
+    'nested': {'list': [1, 'a', {}]},
+    'unknown': _Unknown(),
+}
+EXPECTED = stdlib_json.loads(stdlib_json.dumps(PROBE, default=default))
+
+
+def _encoder(module):
+    """ Build a dumps function from a module with a stdlib style
+        JSONEncoder. Byte strings which are not UTF-8 are read as latin-1
+        rather than failing the whole message
+    """
+    options = dict(
+        separators=(',', ':'), check_circular=False, default=default)
+    encode = module.JSONEncoder(**options).encode
+    fallback = module.JSONEncoder(encoding='latin-1', **options).encode
+
+    def dumps(obj):
+        try:
+            return encode(obj)
+        except UnicodeDecodeError:
+            return fallback(obj)
+    return dumps
+
+
+def _fallback(encode):
+    """ Wrap the dumps function of a third party backend so that anything
+        it refuses, such as integers too big for it, goes to the standard
+        library instead
+    """
+    def dumps(obj):
+        try:
+            return encode(obj)
+        except (TypeError, ValueError, OverflowError):
+            return _stdlib(obj)
+    return dumps
+
+
+def _load(name):
+    """ Import a backend and build its dumps function
+    """
+    if name == 'json':
+        return _stdlib
+    elif name == 'simplejson':
+        import simplejson
+        return _encoder(simplejson)
+    elif name == 'ujson':
+        import ujson
+
+        def dumps(obj):
+            return ujson.dumps(
+                obj, ensure_ascii=True, escape_forward_slashes=False,
+                default=default)
+        return dumps
+    elif name == 'orjson':
+        import orjson
+
+        def dumps(obj):
+            return orjson.dumps(obj, default=default)
+        return dumps
+    raise ValueError('unknown JSON backend %r' % (name, ))
+
+
+def get_backend(name):
+    """ Get the dumps function of a backend. Raises ImportError if the
+        backend is not installed and ValueError if it does not produce the
+        same documents as the standard library
+    """
+    dumps = _load(name)
+    try:
+        output = dumps(PROBE)
+        valid = isinstance(output, bytes) and (
+            stdlib_json.loads(output) == EXPECTED)
+    except Exception:
+        valid = False
+    if not valid:
+        raise ValueError('JSON backend %r failed its self check' % (name, ))
+    if name in NATIVE:
+        return _fallback(dumps)
+    return dumps
+
+
+def available():
+    """ The names of the backends which are installed and usable
+    """
+    names = []
+    for name in BACKENDS:
+        try:
+            get_backend(name)
+        except (ImportError, ValueError):
+            continue
+        names.append(name)
+    return names
+
+
+def use(name):
+    """ Serialize all GELF messages with the named backend from now on
+    """
+    global backend, dumps
+    dumps = get_backend(name)
+    backend = name
+
+
+def _select():
+    for name in PREFERENCE:
+        try:
+            return name, get_backend(name)
+        except (ImportError, ValueError):
+            continue
+
+
+_stdlib = _encoder(stdlib_json)
+backend, dumps = _select()
@@ -8,68 +8,244 @@
 .. moduleauthor:: Adam Drakeford <adamdrakeford@gmail.com>
 """
 
-from collections import deque
+import time
 from socket import gethostname
 
+from zope.interface import implementer
+from twisted.internet import reactor
+from twisted.internet.interfaces import IPushProducer
 from twisted.internet.protocol import Protocol, ReconnectingClientFactory
 
-from gelf import GelfProtocol
+from gelf import GelfBuilder, GelfTemplate, event_level
+from limits import DEFAULT_LIMITS
+from txgraylog.buffering import MessageBuffer, INFO
+from txgraylog.resolver import Resolver
 
+ROUND_ROBIN, LEAST_BUFFERED = 0, 1
 
+
+@implementer(IPushProducer)
 class TCPPlainTextProtocol(Protocol):
     """ Plain Text protocol which generates and sends raw text
-        data to a Graylog2 server
+        data to a Graylog2 server. It registers itself as a producer with
+        its transport, so that when Graylog reads more slowly than we write
+        messages are held in our bounded buffer rather than in the
+        transport's unbounded one
     """
 
     parameter_override = {}
 
-    def __init__(self, host, port):
+    def __init__(
+            self, host, port, buffer=None, coalesce=False, flush_size=65536,
+            flush_delay=0, resolver=None, write_buffer=262144):
         """ Initialize our protocol
+            :param buffer: the :class:`~txgraylog.buffering.MessageBuffer`
+                holding messages while we are disconnected
+            :param coalesce: collect messages and write them to the socket
+                in batches rather than one at a time
+            :param flush_size: the number of pending bytes at which a batch
+                is written out straight away
+            :param flush_delay: the number of seconds a message may wait for
+                its batch to fill. The default of 0 flushes at the end of the
+                current reactor iteration
+            :param resolver: the :class:`~txgraylog.resolver.Resolver`
+                keeping the addresses of the host, which may be shared with
+                other protocols to spread them over the addresses
+            :param write_buffer: the number of bytes the transport may hold
+                before it pauses us, or None for Twisted's default of 64KB.
+                A transport only sends its buffer once per reactor
+                iteration, so this caps the bytes sent in each one
         """
         self.host = host
         self.port = port
+        self.resolver = resolver if resolver is not None else Resolver(host)
 
         self.connected = False
+        self.paused = False
 
         self.hostname = gethostname()
-        self.buffer = deque(maxlen=1000)
+        self.buffer = buffer if buffer is not None else MessageBuffer()
+
+        self.coalesce = coalesce
+        self.flush_size = flush_size
+        self.flush_delay = flush_delay
+        self.write_buffer = write_buffer
+        self.clock = reactor
+
+        self._pending = []
+        self._pending_size = 0
+        self._flush_call = None
+
+        self.messages_sent = 0
+        self.bytes_sent = 0
+        self.connects = 0
+        self.disconnects = 0
+        self.pauses = 0
+        self.paused_time = 0
+        self.metrics = None
+        self._paused_at = None
 
     def connectionMade(self):
         """ Connection made to Graylog server
         """
         self.connected = True
-
-        while True:
-            try:
-                event = self.buffer.pop()
-                self.send_to_graylog(event)
-            except IndexError:
-                break
+        self.connects += 1
+        self.paused = False
+        if self.write_buffer is not None:
+            self.transport.bufferSize = self.write_buffer
+        self.transport.registerProducer(self, True)
+        self._drain()
 
     def connectionLost(self, reason):
-        """ Connection lost to Graylog server
+        """ Connection lost to Graylog server. Any batch still waiting to be
+            written is kept for when we reconnect
         """
         self.connected = False
+        self.disconnects += 1
+        self._unpause()
+        self.buffer.restore(self._take_pending())
 
-    def send_to_graylog(self, message):
-        """ Write the data to socket
+    def send_to_graylog(self, message, level=INFO):
+        """ Write the data to socket, or buffer it while we are disconnected,
+            paused or still have buffered messages to send
         """
         message = str(message)
         if not message.endswith('\x00'):
             message += '\x00'
 
-        if not self.connected:
-            self.buffer.append(message)
+        if not self.connected or self.paused or len(self.buffer):
+            self.buffer.append(message, level)
+            return
+
+        self._write(message, level)
+
+    def _write(self, message, level):
+        """ Write a framed message to the socket, or add it to the pending
+            batch when coalescing
+        """
+        self.messages_sent += 1
+        self.bytes_sent += len(message)
+
+        if not self.coalesce:
+            self.transport.write(message)
+            return
+
+        self._pending.append((message, level))
+        self._pending_size += len(message)
+
+        if self._pending_size >= self.flush_size:
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = self.clock.callLater(
+                self.flush_delay, self.flush)
+
+    def flush(self):
+        """ Write any pending messages to the socket in a single write
+        """
+        pending = self._take_pending()
+        if pending:
+            self.transport.write(''.join([m for m, _ in pending]))
+
+    def pauseProducing(self):
+        """ The transport's write buffer is full. Stop writing to it until
+            it has drained, buffering messages in the meantime. A batch
+            already pending is still written when it is due
+        """
+        if self.paused:
+            return
+        self.paused = True
+        self.pauses += 1
+        self._paused_at = self.clock.seconds()
+
+    def resumeProducing(self):
+        """ The transport's write buffer has drained. Send the messages we
+            buffered while paused, ahead of any new ones
+        """
+        if not self.paused:
             return
+        self._unpause()
+        self._drain()
+
+    def _drain(self):
+        """ Write buffered messages until there are none left or the
+            transport pauses us again. The transport's own buffer paces
+            this, so it is not spread over reactor iterations, which would
+            let messages arrive faster than they are sent
+        """
+        buffer = self.buffer
+        while self.connected and not self.paused and len(buffer):
+            message, level = buffer.popleft()
+            buffer.replayed += 1
+            self._write(message, level)
+
+    def stopProducing(self):
+        """ The connection is closing, which `connectionLost` deals with
+        """
 
-        self.transport.write(message)
+    def paused_seconds(self):
+        """ The total number of seconds we have spent paused, including any
+            pause still going on
+        """
+        if self._paused_at is None:
+            return self.paused_time
+        return self.paused_time + self.clock.seconds() - self._paused_at
+
+    def _unpause(self):
+        """ End any pause, adding its length to our total
+        """
+        self.paused_time = self.paused_seconds()
+        self._paused_at = None
+        self.paused = False
+
+    def pending_bytes(self):
+        """ The number of bytes waiting to be written, both in our pending
+            batch and in the transport's own write buffer
+        """
+        transport = self.transport
+        return self._pending_size + (
+            len(getattr(transport, 'dataBuffer', '')) -
+            getattr(transport, 'offset', 0) +
+            getattr(transport, '_tempDataLen', 0))
+
+    def _take_pending(self):
+        """ Cancel any scheduled flush and hand back the pending messages
+            with their levels
+        """
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+
+        pending, self._pending, self._pending_size = self._pending, [], 0
+        return pending
 
     def log_message(self, event):
         """ The method to be called when we want to emit a log activity
             The paramater overide can be set to include extra paramaters
         """
+        messages = self._encode(event)
+        level = event_level(event)
+        for message in messages:
+            self.send_to_graylog(message, level)
+
+    def _encode(self, event):
+        """ Encode an event, recording how long it took and the size of the
+            messages when we have a :class:`~txgraylog.metrics.Metrics`
+        """
+        metrics = self.metrics
+        if metrics is None:
+            return self.encode(event)
+
+        start = metrics.timer()
+        messages = self.encode(event)
+        metrics.encoded(metrics.timer() - start, [len(m) for m in messages])
+        return messages
+
+    def encode(self, event):
+        """ Build the messages to be sent for an event. This does not touch
+            the transport so it is safe to call outside the reactor thread
+        """
         event.update(self.parameter_override)
-        self.send_to_graylog(event)
+        return [str(event)]
 
 
 class TCPGelfProtocol(TCPPlainTextProtocol):
@@ -77,28 +253,66 @@ class TCPGelfProtocol(TCPPlainTextProtocol):
         Graylog2 server using the Gelf protocol over TCP
     """
 
-    def log_message(self, event):
-        """ The method to be called when we want to emit a log activity
-            The paramater overide can be set to include extra paramaters
+    builder = None
+    limits = DEFAULT_LIMITS
+
+    def encode(self, event):
+        """ Build the uncompressed GELF message to be sent for an event with
+            our builder, which is rebuilt whenever the paramater overide
+            changes
         """
-        event.update(self.parameter_override)
-        gelf = GelfProtocol(
-            self.hostname, chunk=False, compress=False, **event).generate()
-        for message in gelf:
-            self.send_to_graylog(message)
+        builder = self.builder
+        if (builder is None or
+                builder.template.overrides != self.parameter_override):
+            builder = self.builder = GelfBuilder(
+                GelfTemplate(
+                    self.hostname, self.parameter_override, self.limits),
+                chunk=False, compress=False)
+        return builder.build(event)
+
+    def send_encoded(self, message, level=INFO):
+        """ Send a GELF message which has already been serialized
+        """
+        self.send_to_graylog(message, level)
 
 
 class TCPGraylogFactory(ReconnectingClientFactory):
 
     def __init__(self, protocol):
         self.protocol = protocol
+        self.reconnects = 0
+
+    def connect(self):
+        """ Resolve the host of our protocol and connect to one of its
+            addresses, or to the host name itself if it cannot be resolved
+        """
+        d = self.protocol.resolver.start()
+        d.addErrback(lambda _: None)
+        d.addCallback(lambda _: reactor.connectTCP(
+            self._address(), self.protocol.port, self))
+        return d
+
+    def retry(self, connector=None):
+        """ Reconnect to the next of the addresses we have for the host,
+            which the resolver keeps up to date in the background
+        """
+        if connector is not None:
+            connector.host = self._address()
+        ReconnectingClientFactory.retry(self, connector)
+
+    def _address(self):
+        resolver = getattr(self.protocol, 'resolver', None)
+        address = resolver.choose() if resolver is not None else None
+        return address if address is not None else self.protocol.host
 
     def clientConnectionLost(self, connector, reason):
+        self.reconnects += 1
         ReconnectingClientFactory.clientConnectionLost(
             self, connector, reason
         )
 
     def clientConnectionFailed(self, connector, reason):
+        self.reconnects += 1
         ReconnectingClientFactory.clientConnectionFailed(
             self, connector, reason
         )
@@ -106,3 +320,129 @@ class TCPGraylogFactory(ReconnectingClientFactory):
     def buildProtocol(self, addr):
         self.resetDelay()
         return self.protocol
+
+
+class TCPConnectionPool(object):
+    """ Spreads messages over several TCP connections to one or more Graylog
+        endpoints. Connections are shared between the endpoints in turn and
+        each one reconnects on its own. Connections which are down are taken
+        out of rotation until they reconnect
+    """
+
+    def __init__(
+            self, protocol, endpoints, size=1, balance=ROUND_ROBIN, **kwargs):
+        """ Initialise the pool
+            :param protocol: the TCP protocol class to use for each connection
+            :param endpoints: a list of `(host, port)` tuples
+            :param size: the total number of connections to keep open
+            :param balance: how to pick the connection for each message,
+                either ROUND_ROBIN or LEAST_BUFFERED for the connection with
+                the fewest bytes waiting to be written
+            :param kwargs: extra options passed through to each protocol
+        """
+        if 'buffer' in kwargs:
+            raise ValueError('Each pooled connection keeps its own buffer')
+        if 'resolver' in kwargs:
+            raise ValueError('Pooled connections share a resolver per host')
+
+        self.balance = balance
+        # connections to the same host share a resolver, so that they are
+        # spread over its addresses
+        resolvers = {}
+        self.protocols = []
+        for i in xrange(max(size, len(endpoints))):
+            host, port = endpoints[i % len(endpoints)]
+            if host not in resolvers:
+                resolvers[host] = Resolver(host)
+            self.protocols.append(protocol(
+                host, port, **dict(kwargs, resolver=resolvers[host])))
+        self.factories = []
+
+        self._next = 0
+        self._last_stats = time.time()
+        self._last_sent = [0] * len(self.protocols)
+
+    def connect(self):
+        """ Open each of the connections
+        """
+        for protocol in self.protocols:
+            factory = TCPGraylogFactory(protocol)
+            self.factories.append(factory)
+            factory.connect()
+
+    def log_message(self, event):
+        """ The method to be called when we want to emit a log activity
+        """
+        protocol = self._choose()
+        messages = protocol._encode(event)
+        level = event_level(event)
+        for message in messages:
+            protocol.send_to_graylog(message, level)
+
+    def encode(self, event):
+        """ Build the messages to be sent for an event
+        """
+        return self.protocols[0].encode(event)
+
+    def send_to_graylog(self, message, level=INFO):
+        """ Send a message over one of the connections
+        """
+        self._choose().send_to_graylog(message, level)
+
+    def send_encoded(self, message, level=INFO):
+        """ Send a serialized GELF message over one of the connections
+        """
+        self._choose().send_encoded(message, level)
+
+    def stats(self):
+        """ Get the health and throughput of each connection. The rate is
+            the number of messages sent per second since the last call
+        """
+        now = time.time()
+        elapsed = max(now - self._last_stats, 1e-9)
+        self._last_stats = now
+
+        stats = []
+        for i, protocol in enumerate(self.protocols):
+            factory = self.factories[i] if self.factories else None
+            stats.append({
+                'host': protocol.host,
+                'port': protocol.port,
+                'connected': protocol.connected,
+                'paused': protocol.paused,
+                'pauses': protocol.pauses,
+                'connects': protocol.connects,
+                'disconnects': protocol.disconnects,
+                'retries': factory.retries if factory else 0,
+                'retry_delay': factory.delay if factory else 0,
+                'messages_sent': protocol.messages_sent,
+                'bytes_sent': protocol.bytes_sent,
+                'messages_per_second': (
+                    protocol.messages_sent - self._last_sent[i]) / elapsed,
+                'pending_bytes': (
+                    protocol.pending_bytes() if protocol.connected else 0),
+                'buffered': len(protocol.buffer),
+            })
+            self._last_sent[i] = protocol.messages_sent
+        return stats
+
+    def _choose(self):
+        """ Pick the connection for the next message, passing over those
+            which are down or paused. If none is left we carry on in
+            turn so the messages are shared between their buffers
+        """
+        protocols = self.protocols
+        if self.balance == LEAST_BUFFERED:
+            connected = [p for p in protocols if p.connected]
+            if connected:
+                return min(connected, key=lambda p: p.pending_bytes())
+
+        for _ in xrange(len(protocols)):
+            protocol = protocols[self._next]
+            self._next = (self._next + 1) % len(protocols)
+            if protocol.connected and not protocol.paused:
+                return protocol
+
+        protocol = protocols[self._next]
+        self._next = (self._next + 1) % len(protocols)
+        return protocol
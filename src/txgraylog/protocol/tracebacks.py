@@ -0,0 +1,98 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+.. module:: tracebacks
+    :platform: Unix, Windows
+    :synopsis: A cache of formatted tracebacks, so that the same failure
+        raised over and over is only formatted once
+.. moduleauthor:: Adam Drakeford <adamdrakeford@gmail.com>
+"""
+
+import threading
+from collections import OrderedDict
+
+from twisted.python import reflect
+from twisted.python.failure import Failure, traceupLength
+
+
+class TracebackCache(object):
+    """ Reuses the formatted tracebacks of failures. A traceback is the
+        frames the failure passed through followed by a line with its
+        type and value. Failures raised at the same place have the same
+        frames, so everything before the last line is kept, keyed on the
+        type and the function, file and line of each frame, and only the
+        last line is formatted for each failure. The text is the same as
+        :meth:`Failure.getTraceback` would give.
+
+        The `max_size` most recently used tracebacks are kept. Encoding may
+        happen in other threads, so the cache is locked while it is looked
+        up or changed, though not while a traceback is formatted
+    """
+
+    def __init__(self, max_size=256):
+        """ Initialise the cache
+            :param max_size: the most tracebacks kept
+        """
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def format(self, failure):
+        """ Format the traceback of a failure, reusing the frames of one
+            formatted before
+        """
+        if isinstance(failure.value, Failure):
+            # chained failures are rare enough not to be worth caching
+            return failure.getTraceback()
+
+        key = self.fingerprint(failure)
+        last = '%s: %s\n' % (
+            reflect.qual(failure.type), reflect.safe_str(failure.value))
+
+        with self._lock:
+            frames = self._entries.pop(key, None)
+            if frames is not None:
+                self._entries[key] = frames
+                self.hits += 1
+                return frames + last
+            self.misses += 1
+
+        text = failure.getTraceback()
+        if not text.endswith(last):
+            return text
+
+        with self._lock:
+            self._entries[key] = text[:-len(last)]
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+        return text
+
+    def fingerprint(self, failure):
+        """ The type of a failure and the function, file and line of each
+            frame its traceback shows
+        """
+        # the frames of a cleaned failure are lists rather than tuples
+        return (
+            failure.type,
+            tuple([
+                (f[0], f[1], f[2]) for f in failure.stack[-traceupLength:]]),
+            tuple([(f[0], f[1], f[2]) for f in failure.frames]),
+        )
+
+    def clear(self):
+        """ Forget every traceback, keeping the counts
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+DEFAULT_TRACEBACKS = TracebackCache()
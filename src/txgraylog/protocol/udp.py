@@ -8,22 +8,100 @@
 .. moduleauthor:: Adam Drakeford <adamdrakeford@gmail.com>
 """
 
+import errno
+import socket
 from collections import deque
 from socket import gethostname
 
-from gelf import GelfProtocol
+import mmsg
+from gelf import GelfBuilder, GelfTemplate, event_level
+from limits import DEFAULT_LIMITS
 from twisted.internet import protocol, reactor
 
+from txgraylog.buffering import MessageBuffer, INFO
+from txgraylog.resolver import Resolver
+
+MIN_WAIT = 0.001
+# a token, allowing for rounding in the time which has passed
+TOKEN = 1 - 1e-9
+
+
+def datagram_size(datagram):
+    """ The size in bytes of a datagram, which may be a tuple of buffers
+    """
+    if isinstance(datagram, tuple):
+        return sum([len(part) for part in datagram])
+    return len(datagram)
+
+
+def flatten(datagram):
+    """ Join a datagram which is a tuple of buffers into a string
+    """
+    if isinstance(datagram, tuple):
+        return ''.join([
+            part.tobytes() if isinstance(part, memoryview) else part
+            for part in datagram])
+    return datagram
+
+
+def buffered(datagrams):
+    """ The buffer entry for the datagrams of a message, which is a tuple
+        of them when there are several so that the message is kept whole
+    """
+    datagrams = [flatten(datagram) for datagram in datagrams]
+    if len(datagrams) == 1:
+        return datagrams[0]
+    return tuple(datagrams)
+
+
+def unbuffered(message):
+    """ The datagrams of a message taken from the buffer
+    """
+    if isinstance(message, tuple):
+        return message
+    return (message, )
+
 
 class UDPPlainTextProtocol(protocol.DatagramProtocol):
     """ Plain Text protocol which generates and sends raw text
-        data to a Graylog2 server
+        data to a Graylog2 server. Datagrams can be paced to a number of
+        packets or bytes a second, so that bursts do not overrun the socket
+        buffers of the kernel or of Graylog. Paced messages wait in a queue
+        and are sent whole, keeping the chunks of a message together, with
+        the reactor free between each batch. Once the queue is full further
+        messages go to the buffer, which keeps, drops and replays the chunks
+        of each message together. On Linux the datagrams written during a
+        reactor iteration can be coalesced and sent with a single sendmmsg
+        system call
     """
 
     parameter_override = {}
 
-    def __init__(self, host, port):
+    def __init__(
+            self, host, port, buffer=None, resolver=None, packet_rate=None,
+            byte_rate=None, burst=0.05, queue_size=1000, send_buffer=None,
+            coalesce=False, batch_size=64):
         """ Initialize our protocol
+            :param buffer: the :class:`~txgraylog.buffering.MessageBuffer`
+                holding messages until the socket is connected
+            :param resolver: the :class:`~txgraylog.resolver.Resolver`
+                keeping the addresses of the host, which may be shared with
+                other protocols to spread them over the addresses
+            :param packet_rate: the most datagrams to send a second, or None
+                for no limit
+            :param byte_rate: the most bytes to send a second, or None for
+                no limit
+            :param burst: the number of seconds' worth of datagrams which may
+                be sent at once after a quiet period
+            :param queue_size: the number of paced messages which may wait
+                to be sent before further messages are buffered
+            :param send_buffer: the size in bytes to make the socket's send
+                buffer, or None to leave it as it is
+            :param coalesce: collect the datagrams written during a reactor
+                iteration and send them with sendmmsg. Where sendmmsg is
+                not available datagrams are written one at a time
+            :param batch_size: the number of collected datagrams at which
+                they are sent straight away
         """
         self.host = host
         self.port = port
@@ -32,59 +110,309 @@ class UDPPlainTextProtocol(protocol.DatagramProtocol):
         self.started = False
         self.connected = False
         self.host_address = None
+        self.resolver = resolver if resolver is not None else Resolver(host)
+        self.readdressed = 0
 
         self.hostname = gethostname()
-        self.buffer = deque(maxlen=1000)
+        self.buffer = buffer if buffer is not None else MessageBuffer()
+        self.metrics = None
+
+        self.packet_rate = packet_rate
+        self.byte_rate = byte_rate
+        self.burst = burst
+        self.queue_size = queue_size
+        self.send_buffer = send_buffer
+        self.clock = reactor
+
+        self.coalesce = coalesce
+        self.batch_size = batch_size
+        self.sender = None
+        if coalesce and mmsg.available:
+            self.sender = mmsg.BatchSender(batch_size)
+
+        self.refused = 0
+        self.send_dropped = 0
+
+        self._queue = deque()
+        self._packet_tokens = self._capacity(packet_rate)
+        self._byte_tokens = self._capacity(byte_rate)
+        self._refilled = None
+        self._pace_call = None
+        self._batch = []
+        self._flush_call = None
 
         reactor.callWhenRunning(self.resolve)
 
+    @property
+    def paced(self):
+        """ Whether datagrams are paced
+        """
+        return self.packet_rate is not None or self.byte_rate is not None
+
     def connect(self):
         """ Connect our UDP socket.We do this so that we can accept a hostname
             as the host parameter without becoming incredibly slow due to DNS
             lookups on each send
         """
         if self.resolved and self.started and not self.connected:
+            self.host_address = self.resolver.choose(self._family())
+            if self.host_address is None:
+                return
             self.transport.connect(self.host_address, self.port)
             self.connected = True
-
-            while True:
-                try:
-                    event = self.buffer.pop()
-                    self.send_to_graylog(event)
-                except IndexError:
-                    break
+            if self.paced:
+                self._pace()
+            else:
+                self.buffer.replay(self._write)
 
     def resolve(self):
-        """ Resolve the host IP address to avoid to many DNS queries
+        """ Resolve the host IP address to avoid to many DNS queries. The
+            resolver looks the host up again in the background whenever its
+            addresses expire, and we follow them when they change
+        """
+        self.resolver.subscribe(self._addresses_changed)
+        return self.resolver.start()
+
+    def _addresses_changed(self, addresses):
+        """ The addresses of the host changed. Unless the one we are sending
+            to is still among them, point the socket at a new one
         """
-        d = reactor.resolve(self.host)
-        d.addCallback(lambda r: setattr(self, 'host_address', r))
-        d.addCallback(lambda _: setattr(self, 'resolved', True))
-        d.addCallback(lambda _: self.connect())
-        return d
+        self.resolved = True
+        if not self.connected:
+            self.connect()
+            return
+
+        if self.host_address in addresses:
+            return
+
+        address = self.resolver.choose(self._family())
+        if address is None:
+            return
+
+        # twisted refuses to connect a port a second time, but the socket
+        # itself can simply be connected to the new address
+        self.transport._connectedAddr = None
+        self.transport.connect(address, self.port)
+        self.host_address = address
+        self.readdressed += 1
+
+    def _family(self):
+        """ The address family of our socket
+        """
+        return getattr(self.transport, 'addressFamily', socket.AF_INET)
 
     def startProtocol(self):
         """ Start the protocol and keep track of the state
         """
         self.started = True
+        if self.send_buffer is not None:
+            self.transport.socket.setsockopt(
+                socket.SOL_SOCKET, socket.SO_SNDBUF, self.send_buffer)
         self.connect()
 
-    def send_to_graylog(self, message):
-        """ Write the data to socket
+    def stopProtocol(self):
+        """ Stop pacing, keeping any messages still waiting, and send the
+            datagrams collected so far while the socket is still open
         """
-        if not self.connected:
-            self.buffer.append(str(message))
+        if self._pace_call is not None and self._pace_call.active():
+            self._pace_call.cancel()
+        self._pace_call = None
+        self.flush()
+
+    def connectionRefused(self):
+        """ Graylog's port was unreachable, so the datagram was not sent
+        """
+        self.refused += 1
+
+    def send_to_graylog(self, message, level=INFO):
+        """ Write the data to socket, or buffer it until we are connected
+            and have replayed the buffer
+        """
+        self._send([str(message)], level)
+
+    def send_messages(self, messages, level=INFO):
+        """ Send the datagrams of a single message together, so that pacing
+            never waits between its chunks
+        """
+        self._send(messages, level)
+
+    def _send(self, datagrams, level):
+        """ Send the datagrams of a message straight away, queue them to be
+            paced or buffer them until we are connected and have replayed
+            the buffer
+        """
+        if (not self.connected or self.buffer.replaying or
+                (self.paced and (
+                    len(self.buffer) or
+                    len(self._queue) >= self.queue_size))):
+            self.buffer.append(buffered(datagrams), level)
             return
 
+        if self.paced:
+            self._queue.append(datagrams)
+            if self._pace_call is None:
+                self._pace()
+            return
+
+        for datagram in datagrams:
+            self._transmit(datagram)
+
+    def _write(self, message, level):
+        """ Write the datagrams of a buffered message to the socket
+        """
         if self.transport:
-            self.transport.write(str(message))
+            for datagram in unbuffered(message):
+                self._transmit(datagram)
+
+    def _transmit(self, datagram):
+        """ Write a datagram, which may be a tuple of buffers for a
+            scatter/gather write, counting those the kernel had no room for.
+            When coalescing the datagram is added to the batch instead
+        """
+        if self.sender is not None:
+            self._batch.append(flatten(datagram))
+            if len(self._batch) >= self.batch_size:
+                self.flush()
+            elif self._flush_call is None:
+                self._flush_call = self.clock.callLater(0, self.flush)
+            return
+
+        try:
+            if isinstance(datagram, tuple):
+                self.transport.socket.sendmsg(datagram)
+            else:
+                self.transport.write(datagram)
+        except socket.error as se:
+            if not self._failed(se, 1):
+                raise
+
+    def flush(self):
+        """ Send the datagrams collected when coalescing, as many in each
+            system call as the kernel will take
+        """
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+
+        batch, self._batch = self._batch, []
+        sock = getattr(self.transport, 'socket', None)
+        sent = 0
+        while sent < len(batch) and sock is not None:
+            try:
+                sent += self.sender.send(sock, batch, sent)
+            except socket.error as se:
+                if se.args[0] == errno.ECONNREFUSED:
+                    # the refusal takes the place of the next datagram
+                    self.connectionRefused()
+                    sent += 1
+                elif self._failed(se, len(batch) - sent):
+                    # the kernel has no room for the rest of the batch
+                    return
+                else:
+                    raise
+
+    def _failed(self, error, count):
+        """ Count datagrams which were not sent because Graylog's port was
+            unreachable or the kernel had no room for them, returning False
+            for any other error
+        """
+        if error.args[0] == errno.ECONNREFUSED:
+            self.connectionRefused()
+        elif error.args[0] in (errno.ENOBUFS, errno.EAGAIN):
+            self.send_dropped += count
+        else:
+            return False
+        return True
+
+    def _pace(self):
+        """ Send the waiting messages, oldest first, for as long as the
+            rates allow and come back once they allow more. A message is
+            always sent whole, running the rates into debt if need be
+        """
+        self._pace_call = None
+        if not self.connected:
+            return
+
+        self._refill()
+        while self._packet_tokens >= TOKEN and self._byte_tokens >= TOKEN:
+            if self._queue:
+                datagrams = self._queue.popleft()
+            elif len(self.buffer):
+                datagrams = unbuffered(self.buffer.popleft()[0])
+                self.buffer.replayed += 1
+            else:
+                return
+
+            for datagram in datagrams:
+                self._transmit(datagram)
+                self._packet_tokens -= 1
+                self._byte_tokens -= datagram_size(datagram)
+
+        if self._queue or len(self.buffer):
+            self._pace_call = self.clock.callLater(self._wait(), self._pace)
+
+    def _refill(self):
+        """ Add the tokens earned since we last sent
+        """
+        now = self.clock.seconds()
+        if self._refilled is not None:
+            elapsed = now - self._refilled
+            if self.packet_rate is not None:
+                self._packet_tokens = min(
+                    self._packet_tokens + elapsed * self.packet_rate,
+                    self._capacity(self.packet_rate))
+            if self.byte_rate is not None:
+                self._byte_tokens = min(
+                    self._byte_tokens + elapsed * self.byte_rate,
+                    self._capacity(self.byte_rate))
+        self._refilled = now
+
+    def _wait(self):
+        """ The number of seconds until the rates allow another datagram,
+            though never less than a millisecond so that the time passing
+            always adds up to a token
+        """
+        wait = MIN_WAIT
+        if self.packet_rate is not None and self._packet_tokens < 1:
+            wait = max(
+                wait, (1 - self._packet_tokens) / float(self.packet_rate))
+        if self.byte_rate is not None and self._byte_tokens < 1:
+            wait = max(wait, (1 - self._byte_tokens) / float(self.byte_rate))
+        return wait
+
+    def _capacity(self, rate):
+        """ The most tokens a rate may save up, or infinitely many when
+            there is no limit
+        """
+        if rate is None:
+            return float('inf')
+        return max(rate * self.burst, 1)
 
     def log_message(self, event):
         """ The method to be called when we want to emit a log activity
             The paramater overide can be set to include extra paramaters
         """
+        self._send(self._encode(event), event_level(event))
+
+    def _encode(self, event):
+        """ Encode an event, recording how long it took and the size of the
+            messages when we have a :class:`~txgraylog.metrics.Metrics`
+        """
+        metrics = self.metrics
+        if metrics is None:
+            return self.encode(event)
+
+        start = metrics.timer()
+        messages = self.encode(event)
+        metrics.encoded(metrics.timer() - start, [len(m) for m in messages])
+        return messages
+
+    def encode(self, event):
+        """ Build the messages to be sent for an event. This does not touch
+            the transport so it is safe to call outside the reactor thread
+        """
         event.update(self.parameter_override)
-        self.send_to_graylog(event)
+        return [str(event)]
 
 
 class UDPGelfProtocol(UDPPlainTextProtocol):
@@ -92,11 +420,63 @@ class UDPGelfProtocol(UDPPlainTextProtocol):
         Graylog2 server using the Gelf protocol over UDP
     """
 
+    limits = DEFAULT_LIMITS
+
+    def __init__(self, host, port, compression=True, **kwargs):
+        """ Initialize our protocol
+            :param compression: whether to compress with zlib, or one of the
+                strategies from :mod:`~txgraylog.protocol.compression`
+        """
+        UDPPlainTextProtocol.__init__(self, host, port, **kwargs)
+        self.compression = compression
+        self.builder = None
+
     def log_message(self, event):
         """ The method to be called when we want to emit a log activity
-            The paramater overide can be set to include extra paramaters
+            The paramater overide can be set to include extra paramaters.
+            Where the socket supports scatter/gather writes each chunk is
+            sent straight from its header and a view of the payload
         """
-        event.update(self.parameter_override)
-        gelf = GelfProtocol(self.hostname, **event).generate()
-        for message in gelf:
-            self.send_to_graylog(message)
+        sendmsg = getattr(
+            getattr(self.transport, 'socket', None), 'sendmsg', None)
+        if sendmsg is None or not self.connected or self.buffer.replaying:
+            UDPPlainTextProtocol.log_message(self, event)
+            return
+
+        metrics = self.metrics
+        if metrics is None:
+            datagrams = self._builder().datagrams(event)
+        else:
+            start = metrics.timer()
+            datagrams = self._builder().datagrams(event)
+            metrics.encoded(
+                metrics.timer() - start,
+                [datagram_size(d) for d in datagrams])
+
+        self._send(datagrams, event_level(event))
+
+    def encode(self, event):
+        """ Build the compressed and, if needed, chunked GELF datagrams to
+            be sent for an event
+        """
+        return self._builder().build(event)
+
+    def send_encoded(self, message, level=INFO):
+        """ Compress, chunk and send a GELF message which has already been
+            serialized
+        """
+        self._send(self._builder().build_encoded(message), level)
+
+    def _builder(self):
+        """ Get the builder for our messages, rebuilding it whenever the
+            paramater overide or the compression changes
+        """
+        builder = self.builder
+        if (builder is None or
+                builder.compress is not self.compression or
+                builder.template.overrides != self.parameter_override):
+            builder = self.builder = GelfBuilder(
+                GelfTemplate(
+                    self.hostname, self.parameter_override, self.limits),
+                compress=self.compression)
+        return builder
@@ -0,0 +1,221 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+.. module:: resolver
+    :platform: Unix, Windows
+    :synopsis: Cached host name resolution, refreshed in the background
+.. moduleauthor:: Adam Drakeford <adamdrakeford@gmail.com>
+"""
+
+import socket
+
+from twisted.internet import defer, reactor, threads
+from twisted.internet.abstract import isIPAddress, isIPv6Address
+
+
+def system_lookup(host, family=socket.AF_UNSPEC):
+    """ Look a host up with the system resolver in a thread, so that the
+        hosts file and the rest of the system configuration apply. The
+        system resolver does not tell us the TTL of the records, so the
+        result is cached for the resolver's default TTL
+    """
+    def lookup():
+        addresses = []
+        for info in socket.getaddrinfo(host, None, family, socket.SOCK_DGRAM):
+            address = info[4][0]
+            if address not in addresses:
+                addresses.append(address)
+        return addresses, None
+
+    return threads.deferToThread(lookup)
+
+
+def dns_lookup(host, family=socket.AF_UNSPEC):
+    """ Look a host up with :mod:`twisted.names`, which queries the name
+        servers directly and gives us the TTL of the records. The result is
+        cached until the first of them expires
+    """
+    from twisted.names import client, dns
+
+    queries = []
+    if family in (socket.AF_UNSPEC, socket.AF_INET):
+        queries.append((client.lookupAddress, dns.A, socket.AF_INET))
+    if family in (socket.AF_UNSPEC, socket.AF_INET6):
+        queries.append((client.lookupIPV6Address, dns.AAAA, socket.AF_INET6))
+
+    def collect(results):
+        addresses, ttls = [], []
+        for (success, result), (_, type, family) in zip(results, queries):
+            if not success:
+                continue
+            for record in result[0]:
+                if record.type != type:
+                    continue
+                address = socket.inet_ntop(family, record.payload.address)
+                if address not in addresses:
+                    addresses.append(address)
+                    ttls.append(record.ttl)
+
+        if not addresses:
+            raise socket.gaierror(
+                socket.EAI_NONAME, 'No addresses for %s' % (host, ))
+        return addresses, min(ttls)
+
+    d = defer.DeferredList(
+        [lookup(host) for lookup, _, _ in queries], consumeErrors=True)
+    d.addCallback(collect)
+    return d
+
+
+class Resolver(object):
+    """ Keeps the addresses of a host, looking them up again in the
+        background each time they expire. Senders take an address from
+        `addresses` or :meth:`choose` without ever waiting on DNS, and
+        subscribers are told whenever the addresses change.
+
+        When a lookup fails the last known addresses are kept and the
+        lookup is tried again after `retry_delay`. Hosts given as IP
+        addresses are never looked up
+    """
+
+    def __init__(
+            self, host, ttl=60, min_ttl=1, max_ttl=3600, retry_delay=5,
+            family=socket.AF_UNSPEC, lookup=system_lookup):
+        """ Initialise the resolver
+            :param host: the host name to resolve
+            :param ttl: the number of seconds to cache the addresses for when
+                the lookup does not say
+            :param min_ttl: the shortest time to cache the addresses for
+            :param max_ttl: the longest time to cache the addresses for
+            :param retry_delay: the number of seconds to wait before looking
+                the host up again after a failure
+            :param family: AF_INET or AF_INET6 to only resolve addresses of
+                that family, or AF_UNSPEC for both
+            :param lookup: a function taking the host and family and
+                returning a Deferred firing with the list of addresses and
+                their TTL, or None when it is not known
+        """
+        self.host = host
+        self.ttl = ttl
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.retry_delay = retry_delay
+        self.family = family
+        self.lookup = lookup
+        self.clock = reactor
+
+        self.addresses = []
+        self.expires = None
+
+        self.lookups = 0
+        self.failures = 0
+        self.changes = 0
+
+        self._subscribers = []
+        self._refresh_call = None
+        self._waiting = None
+        self._next = 0
+
+        if isIPAddress(host) or isIPv6Address(host):
+            self.addresses = [host]
+
+    def start(self):
+        """ Look the host up unless we already know its addresses, which
+            keep being refreshed from then on. Returns a Deferred firing
+            with the addresses
+        """
+        if self.addresses:
+            return defer.succeed(self.addresses)
+
+        d = defer.Deferred()
+        if self._waiting is None:
+            self._waiting = [d]
+            self.refresh()
+        else:
+            self._waiting.append(d)
+        return d
+
+    def stop(self):
+        """ Stop refreshing the addresses
+        """
+        if self._refresh_call is not None and self._refresh_call.active():
+            self._refresh_call.cancel()
+        self._refresh_call = None
+
+    def subscribe(self, callback):
+        """ Call `callback` with the list of addresses every time they
+            change, starting straight away if they are already known
+        """
+        if callback in self._subscribers:
+            return
+        self._subscribers.append(callback)
+        if self.addresses:
+            callback(self.addresses)
+
+    def unsubscribe(self, callback):
+        if callback in self._subscribers:
+            self._subscribers.remove(callback)
+
+    def choose(self, family=None):
+        """ Take the next of the addresses in turn, so that the callers
+            sharing this resolver are spread over them. Only addresses of
+            `family` are chosen when it is given. Returns None if there are
+            none
+        """
+        addresses = self.addresses
+        if family is not None:
+            addresses = [a for a in addresses if address_family(a) == family]
+        if not addresses:
+            return None
+
+        address = addresses[self._next % len(addresses)]
+        self._next += 1
+        return address
+
+    def refresh(self):
+        """ Look the host up now
+        """
+        self.stop()
+        self.lookups += 1
+        d = defer.maybeDeferred(self.lookup, self.host, self.family)
+        d.addCallbacks(self._resolved, self._failed)
+        return d
+
+    def _resolved(self, result):
+        addresses, ttl = result
+        if ttl is None:
+            ttl = self.ttl
+        ttl = min(max(ttl, self.min_ttl), self.max_ttl)
+
+        self.expires = self.clock.seconds() + ttl
+        self._refresh_call = self.clock.callLater(ttl, self.refresh)
+
+        if addresses and addresses != self.addresses:
+            self.addresses = list(addresses)
+            self.changes += 1
+            for callback in list(self._subscribers):
+                callback(self.addresses)
+        self._wake(None)
+        return self.addresses
+
+    def _failed(self, reason):
+        # keep the addresses we had and try again later
+        self.failures += 1
+        self._refresh_call = self.clock.callLater(
+            self.retry_delay, self.refresh)
+        self._wake(reason)
+
+    def _wake(self, reason):
+        waiting, self._waiting = self._waiting, None
+        for d in waiting or ():
+            if reason is None or self.addresses:
+                d.callback(self.addresses)
+            else:
+                d.errback(reason)
+
+
+def address_family(address):
+    """ Get the address family of an IP address
+    """
+    return socket.AF_INET6 if ':' in address else socket.AF_INET
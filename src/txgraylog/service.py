@@ -9,16 +9,32 @@
 """
 
 from twisted.application import service
+from twisted.internet import reactor
 
 from txgraylog.observer import GraylogObserver
+from txgraylog.protocol.relay import RelayFactory
 
 
 class GraylogService(service.Service):
     """ Graylog Service that will be started by twisted
     """
 
-    def __init__(self, protocol, host, port):
-        self.observer = GraylogObserver(protocol, host, port)
+    def __init__(
+            self, protocol, host, port, observer_class=GraylogObserver,
+            **kwargs):
+        """ Create the observer
+            :param observer_class: the observer to use, either
+                :class:`~txgraylog.observer.GraylogObserver` or
+                :class:`~txgraylog.observer.GraylogLogObserver`
+            :param kwargs: extra options passed through to the observer
+        """
+        self.observer = observer_class(protocol, host, port, **kwargs)
+
+    @property
+    def metrics(self):
+        """ The :class:`~txgraylog.metrics.Metrics` of our observer
+        """
+        return self.observer.metrics
 
     def startService(self):
         service.Service.startService(self)
@@ -27,3 +43,39 @@ class GraylogService(service.Service):
     def stopService(self):
         service.Service.stopService(self)
         self.observer.stop()
+
+
+class GraylogRelayService(GraylogService):
+    """ Graylog relay service, which listens on a Unix socket for the
+        messages of worker processes on the same host using
+        :class:`~txgraylog.protocol.relay.RelayGelfProtocol` and forwards
+        them to Graylog over its own connections. The relay also sends its
+        own log messages
+    """
+
+    def __init__(self, protocol, host, port, path, mode=0600, **kwargs):
+        """ Create the observer and the relay
+            :param path: the path of the Unix socket to listen on
+            :param mode: the permissions of the socket. Anyone who may write
+                to it can send messages to Graylog as this host, so by
+                default only our own user may. 0660 lets workers running
+                as other users of our group in too
+            :param kwargs: extra options passed through to the observer,
+                such as the number of `connections` to keep open
+        """
+        GraylogService.__init__(self, protocol, host, port, **kwargs)
+        self.path = path
+        self.mode = mode
+        self.relay = RelayFactory(
+            self.observer.protocol, self.observer.metrics)
+        self.listener = None
+
+    def startService(self):
+        GraylogService.startService(self)
+        # the lock file lets us take over the socket of a relay which died
+        self.listener = reactor.listenUNIX(
+            self.path, self.relay, mode=self.mode, wantPID=True)
+
+    def stopService(self):
+        GraylogService.stopService(self)
+        return self.listener.stopListening()
@@ -0,0 +1,218 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+.. module:: spill
+    :platform: Unix, Windows
+    :synopsis: Disk backed queue for messages which overflow the in memory
+        buffer during long outages
+.. moduleauthor:: Adam Drakeford <adamdrakeford@gmail.com>
+"""
+
+import os
+import struct
+from collections import deque
+
+from txgraylog.buffering import INFO
+
+RECORD = struct.Struct('>IB')
+# the flag in the level of a record holding a chunked message, whose
+# datagrams each follow their length
+CHUNKED = 0x80
+PART = struct.Struct('>I')
+SEGMENT_SUFFIX = '.spill'
+
+
+class SpillQueue(object):
+    """ An append only queue of messages kept in segment files on disk. Each
+        record is the length of the message and its level followed by the
+        message itself. A chunked message, a tuple of datagrams, is kept in
+        a single record so that it is read back whole. Records are read
+        back one at a time, so the backlog is never loaded into memory, and
+        each segment is deleted once all of its messages have been read.
+        Segments left behind by a previous run are replayed first
+    """
+
+    def __init__(self, directory, segment_size=64 * 1024 * 1024,
+                 max_bytes=None):
+        """ Initialise the spill queue
+            :param directory: the directory holding the segment files
+            :param segment_size: the size in bytes at which a new segment
+                is started
+            :param max_bytes: the maximum number of bytes to keep on disk,
+                or None for no limit
+        """
+        self.directory = directory
+        self.segment_size = segment_size
+        self.max_bytes = max_bytes
+
+        self.count = 0
+        self.size = 0
+
+        self._writer = None
+        self._reader = None
+        self._segments = deque()
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        for name in sorted(os.listdir(directory)):
+            if name.endswith(SEGMENT_SUFFIX):
+                self._segments.append(int(name[:-len(SEGMENT_SUFFIX)]))
+                self._scan(self._path(self._segments[-1]))
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """ Iterate over the messages on disk, oldest first, without
+            removing them
+        """
+        for index, segment in enumerate(list(self._segments)):
+            with open(self._path(segment), 'rb') as f:
+                if index == 0 and self._reader is not None:
+                    f.seek(self._reader.tell())
+                for message, level in self._records(f):
+                    yield self._decode(message, level)[0]
+
+    def append(self, message, level):
+        """ Write a message to the end of the queue. Returns False if the
+            queue is full and the message was not written
+        """
+        if not isinstance(level, int) or not 0 <= level < CHUNKED:
+            level = INFO
+        if isinstance(message, tuple):
+            message = ''.join([
+                PART.pack(len(datagram)) + datagram for datagram in message])
+            level |= CHUNKED
+
+        size = RECORD.size + len(message)
+        if self.max_bytes is not None and self.size + size > self.max_bytes:
+            return False
+
+        if self._writer is None or self._writer.tell() >= self.segment_size:
+            self._rotate()
+
+        self._writer.write(RECORD.pack(len(message), level) + message)
+        self.count += 1
+        self.size += size
+        return True
+
+    def popleft(self):
+        """ Remove and return the oldest message and its level
+        """
+        while self.count:
+            if self._reader is None:
+                self._reader = open(self._path(self._segments[0]), 'rb')
+
+            for message, level in self._records(self._reader):
+                self.count -= 1
+                self.size -= RECORD.size + len(message)
+                if not self.count:
+                    self.clear()
+                elif self._read_finished():
+                    self._next_segment()
+                return self._decode(message, level)
+
+            if len(self._segments) == 1:
+                # the segment we are writing to ended early, so whatever our
+                # count says there is nothing more to read
+                break
+            self._next_segment()
+
+        self.clear()
+        raise IndexError('pop from an empty spill queue')
+
+    def clear(self):
+        """ Delete all of the segments
+        """
+        for handle in (self._reader, self._writer):
+            if handle is not None:
+                handle.close()
+        self._reader = self._writer = None
+
+        while self._segments:
+            os.remove(self._path(self._segments.popleft()))
+
+        self.count = 0
+        self.size = 0
+
+    def close(self):
+        """ Close the segment files, leaving them on disk to be replayed the
+            next time the queue is opened
+        """
+        for handle in (self._reader, self._writer):
+            if handle is not None:
+                handle.close()
+        self._reader = self._writer = None
+
+    def _read_finished(self):
+        """ Whether everything has been read from a segment which is no
+            longer being written to
+        """
+        if len(self._segments) == 1:
+            return False
+        return self._reader.tell() >= os.fstat(self._reader.fileno()).st_size
+
+    def _next_segment(self):
+        """ Delete the segment we have finished reading
+        """
+        self._reader.close()
+        self._reader = None
+        os.remove(self._path(self._segments.popleft()))
+
+    def _rotate(self):
+        """ Start writing to a new segment
+        """
+        if self._writer is not None:
+            self._writer.close()
+
+        segment = self._segments[-1] + 1 if self._segments else 0
+        self._segments.append(segment)
+        # unbuffered, so that readers see every record as soon as it is
+        # written and a crash loses nothing that was already spilled
+        self._writer = open(self._path(segment), 'ab', 0)
+
+    def _scan(self, path):
+        """ Count the records in a segment left behind by a previous run
+        """
+        with open(path, 'rb') as f:
+            for message, _ in self._records(f):
+                self.count += 1
+                self.size += RECORD.size + len(message)
+
+    def _path(self, segment):
+        return os.path.join(
+            self.directory, '%08d%s' % (segment, SEGMENT_SUFFIX))
+
+    @staticmethod
+    def _decode(message, level):
+        """ Split the record of a chunked message back into its datagrams
+        """
+        if not level & CHUNKED:
+            return message, level
+
+        datagrams, offset = [], 0
+        while offset < len(message):
+            length, = PART.unpack_from(message, offset)
+            offset += PART.size
+            datagrams.append(message[offset:offset + length])
+            offset += length
+        return tuple(datagrams), level & ~CHUNKED
+
+    @staticmethod
+    def _records(f):
+        """ Read the records from a file, stopping at the end of the file or
+            at a record which was only partially written
+        """
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                f.seek(-len(header), os.SEEK_CUR)
+                return
+            length, level = RECORD.unpack(header)
+            message = f.read(length)
+            if len(message) < length:
+                f.seek(-(len(header) + len(message)), os.SEEK_CUR)
+                return
+            yield message, level
@@ -0,0 +1,19 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Helpers shared by the tests
+"""
+
+
+def make_event(message='hello', **fields):
+    """ A Twisted log event for a message, with any other fields given
+    """
+    event = {
+        'message': (message, ),
+        'system': 'app',
+        'isError': False,
+        'time': 1434567890.123,
+    }
+    event.update(fields)
+    return event
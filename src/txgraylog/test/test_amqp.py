@@ -0,0 +1,293 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Tests for :class: `~txgraylog.protocol.amqp.AMQPGelfProtocol`
+"""
+import json
+import zlib
+
+from twisted.trial import unittest
+from twisted.internet import defer, task
+
+from txgraylog.buffering import MessageBuffer
+from txgraylog.protocol.amqp import AMQPGelfProtocol, AMQPGraylogFactory
+from txgraylog.test.helpers import make_event
+
+try:
+    import pika
+except ImportError:
+    pika = None
+
+
+class FakeBroker(object):
+    """ An in process stand in for a broker, holding the messages published
+        to it until they are confirmed or refused
+    """
+
+    def __init__(self):
+        self.unconfirmed = []
+        self.queue = []
+
+    def channel(self):
+        return FakeChannel(self)
+
+    def close(self, channel, reason):
+        """ Close a channel, failing its unconfirmed publishes before
+            telling anyone listening for it to close, as pika does
+        """
+        channel.is_closed = True
+        channel.reason = reason
+        unconfirmed, self.unconfirmed = self.unconfirmed, []
+        for _, d in unconfirmed:
+            d.errback(reason)
+        channel.on_closed.callback(reason)
+
+    def confirm(self, count=None):
+        """ Confirm the oldest unconfirmed publishes
+        """
+        count = len(self.unconfirmed) if count is None else count
+        confirmed = self.unconfirmed[:count]
+        del self.unconfirmed[:count]
+        for body, d in confirmed:
+            self.queue.append(body)
+            d.callback(None)
+
+    def refuse(self):
+        """ Refuse the oldest unconfirmed publish
+        """
+        _, d = self.unconfirmed.pop(0)
+        d.errback(ValueError('nack'))
+
+    def drop(self):
+        """ Forget the unconfirmed publishes, as a broker does when the
+            connection is lost
+        """
+        self.unconfirmed = []
+
+    def messages(self):
+        return [
+            json.loads(zlib.decompress(body))['short_message']
+            for body in self.queue]
+
+
+class FakeChannel(object):
+    """ A channel in publisher confirm mode on the fake broker
+    """
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.published = []
+        self.is_closed = False
+        self.reason = None
+        self.on_closed = defer.Deferred()
+
+    def confirm_delivery(self):
+        return defer.succeed(None)
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.published.append((exchange, routing_key))
+        if self.is_closed:
+            return defer.fail(self.reason)
+        d = defer.Deferred()
+        self.broker.unconfirmed.append((body, d))
+        return d
+
+
+class TestAMQPGelf(unittest.TestCase):
+    """ Test publishing GELF messages to a broker
+    """
+
+    def setUp(self):
+        self.broker = FakeBroker()
+        self.protocol = AMQPGelfProtocol(
+            'localhost', 5672, exchange='graylog', routing_key='gelf',
+            batch_size=3, max_unconfirmed=4)
+        self.protocol.clock = self.clock = task.Clock()
+
+    def log(self, *messages):
+        for message in messages:
+            self.protocol.log_message(make_event(message))
+
+    def test_batched(self):
+        """ Test messages are published a batch at a time without waiting
+            for confirms
+        """
+        channel = self.broker.channel()
+        self.protocol.channelOpened(channel)
+
+        self.log('a', 'b')
+        self.assertEquals(self.broker.unconfirmed, [])
+        self.log('c')
+        self.assertEquals(len(self.broker.unconfirmed), 3)
+        self.assertEquals(channel.published, [('graylog', 'gelf')] * 3)
+
+        self.log('d')
+        self.clock.advance(0)
+        self.assertEquals(len(self.broker.unconfirmed), 4)
+        self.assertEquals(self.protocol.messages_sent, 0)
+
+        self.broker.confirm()
+        self.assertEquals(self.broker.messages(), ['a', 'b', 'c', 'd'])
+        self.assertEquals(self.protocol.messages_sent, 4)
+
+    def test_max_unconfirmed(self):
+        """ Test publishing stops once too many publishes are unconfirmed
+            and carries on as they are confirmed
+        """
+        self.protocol.channelOpened(self.broker.channel())
+        self.log('a', 'b', 'c', 'd', 'e', 'f')
+        self.assertEquals(len(self.broker.unconfirmed), 4)
+
+        self.broker.confirm(2)
+        self.assertEquals(len(self.broker.unconfirmed), 4)
+        self.broker.confirm()
+        self.assertEquals(
+            self.broker.messages(), ['a', 'b', 'c', 'd', 'e', 'f'])
+
+    def test_bounded_while_unconfirmed(self):
+        """ Test messages are held in the buffer, with its limits, once as
+            many publishes as may be unconfirmed are waiting, and published
+            in order as they are confirmed
+        """
+        self.protocol.buffer = MessageBuffer(max_count=3)
+        self.protocol.channelOpened(self.broker.channel())
+        self.log(*'abcdefghij')
+
+        self.assertEquals(len(self.broker.unconfirmed), 4)
+        self.assertEquals(self.protocol._pending, [])
+        self.assertEquals(len(self.protocol.buffer), 3)
+        self.assertEquals(self.protocol.buffer.dropped, 3)
+
+        self.broker.confirm(2)
+        self.log('k')
+        self.assertEquals(len(self.protocol.buffer), 2)
+        self.broker.confirm()
+        self.broker.confirm()
+        self.assertEquals(
+            self.broker.messages(), ['a', 'b', 'c', 'd', 'h', 'i', 'j', 'k'])
+        self.assertEquals(len(self.protocol.buffer), 0)
+
+    def test_buffer_until_open(self):
+        """ Test messages are buffered until a channel is opened
+        """
+        self.log('a', 'b')
+        self.assertEquals(len(self.protocol.buffer), 2)
+
+        self.protocol.channelOpened(self.broker.channel())
+        self.clock.advance(0)
+        self.broker.confirm()
+        self.assertEquals(self.broker.messages(), ['a', 'b'])
+        self.assertEquals(len(self.protocol.buffer), 0)
+
+    def test_republish_unconfirmed(self):
+        """ Test unconfirmed and pending messages are published again on
+            the next channel, in order
+        """
+        self.protocol.channelOpened(self.broker.channel())
+        self.log('a', 'b', 'c', 'd')
+        self.broker.confirm(1)
+
+        self.broker.drop()
+        self.protocol.channelClosed(None)
+        self.assertEquals(len(self.protocol.buffer), 3)
+        self.log('e')
+
+        self.protocol.channelOpened(self.broker.channel())
+        self.clock.advance(0)
+        self.broker.confirm()
+        self.assertEquals(
+            self.broker.messages(), ['a', 'b', 'c', 'd', 'e'])
+        self.assertEquals(self.protocol.disconnects, 1)
+
+    def test_refused(self):
+        """ Test messages the broker refuses are published again
+        """
+        self.protocol.channelOpened(self.broker.channel())
+        self.log('a', 'b', 'c')
+        self.broker.refuse()
+        self.broker.confirm()
+        self.clock.advance(0)
+        self.broker.confirm()
+
+        self.assertEquals(self.broker.messages(), ['b', 'c', 'a'])
+        self.assertEquals(self.protocol.nacked, 1)
+
+    def test_channel_closed(self):
+        """ Test nothing is published again once the broker closes the
+            channel, and that the messages are kept for the next one
+        """
+        channel = self.broker.channel()
+        self.protocol.channelOpened(channel)
+        self.log('a', 'b', 'c')
+
+        self.broker.close(channel, ValueError('NOT_FOUND'))
+        self.log('d')
+        self.clock.advance(0)
+
+        self.assertEquals(len(channel.published), 3)
+        self.assertEquals(len(self.protocol.buffer), 4)
+        self.assertEquals(self.protocol.disconnects, 1)
+        self.assertEquals(self.protocol.nacked, 0)
+        self.failIf(self.protocol.connected)
+
+        self.protocol.channelOpened(self.broker.channel())
+        self.clock.advance(0)
+        self.broker.confirm()
+        self.assertEquals(self.broker.messages(), ['a', 'b', 'c', 'd'])
+
+
+class FakeConnection(object):
+
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class TestAMQPGraylogFactory(unittest.TestCase):
+    """ Test the factory reconnecting when the broker closes the channel
+    """
+
+    if pika is None:
+        skip = 'pika is not installed'
+
+    def setUp(self):
+        self.broker = FakeBroker()
+        self.protocol = AMQPGelfProtocol('localhost', 5672)
+        self.protocol.clock = task.Clock()
+        self.factory = AMQPGraylogFactory(self.protocol)
+
+    def open(self):
+        channel = self.broker.channel()
+        connection = FakeConnection()
+        self.factory._confirm(channel, connection)
+        return channel, connection
+
+    def test_closed_by_broker(self):
+        """ Test the connection is closed when the broker closes the channel
+            and that the reconnect delay keeps growing while channels keep
+            being closed
+        """
+        channel, connection = self.open()
+        self.failUnless(self.protocol.connected)
+
+        self.protocol.send_to_graylog('foo')
+        self.broker.close(
+            channel, pika.exceptions.ChannelClosedByBroker(404, 'NOT_FOUND'))
+        self.assertTrue(connection.closed)
+        self.failIf(self.protocol.connected)
+        self.assertEquals(self.factory.channel_closes, 1)
+        self.assertEquals(self.protocol.disconnects, 1)
+        self.assertEquals(len(self.protocol.buffer), 1)
+
+        self.factory.delay = 30
+        channel, connection = self.open()
+        self.assertEquals(self.factory.delay, 30)
+
+        # once the broker confirms messages again the delay is reset
+        self.protocol.clock.advance(0)
+        self.broker.confirm()
+        self.broker.close(channel, ValueError('connection lost'))
+        self.open()
+        self.assertEquals(self.factory.delay, self.factory.initialDelay)
@@ -0,0 +1,98 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Tests for :class: `~txgraylog.buffering.MessageBuffer`
+"""
+from twisted.trial import unittest
+from twisted.internet import task
+
+from txgraylog.buffering import (
+    MessageBuffer, DROP_OLDEST, DROP_NEWEST, DROP_LEVEL
+)
+
+
+class TestMessageBuffer(unittest.TestCase):
+    """ Test buffering messages while disconnected
+    """
+
+    def fill(self, buf, *messages):
+        for message, level in messages:
+            buf.append(message, level)
+        return buf
+
+    def test_fifo_order(self):
+        """ Test messages come back out in the order they went in
+        """
+        buf = self.fill(MessageBuffer(), ('foo', 6), ('bar', 3), ('baz', 7))
+
+        self.assertEquals(list(buf), ['foo', 'bar', 'baz'])
+        self.assertEquals(buf.popleft(), ('foo', 6))
+        self.assertEquals(buf.popleft(), ('bar', 3))
+        self.assertEquals(buf.popleft(), ('baz', 7))
+        self.assertRaises(IndexError, buf.popleft)
+
+    def test_drop_oldest(self):
+        """ Test the oldest message is dropped once the count cap is reached
+        """
+        buf = MessageBuffer(max_count=2, policy=DROP_OLDEST)
+        self.fill(buf, ('foo', 6), ('bar', 6), ('baz', 6))
+
+        self.assertEquals(list(buf), ['bar', 'baz'])
+        self.assertEquals(buf.buffered, 3)
+        self.assertEquals(buf.dropped, 1)
+
+    def test_drop_newest(self):
+        """ Test incoming messages are dropped once the count cap is reached
+        """
+        buf = MessageBuffer(max_count=2, policy=DROP_NEWEST)
+        self.fill(buf, ('foo', 6), ('bar', 6), ('baz', 6))
+
+        self.assertEquals(list(buf), ['foo', 'bar'])
+        self.assertEquals(buf.dropped, 1)
+
+    def test_drop_level(self):
+        """ Test the least severe messages are dropped first
+        """
+        buf = MessageBuffer(max_count=3, policy=DROP_LEVEL)
+        self.fill(
+            buf, ('error', 3), ('debug', 7), ('info', 6), ('debug2', 7),
+            ('error2', 3))
+
+        self.assertEquals(list(buf), ['error', 'info', 'error2'])
+        self.assertEquals(buf.dropped, 2)
+
+    def test_byte_cap(self):
+        """ Test messages are dropped once the size cap is reached
+        """
+        buf = MessageBuffer(max_count=None, max_bytes=6)
+        self.fill(buf, ('foo', 6), ('bar', 6), ('baz', 6))
+
+        self.assertEquals(list(buf), ['bar', 'baz'])
+        self.assertEquals(buf.size, 6)
+
+    def test_restore(self):
+        """ Test restored messages go back in front of the buffer
+        """
+        buf = self.fill(MessageBuffer(), ('baz', 6))
+        buf.restore([('foo', 3), ('bar', 6)])
+
+        self.assertEquals(list(buf), ['foo', 'bar', 'baz'])
+
+    def test_paced_replay(self):
+        """ Test messages are replayed a batch at a time
+        """
+        buf = MessageBuffer(replay_batch=2, replay_interval=0.1)
+        buf.clock = task.Clock()
+        self.fill(buf, ('foo', 6), ('bar', 6), ('baz', 6))
+
+        sent = []
+        buf.replay(lambda message, level: sent.append(message))
+        self.assertEquals(sent, ['foo', 'bar'])
+        self.failUnless(buf.replaying)
+
+        buf.clock.advance(0.1)
+        self.assertEquals(sent, ['foo', 'bar', 'baz'])
+        self.failIf(buf.replaying)
+        self.assertEquals(buf.replayed, 3)
+        self.assertEquals(len(buf), 0)
@@ -0,0 +1,106 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Tests for :class: `~txgraylog.encoder.EncoderPool`
+"""
+import threading
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+
+from txgraylog.encoder import EncoderPool, OVERFLOW_INLINE
+
+
+class FakeProtocol(object):
+    """ Protocol recording the thread each event was encoded in
+    """
+
+    def __init__(self):
+        self.sent = []
+        self.threads = []
+
+    def encode(self, event):
+        self.threads.append(threading.current_thread())
+        if event.get('fail'):
+            raise ValueError('cannot encode')
+        return ['%(message)s-1' % event, '%(message)s-2' % event]
+
+    def send_to_graylog(self, message, level=6):
+        self.sent.append(message)
+
+    def log_message(self, event):
+        for message in self.encode(event):
+            self.send_to_graylog(message)
+
+
+class TestEncoderPool(unittest.TestCase):
+    """ Test encoding events in a thread pool
+    """
+
+    def setUp(self):
+        self.protocol = FakeProtocol()
+
+    def start(self, *args, **kwargs):
+        pool = EncoderPool(self.protocol, *args, **kwargs)
+        pool.start()
+        self.addCleanup(pool.stop)
+        return pool
+
+    @defer.inlineCallbacks
+    def wait(self, pool):
+        while pool.pending:
+            yield task.deferLater(reactor, 0.001, lambda: None)
+
+    @defer.inlineCallbacks
+    def test_encode_in_pool(self):
+        """ Test events are encoded off the reactor thread and the messages
+            are sent from the reactor thread
+        """
+        pool = self.start(size=1)
+        pool.submit({'message': 'foo'})
+        pool.submit({'message': 'bar'})
+        yield self.wait(pool)
+
+        self.assertEquals(
+            self.protocol.sent, ['foo-1', 'foo-2', 'bar-1', 'bar-2'])
+        self.assertNotIn(threading.current_thread(), self.protocol.threads)
+
+    @defer.inlineCallbacks
+    def test_drop_on_overflow(self):
+        """ Test events are dropped once too many are pending
+        """
+        pool = self.start(size=1, max_pending=1)
+        pool.submit({'message': 'foo'})
+        pool.submit({'message': 'bar'})
+        yield self.wait(pool)
+
+        self.assertEquals(self.protocol.sent, ['foo-1', 'foo-2'])
+        self.assertEquals(pool.dropped, 1)
+
+    @defer.inlineCallbacks
+    def test_inline_on_overflow(self):
+        """ Test events are encoded on the reactor thread once too many are
+            pending when using the inline policy
+        """
+        pool = self.start(size=1, max_pending=1, overflow=OVERFLOW_INLINE)
+        pool.submit({'message': 'foo'})
+        pool.submit({'message': 'bar'})
+        self.assertEquals(self.protocol.sent, ['bar-1', 'bar-2'])
+        yield self.wait(pool)
+
+        self.assertEquals(
+            self.protocol.sent, ['bar-1', 'bar-2', 'foo-1', 'foo-2'])
+        self.assertEquals(pool.inlined, 1)
+
+    @defer.inlineCallbacks
+    def test_encoding_error(self):
+        """ Test an event which cannot be encoded is counted and skipped
+        """
+        pool = self.start(size=1)
+        pool.submit({'message': 'foo', 'fail': True})
+        pool.submit({'message': 'bar'})
+        yield self.wait(pool)
+
+        self.assertEquals(self.protocol.sent, ['bar-1', 'bar-2'])
+        self.assertEquals(pool.errors, 1)
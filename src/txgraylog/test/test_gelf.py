@@ -278,3 +278,425 @@ class TestGELF(unittest.TestCase):
                 self.assertEquals(chunk_id, old_id)
 
             old_id = chunk_id
+
+    def test_encoding_cached(self):
+        """ Test the log paramaters are only encoded once
+        """
+        g = GelfProtocol('localhost', **{
+            'system': 'protocol',
+            'message': ['this is a log message'],
+            'isError': False,
+            'time': time.time(),
+        })
+
+        self.assertIdentical(g.encoded_log_params, g.encoded_log_params)
+        self.assertIdentical(g.generate()[0], g.encoded_log_params)
+        self.assertEquals(list(g), [g.encoded_log_params])
+
+    def test_encoding_invalidated(self):
+        """ Test that replacing the log paramaters drops the cached encoding
+        """
+        g = GelfProtocol('localhost', **{
+            'system': 'protocol',
+            'message': ['this is a log message'],
+            'isError': False,
+            'time': time.time(),
+        })
+        g.generate()
+
+        params = dict(g.log_params, short_message='changed')
+        g.log_params = params
+
+        decoded = json.loads(zlib.decompress(g.generate()[0]))
+        self.assertEquals(decoded['short_message'], 'changed')
+
+    def test_encoding_changed_in_place(self):
+        """ Test that changing the log paramaters in place drops the cached
+            encoding
+        """
+        g = GelfProtocol('localhost', **{
+            'system': 'protocol',
+            'message': ['this is a log message'],
+            'isError': False,
+            'time': time.time(),
+        })
+        g.generate()
+
+        g.log_params['short_message'] = 'changed'
+        decoded = json.loads(zlib.decompress(g.generate()[0]))
+        self.assertEquals(decoded['short_message'], 'changed')
+
+        g.log_params.update(_customer_id=1234)
+        del g.log_params['facility']
+        decoded = json.loads(zlib.decompress(g.generate()[0]))
+        self.assertEquals(decoded['_customer_id'], 1234)
+        self.assertNotIn('facility', decoded)
+
+        encoded = g.encoded_log_params
+        self.assertIdentical(g.encoded_log_params, encoded)
+
+    def test_chunking_exact_multiple(self):
+        """ Test a message exactly filling its chunks has no empty chunk
+        """
+        t = time.time()
+        for pad in xrange(4):
+            g = GelfProtocol('localhost', compress=False, **{
+                'system': 'protocol',
+                'isError': False,
+                'message': ['a' * 3000],
+                'pad': 'x' * pad,
+                'time': t,
+            })
+            if len(g.encoded_log_params) % 4 == 0:
+                break
+
+        g.chunk_size = len(g.encoded_log_params) / 4
+        messages = g.generate()
+
+        self.assertEquals(len(messages), 4)
+        self.assertEquals(
+            ''.join([m[38:] for m in messages]), g.encoded_log_params)
+
+    def test_chunking_datagrams(self):
+        """ Test the scatter/gather datagrams match the joined chunks
+        """
+        from txgraylog.protocol.gelf import GELF_NEW
+
+        longMessage = binascii.hexlify(
+            randbytes.insecureRandom(3000)) + 'more!'
+
+        g = GelfProtocol('localhost', gelf_fmt=GELF_NEW, **{
+            'system': 'protocol',
+            'isError': False,
+            'message': [longMessage],
+            'time': time.time(),
+        })
+
+        datagrams = list(g.datagrams())
+        self.failUnless(len(datagrams) > 1)
+
+        for i, (header, piece) in enumerate(datagrams):
+            self.assertIsInstance(piece, memoryview)
+            magic, chunk_id, seq, num_chunks = struct.unpack('2s8sBB', header)
+            self.assertEquals(seq, i)
+            self.assertEquals(num_chunks, len(datagrams))
+
+        self.assertEquals(
+            ''.join([piece.tobytes() for _, piece in datagrams]),
+            g.encoded_log_params)
+
+    def test_chunking_limit_truncate(self):
+        """ Test a message needing too many chunks has its full message
+            truncated until it fits
+        """
+        from txgraylog.protocol.gelf import MAX_CHUNKS
+
+        longMessage = binascii.hexlify(randbytes.insecureRandom(4000))
+
+        g = GelfProtocol('localhost', size=100, compress=False, **{
+            'system': 'protocol',
+            'isError': False,
+            'message': ['short', longMessage, longMessage],
+            'time': time.time(),
+        })
+        messages = g.generate()
+
+        self.failUnless(1 < len(messages) <= MAX_CHUNKS)
+        params = json.loads(''.join([m[38:] for m in messages]))
+        self.assertEquals(params['short_message'], 'short')
+        self.assertEquals(params['_truncated'], True)
+        self.failUnless(
+            ('short ' + longMessage).startswith(params['full_message']))
+
+    def test_chunking_limit_drop(self):
+        """ Test a message needing too many chunks is dropped when using the
+            drop policy
+        """
+        from txgraylog.protocol.gelf import CHUNK_DROP
+
+        longMessage = binascii.hexlify(randbytes.insecureRandom(4000))
+
+        g = GelfProtocol(
+            'localhost', size=100, compress=False, chunk_overflow=CHUNK_DROP,
+            **{
+                'system': 'protocol',
+                'isError': False,
+                'message': [longMessage, longMessage],
+                'time': time.time(),
+            }
+        )
+
+        self.assertEquals(g.generate(), [])
+        self.assertEquals(list(g.datagrams()), [])
+
+    def test_compression_strategies(self):
+        """ Test messages can be compressed with gzip framing, or left
+            uncompressed when they are small
+        """
+        from txgraylog.protocol import compression
+
+        event = {
+            'system': 'protocol',
+            'message': ['this is a log message'],
+            'isError': False,
+            'time': time.time(),
+        }
+
+        gzipped = GelfProtocol(
+            'localhost', compress=compression.GzipCompression(level=1),
+            **event).generate()[0]
+        self.failUnless(gzipped.startswith('\x1f\x8b'))
+        params = json.loads(zlib.decompress(gzipped, compression.GZIP_WBITS))
+        self.assertEquals(params['short_message'], 'this is a log message')
+
+        small = GelfProtocol(
+            'localhost', compress=compression.ZlibCompression(min_size=1024),
+            **event).generate()[0]
+        self.assertEquals(
+            json.loads(small)['short_message'], 'this is a log message')
+
+        plain = GelfProtocol('localhost', compress=False, **event).generate()
+        self.assertEquals(plain, [small])
+
+    def test_template_matches(self):
+        """ Test a template builds the same message as a GelfProtocol built
+            from the event updated with the overrides
+        """
+        from txgraylog.protocol.gelf import GelfTemplate
+
+        t = time.time()
+        events = [
+            {
+                'system': 'protocol',
+                'message': ['this is a log message', 'continued'],
+                'isError': False,
+                'time': t,
+            },
+            {
+                'system': 'protocol',
+                'failure': failure.Failure(Exception('foo')),
+                'isError': True,
+                'time': t,
+                'file': 'foo.py',
+                'line': 12,
+                'username': 'foo',
+            },
+            {
+                'message': [],
+                'isError': False,
+                'time': t,
+                'version': '1.1',
+                'level': 7,
+                'app': 'bar',
+            },
+        ]
+
+        for overrides in ({}, {'app': 'baz', 'env': 'prod'}, {'system': 'x'}):
+            template = GelfTemplate('localhost', overrides)
+            for event in events:
+                expected = GelfProtocol(
+                    'localhost', compress=False, **dict(event, **overrides))
+
+                original = dict(event)
+                encoded = template.encode(event)
+
+                self.assertEquals(event, original)
+                self.assertEquals(
+                    json.loads(encoded),
+                    json.loads(expected.encoded_log_params))
+                self.assertEquals(
+                    template.log_params(event), expected.log_params)
+
+    def test_template_protocol(self):
+        """ Test a GelfProtocol built from a template
+        """
+        from txgraylog.protocol.gelf import GelfTemplate
+
+        g = GelfProtocol(
+            'localhost', template=GelfTemplate('localhost', {'app': 'baz'}),
+            **{
+                'system': 'protocol',
+                'message': ['this is a log message'],
+                'isError': False,
+                'time': time.time(),
+            }
+        )
+
+        params = json.loads(zlib.decompress(g.generate()[0]))
+        self.assertEquals(params['short_message'], 'this is a log message')
+        self.assertEquals(params['_app'], 'baz')
+        self.assertEquals(g.log_params, params)
+
+
+class TestGelfBuilder(unittest.TestCase):
+    """ Test building the messages for events with a reusable builder
+    """
+
+    def setUp(self):
+        from txgraylog.protocol.gelf import GelfTemplate
+        self.template = GelfTemplate('localhost', {'app': 'baz'})
+
+    def event(self, *message):
+        return {
+            'system': 'protocol',
+            'message': list(message),
+            'isError': False,
+            'time': 1434567890.5,
+        }
+
+    def test_matches_protocol(self):
+        """ Test a builder builds the same message as a GelfProtocol
+        """
+        from txgraylog.protocol.gelf import GelfBuilder
+
+        event = self.event('this is a log message')
+        expected = GelfProtocol(
+            'localhost', template=self.template, **event).generate()
+        self.assertEquals(GelfBuilder(self.template).build(event), expected)
+
+        builder = GelfBuilder(self.template, chunk=False, compress=False)
+        self.assertEquals(
+            builder.build(event),
+            [self.template.encode(event)])
+
+    def test_chunking(self):
+        """ Test the chunks of a large message share a header and hold the
+            whole message between them
+        """
+        from txgraylog.protocol.gelf import (
+            GelfBuilder, GELF_LEGACY, GELF_NEW
+        )
+
+        longMessage = binascii.hexlify(randbytes.insecureRandom(3000))
+        event = self.event(longMessage)
+
+        for fmt, header, size in ((GELF_LEGACY, '>2s32sHH', 38),
+                                  (GELF_NEW, '>2s8sBB', 12)):
+            builder = GelfBuilder(self.template, gelf_fmt=fmt, compress=False)
+            messages = builder.build(event)
+            self.failUnless(len(messages) > 1)
+
+            ids = set()
+            for i, message in enumerate(messages):
+                magic, chunk_id, seq, num_chunks = struct.unpack(
+                    header, message[:size])
+                self.assertEquals(magic, '\x1e\x0f')
+                self.assertEquals(seq, i)
+                self.assertEquals(num_chunks, len(messages))
+                ids.add(chunk_id)
+
+            self.assertEquals(len(ids), 1)
+            self.assertEquals(
+                ''.join([m[size:] for m in messages]),
+                self.template.encode(event))
+
+            datagrams = builder.datagrams(event)
+            self.assertEquals(len(datagrams), len(messages))
+            self.assertEquals(
+                ''.join([piece.tobytes() for _, piece in datagrams]),
+                self.template.encode(event))
+
+    def test_overflow_reserved_keys(self):
+        """ Test a message too large for MAX_CHUNKS chunks is truncated
+            even when its event has keys named like the paramaters of
+            :class:`GelfProtocol`
+        """
+        from txgraylog.protocol.gelf import GelfBuilder, MAX_CHUNKS
+
+        event = self.event(
+            'short', binascii.hexlify(randbytes.insecureRandom(8000)))
+        for key in ('host', 'size', 'limits', 'template', 'encoded',
+                    'compress', 'event'):
+            event[key] = 'foo'
+
+        builder = GelfBuilder(self.template, size=100, compress=False)
+        messages = builder.build(event)
+        self.failUnless(1 < len(messages) <= MAX_CHUNKS)
+        params = json.loads(''.join([m[38:] for m in messages]))
+        self.assertEquals(params['_truncated'], True)
+        self.assertEquals(len(builder.datagrams(event)), len(messages))
+
+    def test_build_encoded(self):
+        """ Test a message which has already been serialized is compressed
+            and chunked as it is
+        """
+        from txgraylog.protocol.gelf import GelfBuilder
+
+        builder = GelfBuilder(self.template, size=100)
+        self.assertEquals(
+            zlib.decompress(builder.build_encoded('{"a": 1}')[0]),
+            '{"a": 1}')
+
+        message = binascii.hexlify(randbytes.insecureRandom(1000))
+        builder = GelfBuilder(self.template, size=100, compress=False)
+        chunks = builder.build_encoded(message)
+        self.assertEquals(len(chunks), 20)
+        self.assertEquals(''.join([c[38:] for c in chunks]), message)
+
+    def test_overflow(self):
+        """ Test a message needing too many chunks is left to the chunk
+            overflow policy
+        """
+        from txgraylog.protocol.gelf import (
+            GelfBuilder, CHUNK_DROP, MAX_CHUNKS
+        )
+
+        longMessage = binascii.hexlify(randbytes.insecureRandom(4000))
+        event = self.event('short', longMessage, longMessage)
+
+        builder = GelfBuilder(self.template, size=100, compress=False)
+        messages = builder.build(event)
+        self.failUnless(1 < len(messages) <= MAX_CHUNKS)
+        params = json.loads(''.join([m[38:] for m in messages]))
+        self.assertEquals(params['_truncated'], True)
+        self.assertEquals(params['_app'], 'baz')
+
+        builder.chunk_overflow = CHUNK_DROP
+        self.assertEquals(builder.build(event), [])
+        self.assertEquals(builder.datagrams(event), [])
+
+
+class TestChunkIds(unittest.TestCase):
+    """ Test generating the ids of chunked messages
+    """
+
+    def test_unique(self):
+        """ Test ids are the right size and never repeat within a process
+        """
+        from txgraylog.protocol.gelf import ChunkIds
+
+        for size in (8, 32):
+            ids = ChunkIds(size)
+            generated = [ids.next() for _ in xrange(10000)]
+            self.assertEquals(set(len(i) for i in generated), set([size]))
+            self.assertEquals(len(set(generated)), len(generated))
+            self.assertEquals(
+                set(i[:-8] for i in generated), set([generated[0][:-8]]))
+
+    def test_counter_wraps(self):
+        """ Test the counter wraps around rather than growing the id
+        """
+        from txgraylog.protocol.gelf import ChunkIds
+
+        ids = ChunkIds(8)
+        ids.reset()
+        ids._start = 2 ** 64 - 1
+        self.assertEquals(ids.next(), '\xff' * 8)
+        self.assertEquals(ids.next(), '\x00' * 8)
+
+    def test_fork(self):
+        """ Test a forked process starts from a new prefix and counter
+        """
+        from txgraylog.protocol.gelf import ChunkIds
+
+        pids = [100]
+        ids = ChunkIds(32)
+        ids.getpid = lambda: pids[-1]
+        parent = [ids.next() for _ in xrange(3)]
+
+        pids.append(101)
+        child = [ids.next() for _ in xrange(3)]
+
+        self.assertNotEquals(parent[0][:24], child[0][:24])
+        self.assertNotEquals(parent[0][24:], child[0][24:])
+        self.assertEquals(child[0][:24], child[2][:24])
@@ -0,0 +1,168 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Tests for :class: `~txgraylog.protocol.http.HTTPGelfProtocol`
+"""
+import json
+import zlib
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+from twisted.web import resource, server
+
+from txgraylog.protocol.compression import GZIP_WBITS
+from txgraylog.protocol.http import HTTPGelfProtocol
+from txgraylog.test.helpers import make_event
+
+
+class GelfResource(resource.Resource):
+    """ A stand in for a Graylog GELF HTTP input, answering with the given
+        response codes before accepting everything
+    """
+
+    isLeaf = True
+
+    def __init__(self, codes=()):
+        resource.Resource.__init__(self)
+        self.codes = list(codes)
+        self.requests = []
+        self.messages = []
+
+    def render_POST(self, request):
+        body = request.content.read()
+        encoding = request.getHeader('content-encoding')
+        if encoding == 'gzip':
+            body = zlib.decompress(body, GZIP_WBITS)
+        self.requests.append((encoding, body))
+
+        code = self.codes.pop(0) if self.codes else 202
+        request.setResponseCode(code)
+        if code < 300:
+            self.messages.extend(
+                [json.loads(line) for line in body.split('\n')])
+
+        return ''
+
+
+class TestHTTPGelf(unittest.TestCase):
+    """ Test sending GELF messages to a local HTTP server
+    """
+
+    def make_protocol(self, codes=(), **kwargs):
+        self.resource = GelfResource(codes)
+        port = reactor.listenTCP(
+            0, server.Site(self.resource), interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+
+        protocol = HTTPGelfProtocol(
+            '127.0.0.1', port.getHost().port, **kwargs)
+        self.addCleanup(self.disconnect, protocol)
+        protocol.connect()
+        return protocol
+
+    @defer.inlineCallbacks
+    def disconnect(self, protocol):
+        yield protocol.disconnect()
+        # give the server a chance to see the connections close
+        yield task.deferLater(reactor, 0.01, lambda: None)
+
+    def idle(self, protocol, drained=True):
+        """ Wait until the protocol has no requests in flight and, unless
+            told otherwise, nothing left to send
+        """
+        d = defer.Deferred()
+
+        def check():
+            if protocol.in_flight or (drained and len(protocol.buffer)):
+                reactor.callLater(0.01, check)
+            else:
+                d.callback(None)
+        check()
+        return d
+
+    @defer.inlineCallbacks
+    def test_keep_alive(self):
+        """ Test each message is sent gzipped in its own request
+        """
+        protocol = self.make_protocol(concurrency=1)
+        for i in xrange(3):
+            protocol.log_message(make_event('message %d' % (i, )))
+
+        yield self.idle(protocol)
+        self.assertEquals(
+            [m['short_message'] for m in self.resource.messages],
+            ['message 0', 'message 1', 'message 2'])
+        self.assertEquals(
+            [encoding for encoding, _ in self.resource.requests],
+            ['gzip'] * 3)
+        self.assertEquals(protocol.messages_sent, 3)
+        self.assertEquals(protocol.requests, 3)
+
+    @defer.inlineCallbacks
+    def test_batch(self):
+        """ Test messages logged together are sent in one request
+        """
+        protocol = self.make_protocol(batch=True, compress=False)
+        for i in xrange(5):
+            protocol.log_message(make_event('message %d' % (i, )))
+
+        yield self.idle(protocol)
+        self.assertEquals(len(self.resource.requests), 1)
+        self.assertEquals(self.resource.requests[0][0], None)
+        self.assertEquals(protocol.messages_sent, 5)
+
+    @defer.inlineCallbacks
+    def test_retry(self):
+        """ Test messages are sent again after a server error
+        """
+        protocol = self.make_protocol(codes=[503], initial_delay=0.01)
+        protocol.log_message(make_event())
+
+        yield self.idle(protocol)
+        self.assertEquals(len(self.resource.requests), 2)
+        self.assertEquals(protocol.failures, 1)
+        self.assertEquals(protocol.messages_sent, 1)
+        self.assertEquals(protocol.delay, 0.01)
+
+    @defer.inlineCallbacks
+    def test_rejected(self):
+        """ Test messages the server rejects are not sent again
+        """
+        protocol = self.make_protocol(codes=[400])
+        protocol.log_message(make_event('bad'))
+        protocol.log_message(make_event('good'))
+
+        yield self.idle(protocol)
+        self.assertEquals(protocol.rejected, 1)
+        self.assertEquals(
+            [m['short_message'] for m in self.resource.messages], ['good'])
+
+    @defer.inlineCallbacks
+    def test_backoff(self):
+        """ Test the retry delay grows while the server is unreachable and
+            the messages are kept
+        """
+        port = reactor.listenTCP(0, server.Site(GelfResource()))
+        address = port.getHost()
+        yield port.stopListening()
+
+        protocol = HTTPGelfProtocol(
+            '127.0.0.1', address.port, initial_delay=1, factor=2)
+        protocol.clock = clock = task.Clock()
+        self.addCleanup(self.disconnect, protocol)
+        protocol.connect()
+
+        protocol.log_message(make_event())
+        yield self.idle(protocol, drained=False)
+
+        self.assertEquals(protocol.failures, 1)
+        self.failIf(protocol.connected)
+        self.assertEquals(len(protocol.buffer), 1)
+        self.assertEquals(protocol.delay, 2)
+
+        clock.advance(1)
+        yield self.idle(protocol, drained=False)
+        self.assertEquals(protocol.failures, 2)
+        self.assertEquals(protocol.delay, 4)
+        self.assertEquals(len(protocol.buffer), 1)
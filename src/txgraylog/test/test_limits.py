@@ -0,0 +1,168 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Tests for :class: `~txgraylog.protocol.limits.SizeLimits`
+"""
+import datetime
+import json
+
+from twisted.trial import unittest
+from twisted.python.failure import Failure
+
+from txgraylog.protocol.gelf import GelfProtocol, GelfTemplate, MAX_CHUNKS
+from txgraylog.protocol.limits import SizeLimits
+
+
+def recurse(depth):
+    if depth:
+        recurse(depth - 1)
+    raise ValueError('bottom')
+
+
+class Huge(object):
+    def __repr__(self):
+        return 'x' * 1000000
+
+
+class TestSizeLimits(unittest.TestCase):
+    """ Test keeping GELF fields within limits
+    """
+
+    def setUp(self):
+        self.limits = SizeLimits(
+            max_field=1000, max_size=3000, max_frames=10, min_field=100)
+
+    def test_within_limits(self):
+        """ Test fields within the limits are left alone
+        """
+        fields = {'short_message': 'foo', 'level': 6, '_ok': None}
+        self.assertIdentical(self.limits.apply(fields), fields)
+
+    def test_long_field(self):
+        """ Test a long field keeps its start and end
+        """
+        text = 'a' * 5000 + 'b' * 5000
+        fields = self.limits.apply({'_text': text, 'level': 6})
+
+        self.assertEquals(len(fields['_text']), 1000)
+        self.failUnless(fields['_text'].startswith('a' * 200))
+        self.failUnless(fields['_text'].endswith('b' * 700))
+        self.assertIn('...', fields['_text'])
+        self.assertEquals(fields['_truncated'], True)
+        self.assertEquals(fields['level'], 6)
+
+    def test_lines(self):
+        """ Test text of several lines is cut at line breaks
+        """
+        lines = ['line %d' % (i, ) for i in xrange(1000)]
+        text = self.limits.shorten('\n'.join(lines), 500)
+
+        self.failUnless(len(text) <= 500)
+        kept = text.split('\n')
+        self.assertEquals(kept[0], 'line 0')
+        self.assertEquals(kept[-1], 'line 999')
+        self.assertIn('...', kept)
+        for line in kept:
+            self.failUnless(line == '...' or line in lines)
+
+    def test_traceback(self):
+        """ Test the frames in the middle of a deep traceback are left out
+        """
+        try:
+            recurse(100)
+        except ValueError:
+            failure = Failure()
+
+        traceback = self.limits.traceback(failure)
+        self.assertIn('frames omitted', traceback)
+        self.assertEquals(traceback.count('in recurse'), 9)
+        self.failUnless(traceback.rstrip().endswith('ValueError: bottom'))
+        self.assertEquals(len(failure.frames), 102)
+
+    def test_summarize(self):
+        """ Test values which are not strings or numbers are summarized
+        """
+        when = datetime.datetime(2015, 6, 17, 12, 0, 0)
+        fields = self.limits.apply({
+            '_huge': Huge(),
+            '_list': range(10000),
+            '_when': when,
+            '_failure': Failure(ValueError('oops')),
+        })
+
+        self.failUnless(len(fields['_huge']) <= 100)
+        self.failUnless(len(fields['_list']) <= 100)
+        self.assertEquals(fields['_when'], when.isoformat())
+        self.assertEquals(fields['_failure'], 'oops')
+        self.assertEquals(fields['_truncated'], True)
+
+    def test_total_size(self):
+        """ Test the longest fields are shortened to fit the total size
+        """
+        fields = self.limits.apply({
+            '_a': 'a' * 900, '_b': 'b' * 900, '_c': 'c' * 900,
+            '_d': 'd' * 900, '_e': 'e' * 50,
+        })
+
+        total = sum(len(k) + len(v) for k, v in fields.iteritems()
+                    if isinstance(v, str))
+        self.failUnless(total <= 3000, total)
+        self.assertEquals(fields['_e'], 'e' * 50)
+
+
+class TestGelfLimits(unittest.TestCase):
+    """ Test the limits are applied to GELF messages
+    """
+
+    def event(self):
+        try:
+            recurse(500)
+        except ValueError:
+            failure = Failure()
+
+        return {
+            'system': 'limits',
+            'isError': True,
+            'failure': failure,
+            'message': [],
+            'time': 1434567890.123,
+            'payload': Huge(),
+            'body': 'x' * 500000,
+        }
+
+    def test_bounded(self):
+        """ Test a huge event fits in the chunks Graylog accepts without
+            being truncated afterwards
+        """
+        event = self.event()
+        g = GelfProtocol('localhost', compress=False, **event)
+        messages = g.generate()
+
+        self.failUnless(len(messages) <= MAX_CHUNKS)
+        params = json.loads(''.join([m[38:] for m in messages]))
+        self.assertEquals(params['_truncated'], True)
+        self.assertIn('frames omitted', params['full_message'])
+        self.assertEquals(params['short_message'], 'bottom')
+
+    def test_template(self):
+        """ Test a template applies the same limits
+        """
+        event = self.event()
+        plain = GelfProtocol('localhost', compress=False, **event)
+        templated = GelfProtocol(
+            'localhost', compress=False, template=GelfTemplate('localhost'),
+            **event)
+
+        self.assertEquals(
+            json.loads(templated.encoded_log_params),
+            json.loads(plain.encoded_log_params))
+
+    def test_no_limits(self):
+        """ Test limits can be turned off
+        """
+        g = GelfProtocol(
+            'localhost', compress=False, limits=None,
+            **dict(self.event(), payload=1))
+        self.failIf('_truncated' in g.log_params)
+        self.assertEquals(len(g.log_params['_body']), 500000)
@@ -0,0 +1,128 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Tests for :class: `~txgraylog.metrics.Metrics`
+"""
+import json
+import zlib
+
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.python import failure
+
+from txgraylog.buffering import message_size
+from txgraylog.metrics import Histogram, Metrics
+from txgraylog.observer import GraylogObserver
+from txgraylog.protocol.gelf import WAN_CHUNK
+from txgraylog.protocol.tcp import TCPGraylogFactory, TCPPlainTextProtocol
+from txgraylog.protocol.udp import UDPGelfProtocol
+from txgraylog.test.helpers import make_event
+from txgraylog.throttle import Throttle
+
+
+class TestHistogram(unittest.TestCase):
+    """ Test counting observations in buckets
+    """
+
+    def test_snapshot(self):
+        """ Test the summary of the observations
+        """
+        histogram = Histogram([10, 100])
+        for value in (1, 5, 50, 500):
+            histogram.observe(value)
+
+        snapshot = histogram.snapshot()
+        self.assertEquals(snapshot['count'], 4)
+        self.assertEquals(snapshot['max'], 500)
+        self.assertEquals(snapshot['mean'], 139)
+        self.assertEquals(snapshot['buckets'], [(10, 2), (100, 1), (None, 1)])
+        self.assertEquals(snapshot['p50'], 10)
+        self.assertEquals(snapshot['p99'], 500)
+
+    def test_empty(self):
+        """ Test a histogram with no observations
+        """
+        snapshot = Histogram([10]).snapshot()
+        self.assertEquals(snapshot['mean'], 0)
+        self.assertEquals(snapshot['p99'], 0)
+
+
+class TestMetrics(unittest.TestCase):
+    """ Test collecting metrics from the observer and its protocols
+    """
+
+    def make_observer(self, **kwargs):
+        observer = GraylogObserver(
+            UDPGelfProtocol, '127.0.0.1', 12201, **kwargs)
+        self.addCleanup(observer.protocol.transport.stopListening)
+        return observer
+
+    def test_encoded(self):
+        """ Test events, messages, bytes and chunks are counted
+        """
+        observer = self.make_observer(compression=False)
+        observer.emit(make_event())
+        observer.emit(make_event('x' * WAN_CHUNK))
+
+        # the message and full message are each a chunk long
+        metrics = observer.metrics.snapshot()
+        self.assertEquals(metrics['events'], 2)
+        self.assertEquals(metrics['messages'], 4)
+        self.assertEquals(metrics['chunks'], 3)
+        self.assertEquals(
+            metrics['bytes_encoded'],
+            sum(message_size(m) for m in observer.protocol.buffer))
+        self.assertEquals(metrics['encode_time']['count'], 2)
+        self.assertEquals(metrics['payload_size']['count'], 2)
+
+        # not yet connected, so everything was buffered, with the chunks
+        # of the full message kept together
+        self.assertEquals(metrics['buffered'], 2)
+        self.assertEquals(metrics['buffered_total'], 2)
+
+    def test_components(self):
+        """ Test the counters of the buffer and throttle are read
+        """
+        observer = self.make_observer(throttle=Throttle(rate=2))
+        observer.protocol.buffer.max_count = 1
+        for _ in xrange(4):
+            observer.emit(make_event())
+
+        metrics = observer.metrics.snapshot()
+        self.assertEquals(metrics['events'], 4)
+        self.assertEquals(metrics['throttle_dropped'], 2)
+        self.assertEquals(metrics['buffer_dropped'], 1)
+        self.assertEquals(metrics['buffered'], 1)
+
+    def test_reconnects(self):
+        """ Test reconnects are counted by the factory
+        """
+        factory = TCPGraylogFactory(TCPPlainTextProtocol('localhost', 12201))
+        factory.continueTrying = False
+        metrics = Metrics()
+        metrics.factories = [factory]
+
+        factory.clientConnectionFailed(None, failure.Failure(ValueError()))
+        self.assertEquals(metrics.snapshot()['reconnects'], 1)
+
+    def test_report(self):
+        """ Test the metrics are reported to Graylog periodically
+        """
+        observer = self.make_observer(report_interval=60)
+        observer.clock = task.Clock()
+        observer.start()
+        self.addCleanup(observer.stop)
+        observer.emit(make_event())
+
+        observer.clock.advance(60)
+        buffered = list(observer.protocol.buffer)
+        self.assertEquals(len(buffered), 2)
+
+        report = json.loads(zlib.decompress(buffered[-1]))
+        self.assertEquals(report['short_message'], 'txGraylog metrics')
+        self.assertEquals(report['facility'], 'txgraylog.metrics')
+        self.assertEquals(report['_events'], 1)
+        self.assertEquals(report['_messages'], 1)
+        self.assertEquals(report['_encode_time_count'], 1)
+        self.failIf('_encode_time' in report)
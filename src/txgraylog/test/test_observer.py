@@ -0,0 +1,147 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Tests for :class: `~txgraylog.observer.GraylogLogObserver`
+"""
+import json
+
+from twisted.trial import unittest
+from twisted.python import failure
+from twisted.logger import Logger, LogLevel, PredicateResult
+
+from txgraylog.observer import GraylogLogObserver
+from txgraylog.protocol.udp import UDPGelfProtocol
+from txgraylog.throttle import Throttle
+
+
+class FakeProtocol(object):
+    """ Protocol recording the events it is given
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def log_message(self, event):
+        self.events.append(event)
+
+
+class Formatted(object):
+    """ A format argument counting the times it is rendered
+    """
+
+    def __init__(self):
+        self.rendered = 0
+
+    def __str__(self):
+        self.rendered += 1
+        return 'formatted'
+
+
+class TestGraylogLogObserver(unittest.TestCase):
+    """ Test sending twisted.logger events to Graylog
+    """
+
+    def make_observer(self, **kwargs):
+        observer = GraylogLogObserver(
+            UDPGelfProtocol, '127.0.0.1', 12201, **kwargs)
+        self.addCleanup(observer.protocol.transport.stopListening)
+        self.gelf = observer.protocol
+        observer.protocol = FakeProtocol()
+        return observer
+
+    def test_convert(self):
+        """ Test events are mapped to GELF fields
+        """
+        observer = self.make_observer()
+        log = Logger(namespace='app.web', observer=observer)
+        log.warn('GET {path} took {seconds}s', path='/', seconds=1.5)
+
+        event, = observer.protocol.events
+        self.assertEquals(event['message'], (u'GET / took 1.5s', ))
+        self.assertEquals(event['level'], 4)
+        self.assertEquals(event['system'], 'app.web')
+        self.assertEquals(event['format'], 'GET {path} took {seconds}s')
+        self.assertEquals(event['path'], '/')
+        self.failIf(event['isError'])
+        self.failIf([key for key in event if key.startswith('log_')])
+
+        params = json.loads(self.gelf.encode(event)[0].decode('zlib'))
+        self.assertEquals(params['short_message'], u'GET / took 1.5s')
+        self.assertEquals(params['level'], 4)
+        self.assertEquals(params['facility'], 'app.web')
+        self.assertEquals(params['_seconds'], 1.5)
+        self.assertEquals(params['_format'], 'GET {path} took {seconds}s')
+
+    def test_failure(self):
+        """ Test failures are sent with the rendered message
+        """
+        observer = self.make_observer()
+        log = Logger(namespace='app', observer=observer)
+        try:
+            1 / 0
+        except ZeroDivisionError:
+            log.failure('Dividing {what}', what='things')
+
+        event, = observer.protocol.events
+        self.failUnless(event['isError'])
+        self.assertIsInstance(event['failure'], failure.Failure)
+        self.assertEquals(event['why'], u'Dividing things')
+        self.assertEquals(event['level'], 2)
+
+    def test_level_filter(self):
+        """ Test events below the level are dropped before being formatted
+        """
+        observer = self.make_observer(level=LogLevel.warn)
+        log = Logger(namespace='app', observer=observer)
+        arg = Formatted()
+        log.debug('{arg}', arg=arg)
+        log.info('{arg}', arg=arg)
+        log.error('{arg}', arg=arg)
+
+        self.assertEquals(len(observer.protocol.events), 1)
+        self.assertEquals(arg.rendered, 1)
+        self.assertEquals(observer.filtered, 2)
+
+    def test_namespace_filter(self):
+        """ Test only events from the namespaces and those below them are
+            sent
+        """
+        observer = self.make_observer(namespaces=['app.web'])
+        for namespace in ('app.web', 'app.web.client', 'app.webhooks', 'db'):
+            Logger(namespace=namespace, observer=observer).info('hello')
+
+        self.assertEquals(
+            [event['system'] for event in observer.protocol.events],
+            ['app.web', 'app.web.client'])
+
+    def test_predicates(self):
+        """ Test events are dropped by predicates returning False or
+            PredicateResult.no
+        """
+        observer = self.make_observer(predicates=[
+            lambda event: 'secret' not in event,
+            lambda event: (
+                PredicateResult.no if event.get('noisy')
+                else PredicateResult.maybe),
+        ])
+        log = Logger(namespace='app', observer=observer)
+        log.info('one', secret='hunter2')
+        log.info('two', noisy=True)
+        log.info('three')
+
+        event, = observer.protocol.events
+        self.assertEquals(event['message'], (u'three', ))
+
+    def test_throttle(self):
+        """ Test events are throttled after being filtered
+        """
+        observer = self.make_observer(throttle=Throttle(dedupe_window=10))
+        log = Logger(namespace='app', observer=observer)
+        for _ in xrange(3):
+            log.error('connection refused')
+        observer.stop()
+
+        first, merged = observer.protocol.events
+        self.failIf('repeat_count' in first)
+        self.assertEquals(merged['repeat_count'], 2)
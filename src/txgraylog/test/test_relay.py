@@ -0,0 +1,204 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Tests for :class: `~txgraylog.protocol.relay.RelayGelfProtocol`
+"""
+import json
+import os
+import zlib
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+from twisted.internet.protocol import Factory, Protocol
+from twisted.test import proto_helpers
+
+from txgraylog.observer import GraylogObserver
+from txgraylog.protocol.gelf import GelfProtocol
+from txgraylog.protocol.relay import RelayFactory, RelayGelfProtocol
+from txgraylog.protocol.tcp import TCPGelfProtocol
+from txgraylog.protocol.udp import UDPGelfProtocol
+from txgraylog.service import GraylogRelayService
+from txgraylog.test.helpers import make_event
+
+
+class FakeUpstream(object):
+    """ Records the messages forwarded to it
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    def send_encoded(self, message, level):
+        self.sent.append((json.loads(message)['short_message'], level))
+
+
+class GelfInput(Protocol):
+    """ A stand in for a Graylog GELF TCP input
+    """
+
+    def connectionMade(self):
+        self.factory.connections += 1
+        self.data = ''
+
+    def dataReceived(self, data):
+        self.data += data
+        while '\x00' in self.data:
+            message, self.data = self.data.split('\x00', 1)
+            self.factory.messages.append(json.loads(message))
+
+
+class TestRelayProtocol(unittest.TestCase):
+    """ Test the messages workers send to the relay
+    """
+
+    def test_framing(self):
+        """ Test messages are sent serialized with their level
+        """
+        protocol = RelayGelfProtocol('/tmp/relay.sock')
+        protocol.clock = task.Clock()
+        protocol.makeConnection(proto_helpers.StringTransport())
+
+        protocol.log_message(make_event('foo'))
+        protocol.log_message(make_event('bar', level=3))
+        protocol.clock.advance(0)
+
+        records = protocol.transport.value().split('\x00')
+        self.assertEquals(records[-1], '')
+        self.assertEquals([r[0] for r in records[:-1]], ['6', '3'])
+        self.assertEquals(
+            [json.loads(r[1:])['short_message'] for r in records[:-1]],
+            ['foo', 'bar'])
+
+    def test_frame_level(self):
+        """ Test levels which are not a single digit are framed as one
+            the relay can read
+        """
+        protocol = RelayGelfProtocol('/tmp/relay.sock')
+        protocol.clock = task.Clock()
+        protocol.makeConnection(proto_helpers.StringTransport())
+
+        protocol.log_message(make_event('foo', level='warning'))
+        protocol.log_message(make_event('bar', level=12))
+        protocol.log_message(make_event('baz', level=-1))
+        protocol.clock.advance(0)
+
+        upstream = FakeUpstream()
+        receiver = RelayFactory(upstream).buildProtocol(None)
+        receiver.makeConnection(proto_helpers.StringTransport())
+        receiver.dataReceived(protocol.transport.value())
+        self.assertEquals(
+            upstream.sent, [('foo', 6), ('bar', 9), ('baz', 0)])
+        self.assertEquals(receiver.factory.errors, 0)
+
+
+class TestRelayFactory(unittest.TestCase):
+    """ Test the relay receiving and forwarding messages
+    """
+
+    def setUp(self):
+        self.upstream = FakeUpstream()
+        self.factory = RelayFactory(self.upstream, max_length=100)
+        self.receiver = self.factory.buildProtocol(None)
+        self.receiver.makeConnection(proto_helpers.StringTransport())
+
+    def test_forward(self):
+        """ Test messages split over several reads are forwarded
+        """
+        data = '6{"short_message": "foo"}\x003{"short_message": "bar"}\x00'
+        self.receiver.dataReceived(data[:10])
+        self.receiver.dataReceived(data[10:40])
+        self.receiver.dataReceived(data[40:])
+
+        self.assertEquals(self.upstream.sent, [('foo', 6), ('bar', 3)])
+        self.assertEquals(self.factory.received, 2)
+        self.assertEquals(self.factory.workers, 1)
+
+    def test_bad_level(self):
+        """ Test messages without a level are dropped
+        """
+        self.receiver.dataReceived('{"short_message": "foo"}\x00')
+        self.assertEquals(self.upstream.sent, [])
+        self.assertEquals(self.factory.errors, 1)
+
+    def test_oversized(self):
+        """ Test a worker sending a message which is too long is dropped
+        """
+        self.receiver.dataReceived('6' + 'x' * 200)
+        self.failUnless(self.receiver.transport.disconnecting)
+        self.assertEquals(self.factory.oversized, 1)
+
+
+class TestSendEncoded(unittest.TestCase):
+    """ Test sending messages which have already been serialized
+    """
+
+    def test_udp(self):
+        """ Test serialized messages are compressed and chunked for UDP
+        """
+        message = GelfProtocol(
+            'worker', compress=False, **make_event('x' * 20000)).generate()[0]
+        protocol = UDPGelfProtocol('127.0.0.1', 12201, compression=False)
+        sent = []
+        protocol._send = lambda datagrams, level: sent.extend(datagrams)
+
+        protocol.send_encoded(message, 6)
+        self.failUnless(len(sent) > 1)
+        self.failUnless(all(d.startswith('\x1e\x0f') for d in sent))
+
+        del sent[:]
+        protocol.compression = True
+        protocol.send_encoded(message, 6)
+        self.assertEquals(len(sent), 1)
+        self.assertEquals(zlib.decompress(sent[0]), message)
+
+
+class TestRelayService(unittest.TestCase):
+    """ Test workers logging through a relay
+    """
+
+    @defer.inlineCallbacks
+    def test_relay(self):
+        """ Test the messages of several workers reach Graylog over the
+            relay's connection
+        """
+        graylog = Factory()
+        graylog.protocol = GelfInput
+        graylog.connections = 0
+        graylog.messages = []
+        port = reactor.listenTCP(0, graylog, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+
+        path = self.mktemp()
+        relay = GraylogRelayService(
+            TCPGelfProtocol, '127.0.0.1', port.getHost().port, path)
+        relay.startService()
+        self.addCleanup(relay.stopService)
+        self.addCleanup(self.disconnect, relay.observer)
+
+        workers = [
+            GraylogObserver(RelayGelfProtocol, path, None) for _ in xrange(3)]
+        for i, worker in enumerate(workers):
+            self.addCleanup(self.disconnect, worker)
+            worker.protocol.log_message(make_event(
+                'worker %d' % (i, ), system='worker'))
+
+        self.assertEquals(os.stat(path).st_mode & 0777, 0600)
+
+        while relay.relay.received < 3:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        yield task.deferLater(reactor, 0.01, lambda: None)
+
+        # the relay sends its own log messages too
+        self.assertEquals(
+            sorted(m['short_message'] for m in graylog.messages
+                   if m['facility'] == 'worker'),
+            ['worker 0', 'worker 1', 'worker 2'])
+        self.assertEquals(graylog.connections, 1)
+        self.assertEquals(relay.relay.workers, 3)
+
+    def disconnect(self, observer):
+        for factory in observer.metrics.factories:
+            factory.stopTrying()
+        observer.protocol.transport.loseConnection()
+        return task.deferLater(reactor, 0.01, lambda: None)
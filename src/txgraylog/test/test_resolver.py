@@ -0,0 +1,205 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Tests for :class: `~txgraylog.resolver.Resolver`
+"""
+import socket
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+
+from txgraylog.protocol.tcp import TCPGraylogFactory, TCPPlainTextProtocol
+from txgraylog.protocol.udp import UDPGelfProtocol
+from txgraylog.resolver import Resolver, system_lookup
+
+
+class FakeLookup(object):
+    """ Answers lookups with whatever the test sets, recording them
+    """
+
+    def __init__(self, addresses, ttl=None):
+        self.addresses = addresses
+        self.ttl = ttl
+        self.fail = False
+        self.hosts = []
+
+    def __call__(self, host, family):
+        self.hosts.append(host)
+        if self.fail:
+            return defer.fail(socket.gaierror(socket.EAI_AGAIN, 'timeout'))
+        return defer.succeed((list(self.addresses), self.ttl))
+
+
+class TestResolver(unittest.TestCase):
+    """ Test caching and refreshing the addresses of a host
+    """
+
+    def make_resolver(self, addresses, record_ttl=None, **kwargs):
+        self.lookup = FakeLookup(addresses, record_ttl)
+        resolver = Resolver('graylog', lookup=self.lookup, **kwargs)
+        resolver.clock = self.clock = task.Clock()
+        return resolver
+
+    def test_ip_address(self):
+        """ Test IP addresses are not looked up
+        """
+        for host in ('10.0.0.1', '::1'):
+            resolver = Resolver(host, lookup=None)
+            self.assertEquals(
+                self.successResultOf(resolver.start()), [host])
+            self.assertEquals(resolver.lookups, 0)
+
+    def test_cached(self):
+        """ Test the addresses are looked up once and refreshed once the
+            default TTL has passed
+        """
+        resolver = self.make_resolver(['10.0.0.1'], ttl=30)
+        self.assertEquals(
+            self.successResultOf(resolver.start()), ['10.0.0.1'])
+        self.successResultOf(resolver.start())
+        self.assertEquals(resolver.lookups, 1)
+
+        self.clock.advance(29)
+        self.assertEquals(resolver.lookups, 1)
+        self.clock.advance(1)
+        self.assertEquals(resolver.lookups, 2)
+        resolver.stop()
+
+    def test_record_ttl(self):
+        """ Test the TTL of the records is used, within the limits
+        """
+        resolver = self.make_resolver(
+            ['10.0.0.1'], record_ttl=5, max_ttl=10)
+        resolver.start()
+        self.assertEquals(resolver.expires, 5)
+
+        self.lookup.ttl = 3600
+        self.clock.advance(5)
+        self.assertEquals(resolver.expires, 15)
+
+        self.lookup.ttl = 0
+        self.clock.advance(10)
+        self.assertEquals(resolver.expires, 16)
+        resolver.stop()
+
+    def test_changed(self):
+        """ Test subscribers are told when the addresses change
+        """
+        resolver = self.make_resolver(['10.0.0.1'], record_ttl=10)
+        seen = []
+        resolver.start()
+        resolver.subscribe(seen.append)
+
+        self.clock.advance(10)
+        self.lookup.addresses = ['10.0.0.2', '10.0.0.3']
+        self.clock.advance(10)
+
+        self.assertEquals(seen, [['10.0.0.1'], ['10.0.0.2', '10.0.0.3']])
+        self.assertEquals(resolver.changes, 2)
+        resolver.stop()
+
+    def test_failure(self):
+        """ Test the addresses are kept when a lookup fails and the lookup
+            is retried sooner
+        """
+        resolver = self.make_resolver(
+            ['10.0.0.1'], record_ttl=60, retry_delay=5)
+        resolver.start()
+
+        self.lookup.fail = True
+        self.clock.advance(60)
+        self.assertEquals(resolver.failures, 1)
+        self.assertEquals(resolver.addresses, ['10.0.0.1'])
+
+        self.lookup.fail = False
+        self.lookup.addresses = ['10.0.0.2']
+        self.clock.advance(5)
+        self.assertEquals(resolver.addresses, ['10.0.0.2'])
+        resolver.stop()
+
+    def test_first_failure(self):
+        """ Test starting fails if the host cannot be resolved at all
+        """
+        resolver = self.make_resolver([])
+        self.lookup.fail = True
+        self.failureResultOf(resolver.start(), socket.gaierror)
+        resolver.stop()
+
+    def test_choose(self):
+        """ Test the addresses are chosen in turn, of the given family
+        """
+        resolver = self.make_resolver(['10.0.0.1', '10.0.0.2', '::2'])
+        resolver.start()
+
+        self.assertEquals(
+            [resolver.choose(socket.AF_INET) for _ in xrange(3)],
+            ['10.0.0.1', '10.0.0.2', '10.0.0.1'])
+        self.assertEquals(resolver.choose(socket.AF_INET6), '::2')
+        resolver.stop()
+
+    @defer.inlineCallbacks
+    def test_system_lookup(self):
+        """ Test looking a host up with the system resolver
+        """
+        addresses, ttl = yield system_lookup('localhost', socket.AF_INET)
+        self.assertIn('127.0.0.1', addresses)
+        self.assertIdentical(ttl, None)
+
+
+class TestFollowAddresses(unittest.TestCase):
+    """ Test the senders follow the addresses of their host
+    """
+
+    def make_resolver(self, addresses):
+        self.lookup = FakeLookup(addresses, ttl=10)
+        resolver = Resolver('graylog', lookup=self.lookup)
+        resolver.clock = self.clock = task.Clock()
+        self.addCleanup(resolver.stop)
+        return resolver
+
+    def test_udp(self):
+        """ Test the UDP socket is connected to the new address when the
+            host moves
+        """
+        resolver = self.make_resolver(['127.0.0.1'])
+        protocol = UDPGelfProtocol('graylog', 12201, resolver=resolver)
+        port = reactor.listenUDP(0, protocol, interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        protocol.resolve()
+
+        self.failUnless(protocol.connected)
+        self.assertEquals(
+            port.socket.getpeername(), ('127.0.0.1', 12201))
+
+        self.lookup.addresses = ['127.0.0.2', '127.0.0.1']
+        self.clock.advance(10)
+        self.assertEquals(protocol.readdressed, 0)
+
+        self.lookup.addresses = ['127.0.0.2']
+        self.clock.advance(10)
+        self.assertEquals(protocol.readdressed, 1)
+        self.assertEquals(protocol.host_address, '127.0.0.2')
+        self.assertEquals(
+            port.socket.getpeername(), ('127.0.0.2', 12201))
+
+    def test_tcp(self):
+        """ Test TCP reconnects go to the latest addresses
+        """
+        resolver = self.make_resolver(['127.0.0.1', '127.0.0.2'])
+        protocol = TCPPlainTextProtocol('graylog', 12201, resolver=resolver)
+        factory = TCPGraylogFactory(protocol)
+        factory.continueTrying = False
+        resolver.start()
+
+        class Connector(object):
+            host = 'graylog'
+
+            def connect(self):
+                pass
+
+        connector = Connector()
+        factory.retry(connector)
+        self.assertEquals(connector.host, '127.0.0.1')
+        factory.retry(connector)
+        self.assertEquals(connector.host, '127.0.0.2')
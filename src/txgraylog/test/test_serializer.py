@@ -0,0 +1,96 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Tests for :mod: `~txgraylog.protocol.serializer`
+"""
+import json
+import zlib
+import datetime
+
+from twisted.trial import unittest
+from twisted.python import failure
+
+from txgraylog.protocol import serializer
+from txgraylog.protocol.gelf import GelfProtocol
+
+
+def make_failure():
+    try:
+        1 / 0
+    except ZeroDivisionError:
+        return failure.Failure()
+
+
+class TestSerializer(unittest.TestCase):
+    """ Test choosing and using the JSON backends
+    """
+
+    def event(self):
+        return {
+            'version': '1.0',
+            'host': 'localhost',
+            'short_message': u'caf\xe9 is open',
+            'full_message': 'caf\xc3\xa9 is open\n\ttab\x00',
+            'timestamp': 1434567890.123,
+            'level': 3,
+            'facility': 'a/b',
+            '_failure': make_failure(),
+            '_tags': set(['web']),
+            '_when': datetime.date(2015, 6, 1),
+            '_object': object,
+            '_nested': {'list': [1, 2.5, None, True]},
+        }
+
+    def test_backends_equivalent(self):
+        """ Test every installed backend produces the same document
+        """
+        expected = json.loads(serializer.get_backend('json')(self.event()))
+        for name in serializer.available():
+            dumps = serializer.get_backend(name)
+            self.assertEquals(json.loads(dumps(self.event())), expected)
+
+    def test_default(self):
+        """ Test values JSON cannot represent are summarized
+        """
+        params = json.loads(serializer.dumps(self.event()))
+        self.assertEquals(
+            params['_failure'], 'integer division or modulo by zero')
+        self.assertEquals(params['_tags'], ['web'])
+        self.assertEquals(params['_when'], '2015-06-01')
+        self.assertEquals(params['_object'], str(object))
+
+    def test_compact(self):
+        """ Test the output has no padding, which GelfTemplate relies on
+        """
+        self.assertEquals(serializer.dumps({'a': [1, 2]}), '{"a":[1,2]}')
+
+    def test_invalid_utf8(self):
+        """ Test byte strings which are not UTF-8 do not fail the message
+        """
+        params = json.loads(serializer.get_backend('json')({'a': '\xff'}))
+        self.assertEquals(params, {'a': u'\xff'})
+
+    def test_unknown_backend(self):
+        """ Test asking for a backend we do not know about
+        """
+        self.assertRaises(ValueError, serializer.get_backend, 'yaml')
+
+    def test_use(self):
+        """ Test switching the backend used for GELF messages
+        """
+        self.addCleanup(serializer.use, serializer.backend)
+        serializer.use('json')
+        self.assertEquals(serializer.backend, 'json')
+
+        g = GelfProtocol('localhost', **{
+            'system': 'protocol',
+            'message': ['this is a log message'],
+            'isError': False,
+            'time': 1434567890.123,
+            'failure': make_failure(),
+            'extra': make_failure(),
+        })
+        params = json.loads(zlib.decompress(g.generate()[0]))
+        self.assertEquals(
+            params['_extra'], 'integer division or modulo by zero')
@@ -0,0 +1,123 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Tests for :class: `~txgraylog.spill.SpillQueue`
+"""
+import os
+
+from twisted.trial import unittest
+
+from txgraylog.buffering import MessageBuffer
+from txgraylog.spill import SpillQueue
+
+
+class TestSpillQueue(unittest.TestCase):
+    """ Test spilling messages to disk
+    """
+
+    def setUp(self):
+        self.directory = self.mktemp()
+
+    def segments(self):
+        return sorted(os.listdir(self.directory))
+
+    def test_fifo_order(self):
+        """ Test messages are read back in the order they were written
+        """
+        spill = SpillQueue(self.directory)
+        spill.append('foo', 6)
+        spill.append('bar', 3)
+
+        self.assertEquals(len(spill), 2)
+        self.assertEquals(list(spill), ['foo', 'bar'])
+        self.assertEquals(spill.popleft(), ('foo', 6))
+
+        spill.append('baz', 7)
+        self.assertEquals(spill.popleft(), ('bar', 3))
+        self.assertEquals(spill.popleft(), ('baz', 7))
+        self.assertRaises(IndexError, spill.popleft)
+
+    def test_chunked(self):
+        """ Test the datagrams of a chunked message are read back together
+        """
+        spill = SpillQueue(self.directory)
+        spill.append(('\x1e\x0f1', '', '\x1e\x0f3'), 3)
+        spill.append('foo', 6)
+
+        self.assertEquals(list(spill), [('\x1e\x0f1', '', '\x1e\x0f3'), 'foo'])
+        self.assertEquals(
+            spill.popleft(), (('\x1e\x0f1', '', '\x1e\x0f3'), 3))
+        self.assertEquals(spill.popleft(), ('foo', 6))
+
+    def test_segments_removed(self):
+        """ Test segments are deleted once they have been read
+        """
+        spill = SpillQueue(self.directory, segment_size=10)
+        for message in ('foo', 'bar', 'baz'):
+            spill.append(message * 3, 6)
+
+        self.assertEquals(len(self.segments()), 3)
+        spill.popleft()
+        spill.popleft()
+        self.assertEquals(self.segments(), ['00000002.spill'])
+        spill.popleft()
+        self.assertEquals(self.segments(), [])
+
+    def test_max_bytes(self):
+        """ Test messages are refused once the queue is full
+        """
+        spill = SpillQueue(self.directory, max_bytes=16)
+        self.failUnless(spill.append('foo', 6))
+        self.failUnless(spill.append('bar', 6))
+        self.failIf(spill.append('baz', 6))
+        self.assertEquals(list(spill), ['foo', 'bar'])
+
+    def test_reopen(self):
+        """ Test messages left on disk are replayed by a new queue
+        """
+        spill = SpillQueue(self.directory)
+        spill.append('foo', 6)
+        spill.append('bar', 6)
+        spill.popleft()
+        spill.close()
+
+        spill = SpillQueue(self.directory)
+        spill.append('baz', 6)
+        self.assertEquals(len(spill), 3)
+        self.assertEquals(list(spill), ['foo', 'bar', 'baz'])
+
+    def test_partial_record(self):
+        """ Test a record cut short by a crash is ignored
+        """
+        spill = SpillQueue(self.directory)
+        spill.append('foo', 6)
+        spill.close()
+        with open(os.path.join(self.directory, self.segments()[0]), 'ab') as f:
+            f.write('\x00\x00\x00\x09\x06bar')
+
+        spill = SpillQueue(self.directory)
+        self.assertEquals(len(spill), 1)
+        self.assertEquals(spill.popleft(), ('foo', 6))
+        self.assertEquals(self.segments(), [])
+
+    def test_buffer_overflow(self):
+        """ Test a message buffer spills to disk once it is full and keeps
+            messages in order
+        """
+        buf = MessageBuffer(max_count=2, spill=SpillQueue(self.directory))
+        for message in ('foo', 'bar', 'baz'):
+            buf.append(message, 6)
+
+        self.assertEquals(buf.count, 2)
+        self.assertEquals(len(buf), 3)
+
+        self.assertEquals(buf.popleft(), ('foo', 6))
+        buf.append('qux', 6)
+        self.assertEquals(list(buf), ['bar', 'baz', 'qux'])
+        self.assertEquals(buf.dropped, 0)
+
+        sent = []
+        buf.replay(lambda message, level: sent.append(message))
+        self.assertEquals(sent, ['bar', 'baz', 'qux'])
+        self.assertEquals(self.segments(), [])
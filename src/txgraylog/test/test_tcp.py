@@ -0,0 +1,357 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Tests for :class: `~txgraylog.protocol.tcp.TCPPlainTextProtocol`
+"""
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+from twisted.test import proto_helpers
+
+from txgraylog.buffering import MessageBuffer
+from txgraylog.protocol.tcp import (
+    TCPPlainTextProtocol, TCPConnectionPool, LEAST_BUFFERED
+)
+
+
+class WriteCountingTransport(proto_helpers.StringTransport):
+    """ String transport which keeps track of the number of writes
+    """
+
+    writes = 0
+
+    def write(self, data):
+        self.writes += 1
+        proto_helpers.StringTransport.write(self, data)
+
+
+class TestTCPCoalescing(unittest.TestCase):
+    """ Test the batching of writes in the TCP protocol
+    """
+
+    def connect(self, **kwargs):
+        protocol = TCPPlainTextProtocol('localhost', 12201, **kwargs)
+        protocol.clock = task.Clock()
+        protocol.makeConnection(WriteCountingTransport())
+        return protocol
+
+    def test_write_per_message(self):
+        """ Test each message is written straight away by default
+        """
+        protocol = self.connect()
+        protocol.send_to_graylog('foo')
+        protocol.send_to_graylog('bar')
+
+        self.assertEquals(protocol.transport.value(), 'foo\x00bar\x00')
+        self.assertEquals(protocol.transport.writes, 2)
+
+    def test_flush_on_deadline(self):
+        """ Test pending messages are written in one go once the flush delay
+            has passed
+        """
+        protocol = self.connect(coalesce=True, flush_delay=0.05)
+        protocol.send_to_graylog('foo')
+        protocol.send_to_graylog('bar')
+
+        self.assertEquals(protocol.transport.value(), '')
+
+        protocol.clock.advance(0.05)
+        self.assertEquals(protocol.transport.value(), 'foo\x00bar\x00')
+        self.assertEquals(protocol.transport.writes, 1)
+
+    def test_flush_on_size(self):
+        """ Test pending messages are written once the flush size is reached
+        """
+        protocol = self.connect(coalesce=True, flush_size=8)
+        protocol.send_to_graylog('foo')
+        self.assertEquals(protocol.transport.value(), '')
+
+        protocol.send_to_graylog('bar')
+        self.assertEquals(protocol.transport.value(), 'foo\x00bar\x00')
+        self.assertEquals(protocol.transport.writes, 1)
+        self.assertEquals(protocol.clock.getDelayedCalls(), [])
+
+    def test_pending_kept_on_disconnect(self):
+        """ Test a batch which was never written is buffered when we lose
+            the connection
+        """
+        protocol = self.connect(coalesce=True)
+        protocol.send_to_graylog('foo')
+        protocol.connectionLost(None)
+
+        self.assertEquals(list(protocol.buffer), ['foo\x00'])
+        self.assertEquals(protocol.clock.getDelayedCalls(), [])
+
+
+class TestTCPBuffering(unittest.TestCase):
+    """ Test buffering messages while disconnected
+    """
+
+    def test_replay_in_order(self):
+        """ Test messages buffered while disconnected are sent in the order
+            they were logged once we connect
+        """
+        protocol = TCPPlainTextProtocol('localhost', 12201)
+        protocol.send_to_graylog('foo')
+        protocol.send_to_graylog('bar')
+        protocol.makeConnection(WriteCountingTransport())
+
+        self.assertEquals(protocol.transport.value(), 'foo\x00bar\x00')
+        self.assertEquals(protocol.buffer.replayed, 2)
+
+    def test_replay_unbatched(self):
+        """ Test the whole buffer is replayed straight away, as the
+            transport paces the replay rather than the buffer's batches,
+            and messages sent afterwards follow it
+        """
+        protocol = TCPPlainTextProtocol(
+            'localhost', 12201, buffer=MessageBuffer(replay_batch=1))
+        protocol.buffer.clock = task.Clock()
+        protocol.send_to_graylog('foo')
+        protocol.send_to_graylog('bar')
+        protocol.makeConnection(WriteCountingTransport())
+        protocol.send_to_graylog('baz')
+
+        self.assertEquals(protocol.transport.value(), 'foo\x00bar\x00baz\x00')
+        self.assertEquals(protocol.buffer.clock.getDelayedCalls(), [])
+
+
+class PausingTransport(WriteCountingTransport):
+    """ String transport which pauses its producer once it has been
+        written to a number of times, as a full write buffer would
+    """
+
+    def __init__(self, pause_after):
+        WriteCountingTransport.__init__(self)
+        self.pause_after = pause_after
+
+    def write(self, data):
+        WriteCountingTransport.write(self, data)
+        if self.writes == self.pause_after:
+            self.producer.pauseProducing()
+
+
+class SlowTransport(WriteCountingTransport):
+    """ String transport which pauses its producer once a number of writes
+        are waiting, and resumes it when they have been sent
+    """
+
+    def __init__(self, buffer_writes):
+        WriteCountingTransport.__init__(self)
+        self.buffer_writes = buffer_writes
+        self.waiting = 0
+
+    def write(self, data):
+        WriteCountingTransport.write(self, data)
+        self.waiting += 1
+        if self.waiting == self.buffer_writes:
+            self.producer.pauseProducing()
+
+    def send(self):
+        self.waiting = 0
+        self.producer.resumeProducing()
+
+
+class TestTCPBackpressure(unittest.TestCase):
+    """ Test holding messages in our buffer while the transport is full
+    """
+
+    def connect(self, transport=None, **kwargs):
+        protocol = TCPPlainTextProtocol('localhost', 12201, **kwargs)
+        protocol.clock = task.Clock()
+        protocol.makeConnection(transport or WriteCountingTransport())
+        return protocol
+
+    def test_registers_producer(self):
+        """ Test we register as a streaming producer when we connect
+        """
+        protocol = self.connect()
+        self.assertIdentical(protocol.transport.producer, protocol)
+        self.failUnless(protocol.transport.streaming)
+
+    def test_buffer_while_paused(self):
+        """ Test messages are buffered while paused and sent in order when
+            we are resumed
+        """
+        protocol = self.connect()
+        protocol.send_to_graylog('foo')
+        protocol.pauseProducing()
+        protocol.send_to_graylog('bar')
+        protocol.send_to_graylog('baz')
+
+        self.assertEquals(protocol.transport.value(), 'foo\x00')
+        self.assertEquals(list(protocol.buffer), ['bar\x00', 'baz\x00'])
+
+        protocol.resumeProducing()
+        protocol.send_to_graylog('qux')
+        self.assertEquals(
+            protocol.transport.value(), 'foo\x00bar\x00baz\x00qux\x00')
+
+    def test_bounded_while_paused(self):
+        """ Test the buffer's drop policy applies while paused
+        """
+        protocol = self.connect(buffer=MessageBuffer(max_count=2))
+        protocol.pauseProducing()
+        for message in ('a', 'b', 'c', 'd', 'e'):
+            protocol.send_to_graylog(message)
+
+        self.assertEquals(list(protocol.buffer), ['d\x00', 'e\x00'])
+        self.assertEquals(protocol.buffer.dropped, 3)
+
+    def test_pause_during_replay(self):
+        """ Test a replay stops as soon as the transport pauses us, and
+            carries on from where it stopped when we are resumed
+        """
+        protocol = TCPPlainTextProtocol('localhost', 12201)
+        protocol.clock = task.Clock()
+        for message in ('a', 'b', 'c', 'd'):
+            protocol.send_to_graylog(message)
+        protocol.makeConnection(PausingTransport(pause_after=2))
+
+        self.assertEquals(protocol.transport.value(), 'a\x00b\x00')
+        self.failUnless(protocol.paused)
+        self.failIf(protocol.buffer.replaying)
+
+        protocol.send_to_graylog('e')
+        protocol.resumeProducing()
+        self.assertEquals(
+            protocol.transport.value(), 'a\x00b\x00c\x00d\x00e\x00')
+
+    @defer.inlineCallbacks
+    def test_sustained_load(self):
+        """ Test nothing is dropped when bursts of messages pause us, as
+            long as the transport keeps up on average. Each burst is sent
+            in a reactor iteration of its own
+        """
+        protocol = self.connect(
+            SlowTransport(buffer_writes=600),
+            buffer=MessageBuffer(max_count=1000))
+        sent = 0
+        for burst in [800, 200] * 20:
+            for _ in xrange(burst):
+                protocol.send_to_graylog(str(sent))
+                sent += 1
+            yield task.deferLater(reactor, 0, protocol.transport.send)
+
+        self.assertEquals(protocol.buffer.dropped, 0)
+        self.assertEquals(protocol.pauses, 20)
+        self.assertEquals(
+            protocol.transport.value(),
+            ''.join(['%d\x00' % (i, ) for i in xrange(sent)]))
+
+    def test_paused_time(self):
+        """ Test the time spent paused is counted, including a pause still
+            going on and one ended by losing the connection
+        """
+        protocol = self.connect()
+        protocol.pauseProducing()
+        protocol.clock.advance(1.5)
+        protocol.pauseProducing()
+        self.assertEquals(protocol.paused_seconds(), 1.5)
+
+        protocol.resumeProducing()
+        protocol.clock.advance(10)
+        protocol.pauseProducing()
+        protocol.clock.advance(2)
+        protocol.connectionLost(None)
+        protocol.clock.advance(10)
+
+        self.assertEquals(protocol.paused_seconds(), 3.5)
+        self.assertEquals(protocol.pauses, 2)
+        self.failIf(protocol.paused)
+
+    def test_pool_skips_paused(self):
+        """ Test a pool passes over paused connections
+        """
+        pool = TCPConnectionPool(
+            TCPPlainTextProtocol, [('a', 1)], 2)
+        for protocol in pool.protocols:
+            protocol.makeConnection(WriteCountingTransport())
+        pool.protocols[0].pauseProducing()
+        for message in ('foo', 'bar', 'baz'):
+            pool.send_to_graylog(message)
+
+        self.assertEquals(pool.protocols[0].transport.value(), '')
+        self.assertEquals(
+            pool.protocols[1].transport.value(), 'foo\x00bar\x00baz\x00')
+
+
+class TestTCPConnectionPool(unittest.TestCase):
+    """ Test spreading messages over several connections
+    """
+
+    def pool(self, size, **kwargs):
+        pool = TCPConnectionPool(
+            TCPPlainTextProtocol, [('a', 1), ('b', 2)], size, **kwargs)
+        for protocol in pool.protocols:
+            protocol.makeConnection(WriteCountingTransport())
+        return pool
+
+    def test_endpoints(self):
+        """ Test connections are shared between the endpoints
+        """
+        pool = self.pool(3)
+        self.assertEquals(
+            [(p.host, p.port) for p in pool.protocols],
+            [('a', 1), ('b', 2), ('a', 1)])
+
+    def test_round_robin(self):
+        """ Test messages go to each connected protocol in turn
+        """
+        pool = self.pool(3)
+        pool.protocols[1].connectionLost(None)
+        for message in ('foo', 'bar', 'baz'):
+            pool.send_to_graylog(message)
+
+        self.assertEquals(
+            [p.transport.value() for p in pool.protocols],
+            ['foo\x00baz\x00', '', 'bar\x00'])
+
+    def test_all_disconnected(self):
+        """ Test messages are shared between the buffers while every
+            connection is down
+        """
+        pool = self.pool(2)
+        for protocol in pool.protocols:
+            protocol.connectionLost(None)
+        for message in ('foo', 'bar', 'baz'):
+            pool.send_to_graylog(message)
+
+        self.assertEquals(
+            [list(p.buffer) for p in pool.protocols],
+            [['foo\x00', 'baz\x00'], ['bar\x00']])
+
+    def test_least_buffered(self):
+        """ Test messages go to the connection with the least data waiting
+        """
+        pool = self.pool(2, balance=LEAST_BUFFERED, coalesce=True)
+        pool.protocols[0].clock = pool.protocols[1].clock = task.Clock()
+        pool.send_to_graylog('foo')
+        pool.send_to_graylog('bar')
+        pool.send_to_graylog('bazqux')
+        pool.send_to_graylog('a')
+
+        self.assertEquals(
+            [[m for m, _ in p._pending] for p in pool.protocols],
+            [['foo\x00', 'bazqux\x00'], ['bar\x00', 'a\x00']])
+
+    def test_stats(self):
+        """ Test the stats of each connection
+        """
+        pool = self.pool(2)
+        pool.send_to_graylog('foo')
+        pool.protocols[1].connectionLost(None)
+
+        stats = pool.stats()
+        self.assertEquals(stats[0]['messages_sent'], 1)
+        self.assertEquals(stats[0]['bytes_sent'], 4)
+        self.assertTrue(stats[0]['connected'])
+        self.assertFalse(stats[1]['connected'])
+        self.assertEquals(stats[1]['disconnects'], 1)
+
+    def test_shared_buffer(self):
+        """ Test a single buffer can not be shared between connections
+        """
+        self.assertRaises(
+            ValueError, TCPConnectionPool, TCPPlainTextProtocol,
+            [('a', 1)], 2, buffer=MessageBuffer())
@@ -0,0 +1,121 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Tests for :class: `~txgraylog.throttle.Throttle`
+"""
+from twisted.trial import unittest
+from twisted.internet import task
+from twisted.python import failure
+
+from txgraylog.test.helpers import make_event
+from txgraylog.throttle import Throttle, BY_LEVEL
+
+
+class TestThrottle(unittest.TestCase):
+    """ Test sampling, merging and rate limiting events
+    """
+
+    def make_throttle(self, **kwargs):
+        throttle = Throttle(**kwargs)
+        throttle.clock = self.clock = task.Clock()
+        self.sent = []
+        return throttle
+
+    def send(self, throttle, *events):
+        for event in events:
+            throttle.filter(event, self.sent.append)
+
+    def test_pass_through(self):
+        """ Test everything is sent when no stage is configured
+        """
+        throttle = self.make_throttle()
+        self.send(throttle, *[make_event()] * 5)
+        self.assertEquals(len(self.sent), 5)
+        self.assertEquals(throttle.dropped, 0)
+
+    def test_sample(self):
+        """ Test only a fraction of the sampled levels are kept
+        """
+        throttle = self.make_throttle(sample={7: 0.25})
+        draws = iter([0.1, 0.5, 0.9, 0.2])
+        throttle.random = lambda: next(draws)
+        self.send(throttle, *[make_event(level=7)] * 4)
+        self.send(throttle, make_event(level=3))
+
+        self.assertEquals(
+            [event['level'] for event in self.sent], [7, 7, 3])
+        self.assertEquals(throttle.sampled, 2)
+
+    def test_dedupe(self):
+        """ Test repeats are merged into one event with a repeat count
+        """
+        throttle = self.make_throttle(dedupe_window=10)
+        self.send(throttle, *[make_event()] * 4)
+        self.send(throttle, make_event('other'))
+        self.assertEquals(len(self.sent), 2)
+        self.assertEquals(throttle.merged, 3)
+
+        self.clock.advance(10)
+        self.assertEquals(len(self.sent), 3)
+        self.assertEquals(self.sent[-1]['repeat_count'], 3)
+        self.assertEquals(self.sent[-1]['message'], ('hello', ))
+
+        # the window is over, so the next one is sent straight away
+        self.send(throttle, make_event())
+        self.assertEquals(len(self.sent), 4)
+        self.failIf('repeat_count' in self.sent[-1])
+        self.clock.advance(10)
+        self.assertEquals(len(self.sent), 4)
+        self.failIf(self.clock.getDelayedCalls())
+
+    def test_dedupe_failures(self):
+        """ Test failures are merged by their error
+        """
+        def make_failure(value):
+            try:
+                raise ValueError(value)
+            except ValueError:
+                return {
+                    'message': (), 'system': 'app', 'isError': True,
+                    'failure': failure.Failure(),
+                }
+
+        throttle = self.make_throttle(dedupe_window=10)
+        self.send(throttle, make_failure('a'), make_failure('a'),
+                  make_failure('b'))
+        self.assertEquals(len(self.sent), 2)
+
+    def test_dedupe_stop(self):
+        """ Test merged events are sent when the throttle is stopped
+        """
+        throttle = self.make_throttle(dedupe_window=10)
+        self.send(throttle, *[make_event()] * 3)
+        throttle.stop()
+        self.assertEquals(self.sent[-1]['repeat_count'], 2)
+        self.failIf(self.clock.getDelayedCalls())
+
+    def test_rate_limit(self):
+        """ Test each system has its own token bucket
+        """
+        throttle = self.make_throttle(rate=2, burst=3)
+        self.send(throttle, *[make_event(system='a')] * 5)
+        self.send(throttle, make_event(system='b'))
+        self.assertEquals(len(self.sent), 4)
+        self.assertEquals(throttle.limited, 2)
+
+        self.clock.advance(1)
+        self.send(throttle, *[make_event(system='a')] * 3)
+        self.assertEquals(len(self.sent), 6)
+        self.assertEquals(throttle.stats(), {
+            'sampled': 0, 'merged': 0, 'limited': 3, 'dropped': 3})
+
+    def test_rate_limit_by_level(self):
+        """ Test rate limiting by level with a rate for one level
+        """
+        throttle = self.make_throttle(
+            rate=1, limit_by=BY_LEVEL, rates={3: None})
+        self.send(throttle, *[make_event(level=6)] * 3)
+        self.send(throttle, *[make_event(level=3)] * 3)
+        self.assertEquals(
+            [event['level'] for event in self.sent], [6, 3, 3, 3])
@@ -0,0 +1,114 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Tests for :class: `~txgraylog.protocol.tracebacks.TracebackCache`
+"""
+from twisted.trial import unittest
+from twisted.python.failure import Failure
+
+from txgraylog.protocol.limits import SizeLimits
+from txgraylog.protocol.tracebacks import TracebackCache
+
+
+def fail(message, error=ValueError):
+    try:
+        raise error(message)
+    except Exception:
+        return Failure()
+
+
+def fail_elsewhere(message):
+    try:
+        raise ValueError(message)
+    except Exception:
+        return Failure()
+
+
+def recurse(depth):
+    if depth:
+        recurse(depth - 1)
+    raise ValueError('bottom')
+
+
+class TestTracebackCache(unittest.TestCase):
+    """ Test reusing the formatted tracebacks of repeated failures
+    """
+
+    def setUp(self):
+        self.cache = TracebackCache(max_size=2)
+
+    def test_same_text(self):
+        """ Test a reused traceback is the one the failure would format,
+            with its own value
+        """
+        for i in xrange(3):
+            failure = fail('bad value %d' % (i, ))
+            self.assertEquals(
+                self.cache.format(failure), failure.getTraceback())
+
+        self.assertEquals(self.cache.hits, 2)
+        self.assertEquals(self.cache.misses, 1)
+        self.assertEquals(len(self.cache), 1)
+
+    def test_fingerprint(self):
+        """ Test failures of another type or raised at another place are
+            formatted on their own
+        """
+        self.cache.format(fail('foo'))
+        self.cache.format(fail('foo', KeyError))
+        self.cache.format(fail_elsewhere('foo'))
+
+        self.assertEquals(self.cache.hits, 0)
+        self.assertEquals(self.cache.misses, 3)
+
+    def test_eviction(self):
+        """ Test the least recently used traceback is evicted once the
+            cache is full
+        """
+        # the ValueError was used more recently than the KeyError, so the
+        # KeyError is evicted for the TypeError
+        errors = [
+            ValueError, KeyError, ValueError, TypeError, ValueError, KeyError]
+        for error in errors:
+            self.cache.format(fail('foo', error))
+
+        self.assertEquals(self.cache.hits, 2)
+        self.assertEquals(self.cache.misses, 4)
+        self.assertEquals(self.cache.evicted, 2)
+        self.assertEquals(len(self.cache), 2)
+
+    def test_cleaned(self):
+        """ Test failures cleaned by a Deferred, whose frames are lists, are
+            cached as well
+        """
+        for _ in xrange(2):
+            failure = fail('foo')
+            failure.cleanFailure()
+            self.assertEquals(
+                self.cache.format(failure), failure.getTraceback())
+        self.assertEquals(self.cache.hits, 1)
+
+    def test_no_frames(self):
+        """ Test failures which were never raised are cached by type
+        """
+        first, second = Failure(KeyError('a')), Failure(KeyError('b'))
+        self.cache.format(first)
+        self.assertEquals(self.cache.format(second), second.getTraceback())
+        self.assertEquals(self.cache.hits, 1)
+
+    def test_limits(self):
+        """ Test the tracebacks trimmed by the size limits are reused
+        """
+        limits = SizeLimits(max_frames=10, tracebacks=self.cache)
+        for _ in xrange(2):
+            try:
+                recurse(50)
+            except ValueError:
+                failure = Failure()
+            text = limits.traceback(failure)
+        self.assertIn('<42 frames omitted>', text)
+        self.assertEquals(self.cache.hits, 1)
+
+        uncached = SizeLimits(max_frames=10, tracebacks=None)
+        self.assertEquals(uncached.traceback(failure), text)
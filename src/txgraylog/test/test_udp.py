@@ -0,0 +1,425 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+Tests for :class: `~txgraylog.protocol.udp.UDPPlainTextProtocol`
+"""
+import errno
+import socket
+import time
+import zlib
+import binascii
+
+from twisted.trial import unittest
+from twisted.internet import defer, reactor, task
+from twisted.python import randbytes
+from twisted.test import proto_helpers
+
+from txgraylog.buffering import MessageBuffer
+from txgraylog.encoder import EncoderPool
+from txgraylog.protocol import mmsg
+from txgraylog.protocol.udp import UDPGelfProtocol, UDPPlainTextProtocol
+
+
+class FakeSocket(object):
+    """ Socket recording scatter/gather writes
+    """
+
+    def __init__(self):
+        self.sent = []
+
+    def sendmsg(self, buffers):
+        self.sent.append(buffers)
+        return sum(len(b) for b in buffers)
+
+    def setsockopt(self, level, option, value):
+        self.options = (level, option, value)
+
+
+class FakeDatagramTransport(proto_helpers.FakeDatagramTransport):
+    """ Datagram transport which records connected writes
+    """
+
+    error = None
+
+    def connect(self, host, port):
+        self.address = (host, port)
+
+    def write(self, packet, addr=None):
+        if self.error is not None:
+            raise socket.error(self.error, 'failed')
+        self.written.append(packet)
+
+
+class FakeSender(object):
+    """ Batch sender recording the datagrams sent in each call, which
+        takes at most `limit` datagrams a call and can fail with `errors`
+    """
+
+    def __init__(self, limit=1024):
+        self.limit = limit
+        self.calls = []
+        self.errors = []
+
+    def send(self, sock, datagrams, start=0):
+        if self.errors:
+            raise socket.error(self.errors.pop(0), 'failed')
+        batch = datagrams[start:start + self.limit]
+        self.calls.append(batch)
+        return len(batch)
+
+
+class TestUDPGelf(unittest.TestCase):
+    """ Test sending GELF messages over UDP
+    """
+
+    def connect(self, transport):
+        protocol = UDPGelfProtocol('127.0.0.1', 12201)
+        protocol.transport = transport
+        protocol.connected = True
+        return protocol
+
+    def event(self, message):
+        return {
+            'system': 'protocol',
+            'isError': False,
+            'message': [message],
+            'time': time.time(),
+        }
+
+    def test_write(self):
+        """ Test each datagram is written to the transport
+        """
+        protocol = self.connect(FakeDatagramTransport())
+        protocol.log_message(self.event('foo'))
+
+        self.assertEquals(len(protocol.transport.written), 1)
+        self.failUnless(zlib.decompress(protocol.transport.written[0]))
+
+    def test_sendmsg(self):
+        """ Test chunks are sent with scatter/gather writes where the socket
+            supports them
+        """
+        transport = FakeDatagramTransport()
+        transport.socket = FakeSocket()
+        protocol = self.connect(transport)
+
+        message = binascii.hexlify(randbytes.insecureRandom(3000))
+        protocol.log_message(self.event(message))
+
+        self.assertEquals(transport.written, [])
+        self.failUnless(len(transport.socket.sent) > 1)
+        for header, piece in transport.socket.sent:
+            self.failUnless(header.startswith('\x1e\x0f'))
+            self.assertIsInstance(piece, memoryview)
+
+
+class TestUDPPacing(unittest.TestCase):
+    """ Test pacing datagrams to a number of packets or bytes a second
+    """
+
+    def connect(self, **kwargs):
+        protocol = UDPPlainTextProtocol('127.0.0.1', 12201, **kwargs)
+        protocol.clock = task.Clock()
+        protocol.transport = FakeDatagramTransport()
+        protocol.connected = True
+        return protocol
+
+    def test_unpaced(self):
+        """ Test datagrams are written straight away by default
+        """
+        protocol = self.connect()
+        for i in xrange(100):
+            protocol.send_to_graylog('foo')
+        self.assertEquals(len(protocol.transport.written), 100)
+        self.failIf(protocol.paced)
+
+    def test_packet_rate(self):
+        """ Test no more than the packet rate is sent, after an initial
+            burst
+        """
+        protocol = self.connect(packet_rate=100, burst=0.05)
+        for i in xrange(20):
+            protocol.send_to_graylog(str(i))
+
+        self.assertEquals(protocol.transport.written, list('01234'))
+        protocol.clock.advance(0.05)
+        self.assertEquals(len(protocol.transport.written), 10)
+        protocol.clock.pump([0.01] * 10)
+        self.assertEquals(
+            protocol.transport.written, [str(i) for i in xrange(20)])
+        self.assertEquals(protocol.clock.getDelayedCalls(), [])
+
+    def test_byte_rate(self):
+        """ Test no more than the byte rate is sent
+        """
+        protocol = self.connect(byte_rate=1000, burst=0.1)
+        for i in xrange(10):
+            protocol.send_to_graylog('x' * 100)
+
+        self.assertEquals(len(protocol.transport.written), 1)
+        protocol.clock.pump([0.1] * 9)
+        self.assertEquals(len(protocol.transport.written), 10)
+
+    def test_chunks_together(self):
+        """ Test the chunks of a message are sent together even when they
+            are more than the rate allows at once
+        """
+        protocol = self.connect(packet_rate=10, burst=0.1)
+        protocol._send(['a1', 'a2', 'a3', 'a4', 'a5'], 6)
+        protocol._send(['b1', 'b2'], 6)
+
+        self.assertEquals(
+            protocol.transport.written, ['a1', 'a2', 'a3', 'a4', 'a5'])
+        protocol.clock.advance(0.45)
+        self.assertEquals(len(protocol.transport.written), 5)
+        protocol.clock.advance(0.05)
+        self.assertEquals(
+            protocol.transport.written[5:], ['b1', 'b2'])
+
+    @defer.inlineCallbacks
+    def test_chunks_together_pooled(self):
+        """ Test the chunks of a message encoded in an encoder pool are
+            sent together
+        """
+        protocol = self.connect(packet_rate=10, burst=0.1)
+        protocol.encode = lambda event: [
+            '%s%d' % (event['message'], i) for i in xrange(1, 4)]
+        pool = EncoderPool(protocol, size=1)
+        pool.start()
+        self.addCleanup(pool.stop)
+        pool.submit({'message': 'a'})
+        pool.submit({'message': 'b'})
+        while pool.pending:
+            yield task.deferLater(reactor, 0.001, lambda: None)
+
+        self.assertEquals(protocol.transport.written, ['a1', 'a2', 'a3'])
+        protocol.clock.advance(0.3)
+        self.assertEquals(
+            protocol.transport.written[3:], ['b1', 'b2', 'b3'])
+
+        """ Test messages are buffered once the queue is full and sent in
+            order after those queued
+        """
+        protocol = self.connect(
+            packet_rate=10, burst=0.1, queue_size=2,
+            buffer=MessageBuffer(max_count=3))
+        for i in xrange(10):
+            protocol.send_to_graylog(str(i))
+
+        self.assertEquals(protocol.transport.written, ['0'])
+        self.assertEquals(list(protocol.buffer), ['7', '8', '9'])
+        self.assertEquals(protocol.buffer.dropped, 4)
+
+        protocol.clock.pump([0.1] * 5)
+        self.assertEquals(
+            protocol.transport.written, ['0', '1', '2', '7', '8', '9'])
+
+    def test_chunks_buffered_whole(self):
+        """ Test the chunks of a message are buffered, dropped and paced
+            together once the queue is full
+        """
+        protocol = self.connect(
+            packet_rate=10, burst=0.1, queue_size=1,
+            buffer=MessageBuffer(max_count=2))
+        messages = [
+            ['a1', 'a2', 'a3'], ['b1', 'b2'], ['c1', 'c2'],
+            ['d1', 'd2', 'd3'], ['e1', 'e2']]
+        for datagrams in messages:
+            protocol._send(datagrams, 6)
+
+        self.assertEquals(
+            list(protocol.buffer), [('d1', 'd2', 'd3'), ('e1', 'e2')])
+        self.assertEquals(protocol.buffer.dropped, 1)
+
+        # whenever the pacer stops, it is between two messages
+        boundaries = set([0, 3, 5, 8, 10])
+        for _ in xrange(100):
+            self.assertIn(len(protocol.transport.written), boundaries)
+            protocol.clock.advance(0.01)
+        self.assertEquals(
+            protocol.transport.written,
+            ['a1', 'a2', 'a3', 'b1', 'b2', 'd1', 'd2', 'd3', 'e1', 'e2'])
+
+    def test_paced_replay(self):
+        """ Test messages buffered before we connect are paced once we do
+        """
+        protocol = UDPPlainTextProtocol(
+            '127.0.0.1', 12201, packet_rate=10, burst=0.2)
+        protocol.clock = task.Clock()
+        for i in xrange(6):
+            protocol.send_to_graylog(str(i))
+
+        protocol.transport = FakeDatagramTransport()
+        protocol.resolved = protocol.started = True
+        protocol.resolver.choose = lambda family=None: '127.0.0.1'
+        protocol.connect()
+
+        self.assertEquals(protocol.transport.written, ['0', '1'])
+        protocol.send_to_graylog('6')
+        protocol.clock.pump([0.1] * 5)
+        self.assertEquals(
+            protocol.transport.written, [str(i) for i in xrange(7)])
+        self.assertEquals(protocol.buffer.replayed, 7)
+
+    def test_send_errors(self):
+        """ Test datagrams refused or dropped for lack of buffer space are
+            counted rather than raised
+        """
+        protocol = self.connect()
+        protocol.transport.error = errno.ENOBUFS
+        protocol.send_to_graylog('foo')
+        protocol.transport.error = errno.EAGAIN
+        protocol.send_to_graylog('foo')
+        protocol.transport.error = errno.ECONNREFUSED
+        protocol.send_to_graylog('foo')
+
+        self.assertEquals(protocol.send_dropped, 2)
+        self.assertEquals(protocol.refused, 1)
+
+        protocol.transport.error = errno.EPERM
+        self.assertRaises(socket.error, protocol.send_to_graylog, 'foo')
+
+    def test_send_buffer(self):
+        """ Test the socket's send buffer is sized when we start
+        """
+        protocol = UDPPlainTextProtocol(
+            '127.0.0.1', 12201, send_buffer=4194304)
+        protocol.transport = FakeDatagramTransport()
+        protocol.transport.socket = FakeSocket()
+        protocol.startProtocol()
+
+        self.assertEquals(
+            protocol.transport.socket.options,
+            (socket.SOL_SOCKET, socket.SO_SNDBUF, 4194304))
+
+
+class TestUDPCoalescing(unittest.TestCase):
+    """ Test sending the datagrams written during a reactor iteration in
+        batches
+    """
+
+    def connect(self, **kwargs):
+        protocol = UDPPlainTextProtocol(
+            '127.0.0.1', 12201, coalesce=True, **kwargs)
+        protocol.clock = task.Clock()
+        protocol.transport = FakeDatagramTransport()
+        protocol.transport.socket = FakeSocket()
+        protocol.connected = True
+        protocol.sender = FakeSender()
+        return protocol
+
+    def test_coalesced(self):
+        """ Test datagrams are sent together at the end of the iteration
+        """
+        protocol = self.connect()
+        for i in xrange(10):
+            protocol.send_to_graylog(str(i))
+        self.assertEquals(protocol.sender.calls, [])
+
+        protocol.clock.advance(0)
+        self.assertEquals(
+            protocol.sender.calls, [[str(i) for i in xrange(10)]])
+        self.assertEquals(protocol.transport.written, [])
+
+    def test_batch_size(self):
+        """ Test a full batch is sent straight away
+        """
+        protocol = self.connect(batch_size=4)
+        for i in xrange(10):
+            protocol.send_to_graylog(str(i))
+        self.assertEquals(len(protocol.sender.calls), 2)
+
+        protocol.clock.advance(0)
+        self.assertEquals(
+            [len(batch) for batch in protocol.sender.calls], [4, 4, 2])
+
+    def test_partial_send(self):
+        """ Test the rest of a batch is sent when the kernel takes only part
+            of it
+        """
+        protocol = self.connect()
+        protocol.sender.limit = 3
+        for i in xrange(8):
+            protocol.send_to_graylog(str(i))
+        protocol.flush()
+
+        self.assertEquals(
+            sum(protocol.sender.calls, []), [str(i) for i in xrange(8)])
+        self.assertEquals(len(protocol.sender.calls), 3)
+
+    def test_send_errors(self):
+        """ Test a refused datagram is skipped, and that the rest of a batch
+            the kernel has no room for is counted as dropped
+        """
+        protocol = self.connect()
+        protocol.sender.errors = [errno.ECONNREFUSED]
+        for i in xrange(5):
+            protocol.send_to_graylog(str(i))
+        protocol.flush()
+
+        self.assertEquals(protocol.refused, 1)
+        self.assertEquals(protocol.sender.calls, [['1', '2', '3', '4']])
+
+        protocol.sender.errors = [errno.ENOBUFS]
+        for i in xrange(5):
+            protocol.send_to_graylog(str(i))
+        protocol.flush()
+        self.assertEquals(protocol.send_dropped, 5)
+
+        protocol.sender.errors = [errno.EPERM]
+        protocol.send_to_graylog('foo')
+        self.assertRaises(socket.error, protocol.flush)
+
+    def test_stop(self):
+        """ Test the datagrams collected so far are sent when we stop
+        """
+        protocol = self.connect()
+        protocol.send_to_graylog('foo')
+        protocol.stopProtocol()
+
+        self.assertEquals(protocol.sender.calls, [['foo']])
+        self.failIf(protocol.clock.getDelayedCalls())
+
+    def test_unavailable(self):
+        """ Test datagrams are written one at a time without sendmmsg
+        """
+        self.patch(mmsg, 'available', False)
+        protocol = UDPPlainTextProtocol('127.0.0.1', 12201, coalesce=True)
+        protocol.transport = FakeDatagramTransport()
+        protocol.connected = True
+        protocol.send_to_graylog('foo')
+
+        self.assertIdentical(protocol.sender, None)
+        self.assertEquals(protocol.transport.written, ['foo'])
+
+
+class TestBatchSender(unittest.TestCase):
+    """ Test sending datagrams with sendmmsg on a real socket
+    """
+
+    if not mmsg.available:
+        skip = 'sendmmsg is not available'
+
+    def setUp(self):
+        self.receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.receiver.bind(('127.0.0.1', 0))
+        self.addCleanup(self.receiver.close)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.connect(self.receiver.getsockname())
+        self.addCleanup(self.sock.close)
+
+    def test_send(self):
+        """ Test every datagram arrives whole and in order
+        """
+        datagrams = ['datagram %d ' % i * (i + 1) for i in xrange(20)]
+        sender = mmsg.BatchSender(8)
+
+        self.assertEquals(sender.send(self.sock, datagrams), 8)
+        self.assertEquals(sender.send(self.sock, datagrams, 8), 8)
+        self.assertEquals(sender.send(self.sock, datagrams, 16), 4)
+        self.assertEquals(sender.send(self.sock, datagrams, 20), 0)
+        self.assertEquals(sender.calls, 3)
+
+        self.assertEquals(
+            [self.receiver.recv(65536) for _ in xrange(20)], datagrams)
@@ -0,0 +1,207 @@
+# Copyright (c) 2015 Adam Drakeford <adamdrakeford@gmail.com>
+# See LICENSE for more details
+
+"""
+.. module:: throttle
+    :platform: Unix, Windows
+    :synopsis: Sampling, rate limiting and deduplication of events, to keep
+        storms of log messages from flooding Graylog
+.. moduleauthor:: Adam Drakeford <adamdrakeford@gmail.com>
+"""
+
+import random
+
+from twisted.internet import reactor
+from twisted.python import log
+
+from txgraylog.protocol.gelf import event_level
+
+BY_SYSTEM, BY_LEVEL = 0, 1
+
+
+class Throttle(object):
+    """ Decides which events are sent to Graylog. Events pass through three
+        stages, each of which is off unless configured:
+            sampling keeps a fraction of the events of each level given
+            deduplication sends the first of a run of identical events
+                straight away and merges the rest into a single event, sent
+                once the window is over, with a `repeat_count` field
+            rate limiting gives each system, or each level, a token bucket
+                which holds `burst` events and refills at `rate` events a
+                second. Events arriving at an empty bucket are dropped
+        Events are identical when they have the same system, level and
+        message, or the same system, level and error for failures
+    """
+
+    max_keys = 10000
+
+    def __init__(
+            self, sample=None, dedupe_window=0, rate=None, burst=None,
+            limit_by=BY_SYSTEM, rates=None):
+        """ Initialise the throttle
+            :param sample: `dict` of the fraction of events to keep for
+                each syslog level, such as `{7: 0.01}`
+            :param dedupe_window: the number of seconds identical events are
+                merged for, or 0 to send them all
+            :param rate: the number of events a second allowed for each
+                system or level, or None for no limit
+            :param burst: the number of events which may be sent at once
+                after a quiet period, by default the same as `rate`
+            :param limit_by: BY_SYSTEM to rate limit each system, BY_LEVEL
+                to rate limit each level, or a callable taking an event and
+                returning the key to rate limit it by
+            :param rates: `dict` of rates for particular systems or levels,
+                overriding `rate`
+        """
+        self.sample = dict(sample or {})
+        self.dedupe_window = dedupe_window
+        self.rate = rate
+        self.burst = burst
+        self.limit_by = limit_by
+        self.rates = dict(rates or {})
+        self.clock = reactor
+        self.random = random.random
+
+        self.sampled = 0
+        self.merged = 0
+        self.limited = 0
+
+        # key -> [tokens, last refilled]
+        self._buckets = {}
+        # key -> [window end, repeats, last repeat, send]
+        self._repeats = {}
+        self._flush_call = None
+
+    @property
+    def dropped(self):
+        """ The number of events dropped by sampling and rate limiting
+        """
+        return self.sampled + self.limited
+
+    def stats(self):
+        """ The number of events dropped and merged by each stage
+        """
+        return {
+            'sampled': self.sampled,
+            'merged': self.merged,
+            'limited': self.limited,
+            'dropped': self.dropped,
+        }
+
+    def filter(self, event, send):
+        """ Pass an event through the stages, calling `send` with it if it
+            should be sent. Merged events are later sent through `send` too
+        """
+        level = event_level(event)
+
+        if level in self.sample and self.random() >= self.sample[level]:
+            self.sampled += 1
+            return
+
+        if self.dedupe_window and self._repeated(event, level, send):
+            self.merged += 1
+            return
+
+        if self._limited(event, level):
+            self.limited += 1
+            return
+
+        send(event)
+
+    def flush(self):
+        """ Send the merged events for every window which has ended
+        """
+        self._flush_call = None
+        now = self.clock.seconds()
+
+        for key, (end, repeats, last, send) in self._repeats.items():
+            if end > now:
+                continue
+            del self._repeats[key]
+            if repeats:
+                send(dict(last, repeat_count=repeats))
+
+        if self._repeats:
+            self._flush_call = self.clock.callLater(
+                self.dedupe_window, self.flush)
+
+    def stop(self, send_merged=True):
+        """ Stop the flush timer, sending the merged events of windows
+            which have not ended yet unless told not to
+        """
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+
+        repeats, self._repeats = self._repeats, {}
+        if send_merged:
+            for _, count, last, send in repeats.itervalues():
+                if count:
+                    send(dict(last, repeat_count=count))
+
+    def _repeated(self, event, level, send):
+        """ Whether an event repeats one sent within the window, in which
+            case it is merged
+        """
+        if event.get('isError') and 'failure' in event:
+            f = event['failure']
+            message = (f.type, f.getErrorMessage())
+        else:
+            # messages logged with a format have to be rendered to tell
+            # them apart
+            message = event.get('message') or log.textFromEventDict(event)
+        key = (event.get('system'), level, message)
+
+        try:
+            entry = self._repeats.get(key)
+        except TypeError:
+            # messages made of unhashable objects are never merged
+            return False
+
+        if entry is not None:
+            entry[1] += 1
+            entry[2] = event
+            return True
+
+        if len(self._repeats) < self.max_keys:
+            self._repeats[key] = [
+                self.clock.seconds() + self.dedupe_window, 0, None, send]
+            if self._flush_call is None:
+                self._flush_call = self.clock.callLater(
+                    self.dedupe_window, self.flush)
+        return False
+
+    def _limited(self, event, level):
+        """ Take a token from the bucket for an event, returning whether
+            there was none to take
+        """
+        if self.limit_by == BY_SYSTEM:
+            key = event.get('system')
+        elif self.limit_by == BY_LEVEL:
+            key = level
+        else:
+            key = self.limit_by(event)
+
+        rate = self.rates.get(key, self.rate)
+        if rate is None:
+            return False
+
+        now = self.clock.seconds()
+        try:
+            bucket = self._buckets[key]
+        except KeyError:
+            if len(self._buckets) >= self.max_keys:
+                self._buckets.clear()
+            bucket = self._buckets[key] = [self._capacity(rate), now]
+
+        bucket[0] = min(
+            self._capacity(rate), bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+
+        if bucket[0] < 1:
+            return True
+        bucket[0] -= 1
+        return False
+
+    def _capacity(self, rate):
+        return self.burst if self.burst is not None else max(rate, 1)